@@ -10,8 +10,15 @@ import subprocess
 import shlex
 import shutil
 import time
-from inspect import getframeinfo, stack
+import bisect
+import hashlib
+import resource
 import threading
+import contextlib
+import types
+import traceback
+from inspect import getframeinfo, stack
+import concurrent.futures
 
 logger = logging.getLogger(__name__)
 
@@ -32,12 +39,178 @@ def run_cmd(cmd, ignore_error=False):
     return 0 # all good.
 
 
+def run_cmd_with_rusage(cmd):
+    """
+    Like run_cmd(cmd, ignore_error=True), but also returns the resource usage of the
+    command (and the processes it waited on): (exit val, resource.struct_rusage)
+    """
+
+    logger.info("Running: " + cmd)
+
+    proc = subprocess.Popen(cmd, shell=True)
+
+    # wait4 gives the usage of just this child, even with other commands running concurrently.
+    (pid, status, rusage) = os.wait4(proc.pid, 0)
+    ret = proc.returncode = os.waitstatus_to_exitcode(status)
+
+    if ret != 0:
+        logger.error("Error: Command '{}' returned non-zero exit status {}., exit val: {}".format(cmd, ret, ret))
+
+    return (ret, rusage)
+
+
+
+#################
+## Checkpoints
+#################
+
+"""
+A checkpoint file holds a fingerprint of its step: the sha1 of the command string
+and the size and modification time of each of the step's declared input files.
+A step is rerun when its checkpoint is missing or its fingerprint has changed, ie.
+when the command (parameters, genome lib paths, ...) or any of its inputs changed.
+Empty checkpoints written by earlier versions are never current.
+"""
+
+
+def get_file_fingerprint(filename):
+
+    if not os.path.exists(filename):
+        return "{}\tmissing".format(filename)
+
+    st = os.stat(filename)
+
+    return "{}\t{}\t{}".format(filename, st.st_size, st.st_mtime_ns)
+
+
+def get_checkpoint_fingerprint(cmd, input_files=()):
+
+    checksum = hashlib.sha1(cmd.encode())
+    for input_file in input_files:
+        checksum.update(("\n" + get_file_fingerprint(input_file)).encode())
+
+    return checksum.hexdigest()
+
+
+def checkpoint_is_current(checkpoint_file, fingerprint):
+
+    if not os.path.exists(checkpoint_file):
+        return False
+
+    with open(checkpoint_file, 'rt') as fh:
+        checkpoint_fingerprint = fh.read().strip()
+
+    if checkpoint_fingerprint == fingerprint:
+        return True
+
+    if checkpoint_fingerprint == "":
+        logger.info("Checkpoint {} lacks a fingerprint, so rerunning its step.".format(checkpoint_file))
+    else:
+        logger.info("Command or inputs changed since checkpoint {}, so rerunning its step.".format(checkpoint_file))
+
+    return False
+
+
+def write_checkpoint(checkpoint_file, fingerprint):
+
+    tmp_checkpoint_file = "{}.tmp.{}".format(checkpoint_file, os.getpid())
+    with open(tmp_checkpoint_file, 'wt') as ofh:
+        ofh.write(fingerprint + "\n")
+
+    os.replace(tmp_checkpoint_file, checkpoint_file)
+
+
+
+##############
+## Run report
+##############
+
+RUN_REPORT_FILENAME = "run_report.tsv"
+
+RUN_REPORT_COLUMNS = [ "step_type", "step", "status", "start_time",
+                       "wall_time_sec", "user_cpu_sec", "sys_cpu_sec", "max_rss_kb", "cmd" ]
+
+_run_report_lock = threading.Lock()
+
+
+def get_max_rss_kb(rusage):
+    # ru_maxrss is in kilobytes on linux but bytes on mac.
+    # (for commands, the linux value is floored at the rss of the forking python process)
+    if sys.platform == "darwin":
+        return int(rusage.ru_maxrss / 1024)
+    return rusage.ru_maxrss
+
+
+def write_run_report_record(checkpoint_dir, step_type, step, status, start_time,
+                            wall_time, user_cpu_time, sys_cpu_time, max_rss_kb, cmd=""):
+    """
+    Appends a record to the run report (run_report.tsv) in the checkpoint dir.
+    Records from reruns are appended, so the report keeps the history of the pipeline.
+    """
+
+    report_file = os.path.join(checkpoint_dir, RUN_REPORT_FILENAME)
+
+    record = [ step_type, step, status,
+               time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(start_time)),
+               "{:.3f}".format(wall_time),
+               "{:.3f}".format(user_cpu_time),
+               "{:.3f}".format(sys_cpu_time),
+               str(max_rss_kb),
+               cmd.replace("\t", " ").replace("\n", " ") ]
+
+    with _run_report_lock:
+        write_header = not os.path.exists(report_file)
+        with open(report_file, 'at') as ofh:
+            if write_header:
+                ofh.write("\t".join(RUN_REPORT_COLUMNS) + "\n")
+            ofh.write("\t".join(record) + "\n")
+
+
+def get_thread_rusage():
+    # per-thread cpu times where supported (linux), since pipeline steps may run concurrently
+    return resource.getrusage(getattr(resource, "RUSAGE_THREAD", resource.RUSAGE_SELF))
+
+
+@contextlib.contextmanager
+def track_stage(checkpoint_dir, stage_name):
+    """
+    Records an in-process (python) pipeline stage to the run report:
+
+        with track_stage(checkpoint_dir, "introns"):
+            ...
+
+    cpu times are those of the calling thread during the stage, and max_rss_kb is
+    the peak rss of this process as of the end of the stage.
+    """
+
+    start_time = time.time()
+    start_rusage = get_thread_rusage()
+
+    status = "failed"
+    try:
+        yield
+        status = "ok"
+    finally:
+        end_rusage = get_thread_rusage()
+        write_run_report_record(checkpoint_dir, "in_process", stage_name, status, start_time,
+                                time.time() - start_time,
+                                end_rusage.ru_utime - start_rusage.ru_utime,
+                                end_rusage.ru_stime - start_rusage.ru_stime,
+                                get_max_rss_kb(end_rusage))
+
+
 class Pipeliner(object):
 
     _checkpoint_dir = None
     _cmds_list = []
 
-    def __init__(self, checkpoint_dir):
+    def __init__(self, checkpoint_dir, num_threads=1):
+        """
+        num_threads: cpu budget.  Above 1, commands declaring their inputs/outputs/dependencies
+        are scheduled as a dependency graph, running independent ones concurrently (see _run_cmds_dag).
+        Nothing in this tree uses a budget above 1 yet: the STAR_to_cancer_introns.py --vis
+        steps form a single chain, so it runs its Pipeliners serially.
+        """
 
         checkpoint_dir = os.path.abspath(checkpoint_dir)
 
@@ -45,6 +218,8 @@ class Pipeliner(object):
             os.makedirs(checkpoint_dir)
             
         self._checkpoint_dir = checkpoint_dir
+        self._cmds_list = list()
+        self._num_threads = max(1, num_threads)  # cpu budget shared by concurrently running commands
     
 
 
@@ -64,11 +239,20 @@ class Pipeliner(object):
         return len(self._cmds_list)
 
 
+    def track_stage(self, stage_name):
+        """ context manager recording an in-process stage to this pipeline's run report """
+        return track_stage(self._checkpoint_dir, stage_name)
+
+
     def run(self):
-        for cmd in self._cmds_list:
-            
-            checkpoint_dir = self._checkpoint_dir
-            cmd.run(checkpoint_dir)
+
+        if self._num_threads > 1 and len(self._cmds_list) > 1:
+            self._run_cmds_dag()
+        else:
+            for cmd in self._cmds_list:
+
+                checkpoint_dir = self._checkpoint_dir
+                cmd.run(checkpoint_dir)
 
         # since all commands executed successfully, remove them from the current cmds list
         self._cmds_list = list()
@@ -76,13 +260,133 @@ class Pipeliner(object):
         return
 
 
+    def _get_cmd_dependencies(self):
+        """
+        Returns, for each command, the set of indices of earlier commands it must wait on:
+        those declaring an output that's among its inputs, plus those it explicitly depends on.
+        Commands declaring none of inputs, outputs or dependencies run in their added order
+        relative to all other commands, same as without a cpu budget.
+        """
+
+        cmd_to_idx = { id(cmd) : i for (i, cmd) in enumerate(self._cmds_list) }
+        output_to_cmd_idx = dict()
+        barrier_idx = None
+
+        cmd_dependencies = list()
+
+        for (i, cmd) in enumerate(self._cmds_list):
+
+            if not cmd.declares_dependencies():
+                dependencies = set(range(i))
+                barrier_idx = i
+
+            else:
+                dependencies = set()
+                if barrier_idx is not None:
+                    dependencies.add(barrier_idx)
+
+                for input_file in cmd.get_inputs():
+                    if input_file in output_to_cmd_idx:
+                        dependencies.add(output_to_cmd_idx[input_file])
+
+                for depends_on_cmd in cmd.get_dependencies():
+                    # commands not in the current list were run already.
+                    dep_idx = cmd_to_idx.get(id(depends_on_cmd), None)
+                    if dep_idx is not None:
+                        if dep_idx >= i:
+                            raise RuntimeError("Error, command [ {} ] depends on a command added after it: [ {} ]".format(cmd, depends_on_cmd))
+                        dependencies.add(dep_idx)
+
+                for output_file in cmd.get_outputs():
+                    output_to_cmd_idx[output_file] = i
+
+            cmd_dependencies.append(dependencies)
+
+        return cmd_dependencies
+
+
+    def _run_cmds_dag(self):
+        """
+        Runs each command once the commands it depends on have completed, with as
+        many running concurrently as fit within the cpu budget.  Ready commands are
+        launched in the order they were added.
+        """
+
+        cmd_dependencies = self._get_cmd_dependencies()
+
+        num_cmds = len(self._cmds_list)
+        num_pending_dependencies = [ len(dependencies) for dependencies in cmd_dependencies ]
+        dependents = [ list() for i in range(num_cmds) ]
+        for (i, dependencies) in enumerate(cmd_dependencies):
+            for dep_idx in dependencies:
+                dependents[dep_idx].append(i)
+
+        ready = [ i for i in range(num_cmds) if num_pending_dependencies[i] == 0 ]
+        running = dict()  # future -> cmd idx
+        num_threads_in_use = 0
+        error = None
+
+        def get_cmd_num_threads(cmd_idx):
+            return min(self._cmds_list[cmd_idx].get_num_threads(), self._num_threads)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._num_threads) as executor:
+
+            while ready or running:
+
+                # after an error, just wait for those running to finish.
+                while ready and error is None:
+                    cmd_num_threads = get_cmd_num_threads(ready[0])
+                    if running and num_threads_in_use + cmd_num_threads > self._num_threads:
+                        break
+
+                    cmd_idx = ready.pop(0)
+                    running[executor.submit(self._cmds_list[cmd_idx].run, self._checkpoint_dir)] = cmd_idx
+                    num_threads_in_use += cmd_num_threads
+
+                if not running:
+                    break
+
+                (done, not_done) = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+
+                for future in done:
+                    cmd_idx = running.pop(future)
+                    num_threads_in_use -= get_cmd_num_threads(cmd_idx)
+
+                    try:
+                        future.result()
+                    except Exception as e:
+                        if error is None:
+                            error = e
+                        continue
+
+                    for dependent_idx in dependents[cmd_idx]:
+                        num_pending_dependencies[dependent_idx] -= 1
+                        if num_pending_dependencies[dependent_idx] == 0:
+                            bisect.insort(ready, dependent_idx)
+
+        if error is not None:
+            raise error
+
+        return
+
+
 
 class Command(object):
 
-    def __init__(self, cmd, checkpoint, ignore_error=False):
+    def __init__(self, cmd, checkpoint, ignore_error=False, inputs=None, outputs=None, depends_on=None, num_threads=1):
+        """
+        inputs, outputs: files the command reads and writes.  When run under a Pipeliner
+                         with a cpu budget, a command waits on those producing its inputs.
+        depends_on: other Command objects it must wait on.
+        num_threads: cpus the command uses, counted against the Pipeliner cpu budget.
+        """
         self._cmd = cmd
         self._checkpoint = checkpoint
         self._ignore_error = ignore_error
+        self._inputs = [ os.path.abspath(x) for x in (inputs or []) ]
+        self._outputs = [ os.path.abspath(x) for x in (outputs or []) ]
+        self._depends_on = list(depends_on or [])
+        self._num_threads = num_threads
         self._stacktrace = self._extract_stack(stack())
 
     def get_cmd(self):
@@ -93,6 +397,24 @@ class Command(object):
 
     def get_ignore_error_setting(self):
         return self._ignore_error
+
+    def get_inputs(self):
+        return self._inputs
+
+    def get_outputs(self):
+        return self._outputs
+
+    def get_dependencies(self):
+        return self._depends_on
+
+    def declares_dependencies(self):
+        return bool(self._inputs or self._outputs or self._depends_on)
+
+    def get_num_threads(self):
+        return self._num_threads
+
+    def get_fingerprint(self):
+        return get_checkpoint_fingerprint(self._cmd, self._inputs)
  
 
     def __repr__(self):
@@ -114,15 +436,24 @@ class Command(object):
     def run(self, checkpoint_dir):
 
         checkpoint_file = os.path.sep.join([checkpoint_dir, self.get_checkpoint()])
+        fingerprint = self.get_fingerprint()
         ret = 0
-        if os.path.exists(checkpoint_file):
+        if checkpoint_is_current(checkpoint_file, fingerprint) and all(os.path.exists(x) for x in self.get_outputs()):
             logger.info("CMD: " + self.get_cmd() + " already processed. Skipping.")
         else:
             # execute it.  If it succeeds, make the checkpoint file
             start_time = time.time()
 
             cmdstr = self.get_cmd()
-            ret = run_cmd(cmdstr, True)
+            (ret, rusage) = self._execute()
+
+            end_time = time.time()
+            write_run_report_record(checkpoint_dir, self._step_type, self.get_checkpoint(),
+                                    "failed" if ret else "ok",
+                                    start_time, end_time - start_time,
+                                    rusage.ru_utime, rusage.ru_stime, get_max_rss_kb(rusage),
+                                    cmdstr)
+
             if ret:
                 # failure occurred.
                 errmsg = str("Error, command: [ {} ] failed, stack trace: [ {} ] ".format(cmdstr, self.get_stacktrace()))
@@ -131,39 +462,75 @@ class Command(object):
                 if self.get_ignore_error_setting() is False:
                     raise RuntimeError(errmsg)
             else:
-                end_time = time.time()
                 runtime_minutes = (end_time - start_time) / 60
                 logger.info("Execution Time = {:.2f} minutes. CMD: {}".format(runtime_minutes, cmdstr))
-                run_cmd("touch {}".format(checkpoint_file))  # only if succeeds.
+                write_checkpoint(checkpoint_file, fingerprint)  # only if succeeds.
 
         return ret
 
 
-#############################
-## Parallel command execution
-#############################
+    _step_type = "cmd"
 
+    def _execute(self):
+        """ runs the command, returning (exit val, resource usage) """
+        return run_cmd_with_rusage(self.get_cmd())
 
-class ParallelCommandThread(threading.Thread):
 
-    def __init__(self, cmdobj, checkpointdir, paraCmdListObj):
 
-        threading.Thread.__init__(self)
+class PyCommand(Command):
+    """
+    Pipeline step that calls a python function in-process rather than running a
+    shell command, avoiding an interpreter startup (and module imports) per step:
 
-        self._cmdobj = cmdobj
-        self._checkpointdir = checkpointdir
-        self._paraCmdListObj = paraCmdListObj
+        PyCommand(filter_cancer_introns_file, [prelim_file, 5, output_file], "introns_filtered.ok",
+                  inputs=[prelim_file], outputs=[output_file])
 
+    Checkpoints, dependencies and error handling are the same as for Command.  The
+    step fails if the function raises, and the checkpoint fingerprint is computed from
+    the function name and its arguments, so should only be given arguments with a
+    stable repr (strings, numbers, ...).
+    """
 
-    def run(self):
+    _step_type = "in_process"
+
+    def __init__(self, func, args, checkpoint, kwargs=None, **command_opts):
+
+        self._func = func
+        self._args = list(args)
+        self._kwargs = dict(kwargs or {})
+
+        arg_strs = [ repr(x) for x in self._args ] + [ "{}={!r}".format(k, v) for (k, v) in sorted(self._kwargs.items()) ]
+        cmd = "{}.{}({})".format(func.__module__, func.__qualname__, ", ".join(arg_strs))
+
+        Command.__init__(self, cmd, checkpoint, **command_opts)
+
+
+    def _execute(self):
+
+        logger.info("Running: " + self.get_cmd())
+
+        start_rusage = get_thread_rusage()
+
+        ret = 0
+        try:
+            self._func(*self._args, **self._kwargs)
+        except Exception as e:
+            logger.error("Error: {}\n{}".format(str(e), traceback.format_exc()))
+            ret = 1
+
+        end_rusage = get_thread_rusage()
+
+        rusage = types.SimpleNamespace(ru_utime=end_rusage.ru_utime - start_rusage.ru_utime,
+                                       ru_stime=end_rusage.ru_stime - start_rusage.ru_stime,
+                                       ru_maxrss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+        return (ret, rusage)
 
-        ret = self._cmdobj.run(self._checkpointdir)
 
-        # track job completion and capture success/failure
-        self._paraCmdListObj._num_running -= 1
-        
-        if ret != 0:
-            self._paraCmdListObj._num_errors += 1
+
+#############################
+## Parallel command execution
+#############################
 
 
 class ParallelCommandList(object):
@@ -174,53 +541,69 @@ class ParallelCommandList(object):
         self._checkpoint = checkpoint
         self._num_threads = num_threads
         self._ignore_error = ignore_error
-        self._num_running = 0
-        self._num_errors = 0
+
+    def __repr__(self):
+        return "ParallelCommandList({})".format(self._checkpoint)
+
+    def declares_dependencies(self):
+        # runs in order relative to the other pipeline commands
+        return False
+
+    def get_num_threads(self):
+        return self._num_threads
 
     def run(self, checkpoint_dir):
 
         parallel_job_checkpoint_file = self._checkpoint
 
         full_path_parallel_job_checkpoint_file = os.path.sep.join([checkpoint_dir, parallel_job_checkpoint_file])
-        if os.path.exists(full_path_parallel_job_checkpoint_file):
+        fingerprint = get_checkpoint_fingerprint("\n".join(self._cmdlist))
+        if checkpoint_is_current(full_path_parallel_job_checkpoint_file, fingerprint):
             logger.info("Parallel command series already completed, so skipping. Checkpoint found as: {}".format(full_path_parallel_job_checkpoint_file))
             return
         
         ## run parallel command series, no more than _num_threads simultaneously.
-        
-        cmd_idx = 0
-        while cmd_idx < len(self._cmdlist):
+        ## Each worker thread blocks on its own subprocess, and completions are
+        ## collected here in the calling thread, so there's no shared counter state.
 
-            if self._num_running < self._num_threads:
-                
-                cmdstr = self._cmdlist[cmd_idx]
+        num_errors = 0
 
-                checkpoint_file = "{}.tid-{}".format(parallel_job_checkpoint_file, cmd_idx)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._num_threads) as executor:
 
+            futures = list()
+            for (cmd_idx, cmdstr) in enumerate(self._cmdlist):
+                checkpoint_file = "{}.tid-{}".format(parallel_job_checkpoint_file, cmd_idx)
                 cmdobj = Command(cmdstr, checkpoint_file, ignore_error=True)
-                cmdthread = ParallelCommandThread(cmdobj, checkpoint_dir, self)
-                self._num_running += 1
-                cmdthread.start() # will auto-decrement _num_threads once it completes via shared memory usage.
-                cmd_idx += 1
-
-        ## wait for the remaining ones to finish.
-        iter_counter = 0
-        while self._num_running > 0:
-            time.sleep(1) # avoid unnecessarily running at 100% CPU. Sleeping 1 second is a long enough time in the quantum realm.
-            iter_counter += 1
-            if iter_counter % 60 == 0:
-                sys.stderr.write("\r waiting for {} jobs to complete.    ".format(self._num_running))
-
-
-        if self._num_errors > 0:
-            errmsg = "Error, {} commands failed".format(self._num_errors)
+                futures.append(executor.submit(cmdobj.run, checkpoint_dir))
+
+            ## wait for them to finish.
+            not_done = futures
+            while not_done:
+                (done, not_done) = concurrent.futures.wait(not_done, timeout=60)
+
+                for future in done:
+                    try:
+                        ret = future.result()
+                    except Exception as e:
+                        logger.error("Error, parallel command raised: {}".format(str(e)))
+                        ret = 1
+
+                    if ret != 0:
+                        num_errors += 1
+
+                if not_done:
+                    sys.stderr.write("\r waiting for {} jobs to complete.    ".format(len(not_done)))
+
+
+        if num_errors > 0:
+            errmsg = "Error, {} commands failed".format(num_errors)
             logger.error(errmsg)
             if not self._ignore_error:
                 raise RuntimeError(errmsg)
         else:
             logger.info("All parallel commands succeeded.")
         
-        run_cmd("touch {}".format(full_path_parallel_job_checkpoint_file))
+        write_checkpoint(full_path_parallel_job_checkpoint_file, fingerprint)
 
         logger.info("done running parallel command series.")
         
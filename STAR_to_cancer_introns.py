@@ -24,6 +24,11 @@ from Pipeliner import *
 utildir = scriptdir + "/util"
 sys.path.append(utildir)
 import intron_occurrence_capture as ioc
+import filter_by_min_total_reads
+from make_igv_splice_bed import make_igv_splice_bed
+from cancer_intron_annotator import CancerIntronAnnotator, annotate_cancer_introns
+from cancer_intron_store import open_cancer_intron_store
+from chimeric_junctions_to_introns import map_chimeric_reads_to_introns
 
 
 def main():
@@ -46,8 +51,9 @@ def main():
         "--SJ_tab_file",
         dest="SJ_tab_file",
         type=str,
-        required=True,
-        help="STAR SJ.out.tab file",
+        required=False,
+        default=None,
+        help="STAR SJ.out.tab file (required unless --batch_manifest)",
     )
     parser.add_argument(
         "--chimJ_file",
@@ -95,6 +101,16 @@ def main():
         default="",
         help="sample name for vis title",
     )
+    parser.add_argument(
+        "--batch_manifest",
+        dest="batch_manifest",
+        type=str,
+        required=False,
+        default=None,
+        help="tab-delimited manifest with columns: sample_name, SJ.out.tab, [Chimeric.out.junction], [bam]. "
+        + "All samples are processed in a single run, loading the genome lib resources once. "
+        + "Outputs are written as {output_prefix}.{sample_name}.*",
+    )
 
     args = parser.parse_args()
 
@@ -120,6 +136,18 @@ def main():
     
 
     
+    if args.batch_manifest:
+        if SJ_tab_file:
+            raise RuntimeError("Error, --SJ_tab_file and --batch_manifest are mutually exclusive")
+
+        run_batch(args.batch_manifest, ctat_genome_lib, output_prefix, min_total_reads, VIS_flag)
+
+        logger.info("done.")
+        sys.exit(0)
+
+    if not SJ_tab_file:
+        raise RuntimeError("Error, must specify --SJ_tab_file or --batch_manifest ")
+
     if VIS_flag and not bam_file:
         raise RuntimeError("Error, if --vis, must specify --bam_file ")
 
@@ -139,83 +167,65 @@ def main():
     introns_output_file = output_prefix + ".introns"
     introns_output_file_chckpt = os.path.join(chckpts_dir, "introns.ok")
 
+    targets_list_file = os.path.join(ctat_genome_lib, "ref_annot.gtf.mini.sortu")
+    introns_fingerprint = get_introns_fingerprint(SJ_tab_file, chimJ_file, targets_list_file)
     
-    if not os.path.exists(introns_output_file_chckpt):
-
-        targets_list_file = os.path.join(ctat_genome_lib, "ref_annot.gtf.mini.sortu")
-        chr_intron_bounds = ioc.populate_intron_bounds(targets_list_file)
-        introns_dict = ioc.map_introns_from_splice_tab(SJ_tab_file, chr_intron_bounds)
+    if not step_is_current(introns_output_file_chckpt, introns_fingerprint, introns_output_file):
 
-        if chimJ_file is not None:
-            if not os.path.exists(chimJ_file):
-                raise RuntimeError(
-                    "Error, cannot locate expected chimeric Junctiom out file: {} ".format(
-                        chimJ_file
-                    )
-                )
+        with pipeliner.track_stage("introns"):
+            chr_intron_bounds = ioc.populate_intron_bounds(targets_list_file)
 
-            # must make splice file:
-            chimJ_introns_file = (
-                output_prefix + "." + os.path.basename(chimJ_file) + ".introns.tmp"
+            write_introns_file(
+                SJ_tab_file, chimJ_file, chr_intron_bounds, output_prefix, introns_output_file
             )
-            cmd = str(
-                os.path.join(utildir, "STAR_chimeric_junctions_to_introns.pl")
-                + " -J {} > {}".format(chimJ_file, chimJ_introns_file)
-            )
-            subprocess.check_call(cmd, shell=True)
-
-            introns_dict = ioc.supplement_introns_from_chimeric_junctions_file(
-                chimJ_introns_file, introns_dict, chr_intron_bounds
-            )
-
-        with open(introns_output_file, "wt") as ofh:
-            # write header
-            ofh.write(
-                "\t".join(["intron", "strand", "genes", "uniq_mapped", "multi_mapped"])
-                + "\n"
-            )
-
-            for intron in introns_dict.values():
-                ofh.write(
-                    "\t".join(
-                        [
-                            "{}:{}-{}".format(
-                                intron.chromosome, intron.lend, intron.rend
-                            ),
-                            intron.strand,
-                            intron.genes,
-                            str(intron.uniq_mapped),
-                            str(intron.multi_mapped),
-                        ]
-                    )
-                    + "\n"
-                )
 
         # done, add checkpoint
-        subprocess.check_call("touch {}".format(introns_output_file_chckpt), shell=True)
+        write_checkpoint(introns_output_file_chckpt, introns_fingerprint)
 
     # annotate for cancer introns.
     cancer_introns_file_prelim = output_prefix + ".cancer.introns.prelim"
-    cmd = str(
-        os.path.join(utildir, "annotate_cancer_introns.pl")
-        + " --introns_file {} ".format(introns_output_file)
-        + " --ctat_genome_lib {} ".format(ctat_genome_lib)
-        + " --intron_col 0 "
-        + " > {} ".format(cancer_introns_file_prelim)
-    )
 
-    pipeliner.add_commands([Command(cmd, "prelim_introns.ok")])
+    if open_cancer_intron_store(ctat_genome_lib) is not None:
+        # lookups via the genome lib's compiled store
+        annotate_cmd = PyCommand(
+            annotate_cancer_introns,
+            [ctat_genome_lib, introns_output_file, cancer_introns_file_prelim],
+            "prelim_introns.ok",
+            inputs=[introns_output_file, splicing_db],
+            outputs=[cancer_introns_file_prelim],
+        )
+    else:
+        # no current compiled store: per-intron lookups in the TiedHash index
+        cmd = str(
+            os.path.join(utildir, "annotate_cancer_introns.pl")
+            + " --introns_file {} ".format(introns_output_file)
+            + " --ctat_genome_lib {} ".format(ctat_genome_lib)
+            + " --intron_col 0 "
+            + " > {} ".format(cancer_introns_file_prelim)
+        )
+        annotate_cmd = Command(
+            cmd,
+            "prelim_introns.ok",
+            inputs=[introns_output_file, splicing_db],
+            outputs=[cancer_introns_file_prelim],
+        )
+
+    pipeliner.add_commands([annotate_cmd])
 
     # filter for min support
     cancer_introns_file = output_prefix + ".cancer.introns"
-    cmd = str(
-        os.path.join(utildir, "filter_by_min_total_reads.py")
-        + " --cancer_intron_candidates {}".format(cancer_introns_file_prelim)
-        + " --min_total_reads {} ".format(min_total_reads)
-        + " > {} ".format(cancer_introns_file)
-    )
 
-    pipeliner.add_commands([Command(cmd, "introns_filtered.ok")])
+    pipeliner.add_commands(
+        [
+            PyCommand(
+                filter_by_min_total_reads.filter_cancer_introns_file,
+                [cancer_introns_file_prelim, min_total_reads, cancer_introns_file],
+                "introns_filtered.ok",
+                inputs=[cancer_introns_file_prelim],
+                outputs=[cancer_introns_file],
+            )
+        ]
+    )
 
     pipeliner.run()
 
@@ -228,46 +238,279 @@ def main():
     
     
     if VIS_flag:
-
-        # generate the intron/junctions bed needed by igv
-        igv_introns_bed_file = introns_output_file + ".for_IGV.bed"
-        cmd = str(
-            os.path.join(utildir, "make_igv_splice_bed.py")
-            + " --all_introns {} ".format(introns_output_file)
-            + " --cancer_introns {} ".format(cancer_introns_file)
-            + " --genome_lib_dir {} ".format(ctat_genome_lib)
-            + " --output_bed {} ".format(igv_introns_bed_file)
-        )
-
-        pipeliner.add_commands([Command(cmd, "intron_igv_bed.ok")])
-        pipeliner.run()
-
-        igv_tracks_config_file = write_igv_config(
+        make_igv_report(
             output_prefix,
             ctat_genome_lib,
-            igv_introns_bed_file,
+            introns_output_file,
+            cancer_introns_file,
             bam_file,
-            os.path.join(utildir, "misc/igv.tracks.json"),
+            vis_sample_name,
             pipeliner,
         )
 
-        # Create the IGV Reports
-        cmd = str(
-            "create_report {} ".format(igv_introns_bed_file)
-            + " {} ".format(os.path.join(ctat_genome_lib, "ref_genome.fa"))
-            + " --type junction "
-            + " --output {}.ctat-splicing.igv.html ".format(output_prefix)
-            + " --track-config {} ".format(igv_tracks_config_file)
-            + " --info-columns gene variant_name uniquely_mapped multi_mapped TCGA GTEx "
-            + " --title 'CTAT_Splicing: {}' ".format(vis_sample_name)
+    logger.info("done.")
+
+    sys.exit(0)
+
+
+def parse_batch_manifest(batch_manifest):
+
+    samples = list()
+    seen = set()
+
+    with open(batch_manifest) as fh:
+        for line in fh:
+            if line[0] == "#":
+                continue
+            line = line.rstrip()
+            if line == "":
+                continue
+
+            vals = line.split("\t")
+            if len(vals) < 2 or len(vals) > 4:
+                raise RuntimeError(
+                    "Error, cannot parse batch manifest line: {}".format(line)
+                )
+
+            # optional columns may be left empty or set to NA
+            vals = [None if val in ("", "NA", ".") else val for val in vals]
+            vals += [None] * (4 - len(vals))
+            (sample_name, SJ_tab_file, chimJ_file, bam_file) = vals
+
+            if sample_name is None or SJ_tab_file is None:
+                raise RuntimeError(
+                    "Error, batch manifest line lacks sample name or SJ.out.tab file: {}".format(line)
+                )
+
+            if sample_name in seen:
+                raise RuntimeError(
+                    "Error, sample name {} occurs multiple times in the batch manifest".format(sample_name)
+                )
+            seen.add(sample_name)
+
+            for filename in (SJ_tab_file, chimJ_file, bam_file):
+                if filename is not None and not os.path.exists(filename):
+                    raise RuntimeError(
+                        "Error, cannot locate file {} for sample {}".format(filename, sample_name)
+                    )
+
+            samples.append((sample_name, SJ_tab_file, chimJ_file, bam_file))
+
+    return samples
+
+
+def run_batch(batch_manifest, ctat_genome_lib, output_prefix, min_total_reads, VIS_flag):
+
+    samples = parse_batch_manifest(batch_manifest)
+
+    if VIS_flag:
+        for (sample_name, SJ_tab_file, chimJ_file, bam_file) in samples:
+            if bam_file is None:
+                raise RuntimeError(
+                    "Error, if --vis, must specify a bam file for each sample. Missing for: {}".format(sample_name)
+                )
+
+    # genome lib resources are loaded just once and shared by all samples
+    batch_pipeliner = Pipeliner(output_prefix + ".chckpts")
+    with batch_pipeliner.track_stage("load_genome_lib_resources"):
+        targets_list_file = os.path.join(ctat_genome_lib, "ref_annot.gtf.mini.sortu")
+        chr_intron_bounds = ioc.populate_intron_bounds(targets_list_file)
+
+        annotator = CancerIntronAnnotator(ctat_genome_lib)
+
+    splicing_db = os.path.join(ctat_genome_lib, "cancer_splicing_lib/cancer_splicing.idx")
+
+    num_samples = len(samples)
+    for counter, (sample_name, SJ_tab_file, chimJ_file, bam_file) in enumerate(samples, 1):
+
+        logger.info("-[{}/{}] processing sample: {}".format(counter, num_samples, sample_name))
+
+        sample_output_prefix = "{}.{}".format(output_prefix, sample_name)
+
+        chckpts_dir = sample_output_prefix + ".chckpts"
+        pipeliner = Pipeliner(chckpts_dir)
+
+        introns_output_file = sample_output_prefix + ".introns"
+        introns_output_file_chckpt = os.path.join(chckpts_dir, "introns.ok")
+        introns_fingerprint = get_introns_fingerprint(SJ_tab_file, chimJ_file, targets_list_file)
+        if not step_is_current(introns_output_file_chckpt, introns_fingerprint, introns_output_file):
+            with pipeliner.track_stage("introns"):
+                write_introns_file(
+                    SJ_tab_file, chimJ_file, chr_intron_bounds, sample_output_prefix, introns_output_file
+                )
+            write_checkpoint(introns_output_file_chckpt, introns_fingerprint)
+
+        # annotate for cancer introns.
+        cancer_introns_file_prelim = sample_output_prefix + ".cancer.introns.prelim"
+        cancer_introns_file_prelim_chckpt = os.path.join(chckpts_dir, "prelim_introns.ok")
+        prelim_fingerprint = get_checkpoint_fingerprint(
+            "annotate_cancer_introns", [introns_output_file, splicing_db]
+        )
+        if not step_is_current(cancer_introns_file_prelim_chckpt, prelim_fingerprint, cancer_introns_file_prelim):
+            with pipeliner.track_stage("prelim_introns"), open(cancer_introns_file_prelim, "wt") as ofh:
+                annotator.annotate_introns_file(introns_output_file, ofh)
+            write_checkpoint(cancer_introns_file_prelim_chckpt, prelim_fingerprint)
+
+        # filter for min support
+        cancer_introns_file = sample_output_prefix + ".cancer.introns"
+        cancer_introns_file_chckpt = os.path.join(chckpts_dir, "introns_filtered.ok")
+        filtered_fingerprint = get_checkpoint_fingerprint(
+            "filter_by_min_total_reads --min_total_reads {}".format(min_total_reads),
+            [cancer_introns_file_prelim],
         )
+        if not step_is_current(cancer_introns_file_chckpt, filtered_fingerprint, cancer_introns_file):
+            with pipeliner.track_stage("introns_filtered"), open(cancer_introns_file, "wt") as ofh:
+                filter_by_min_total_reads.filter_cancer_introns(
+                    cancer_introns_file_prelim, min_total_reads, ofh
+                )
+            write_checkpoint(cancer_introns_file_chckpt, filtered_fingerprint)
+
+        num_cancer_introns = len(pd.read_csv(cancer_introns_file, sep="\t"))
+        logger.info(f"-{sample_name}: found {num_cancer_introns} cancer introns")
+
+        if VIS_flag and num_cancer_introns > 0:
+            make_igv_report(
+                sample_output_prefix,
+                ctat_genome_lib,
+                introns_output_file,
+                cancer_introns_file,
+                bam_file,
+                sample_name,
+                pipeliner,
+            )
 
-        pipeliner.add_commands([Command(cmd, "igv_create_html.ok")])
-        pipeliner.run()
+    return
 
-    logger.info("done.")
 
-    sys.exit(0)
+def get_introns_fingerprint(SJ_tab_file, chimJ_file, targets_list_file):
+
+    input_files = [SJ_tab_file, targets_list_file]
+    if chimJ_file:
+        input_files.append(chimJ_file)
+
+    return get_checkpoint_fingerprint("introns", input_files)
+
+
+def step_is_current(checkpoint_file, fingerprint, output_file):
+    # in-process steps: rerun if the inputs changed or the output went missing
+    return checkpoint_is_current(checkpoint_file, fingerprint) and os.path.exists(output_file)
+
+
+def write_introns_file(
+    SJ_tab_file, chimJ_file, chr_intron_bounds, output_prefix, introns_output_file
+):
+
+    introns_dict = ioc.map_introns_from_splice_tab(SJ_tab_file, chr_intron_bounds)
+
+    if chimJ_file is not None:
+        if not os.path.exists(chimJ_file):
+            raise RuntimeError(
+                "Error, cannot locate expected chimeric Junctiom out file: {} ".format(
+                    chimJ_file
+                )
+            )
+
+        # chimeric alignments are streamed straight into the introns
+        chimJ_intron_counts = map_chimeric_reads_to_introns(chimJ_file)
+
+        introns_dict = ioc.supplement_introns_from_chimeric_junctions(
+            chimJ_intron_counts, introns_dict, chr_intron_bounds
+        )
+
+    with open(introns_output_file, "wt") as ofh:
+        # write header
+        ofh.write(
+            "\t".join(["intron", "strand", "genes", "uniq_mapped", "multi_mapped"])
+            + "\n"
+        )
+
+        for intron in introns_dict.values():
+            ofh.write(
+                "\t".join(
+                    [
+                        "{}:{}-{}".format(
+                            intron.chromosome, intron.lend, intron.rend
+                        ),
+                        intron.strand,
+                        intron.genes,
+                        str(intron.uniq_mapped),
+                        str(intron.multi_mapped),
+                    ]
+                )
+                + "\n"
+            )
+
+    return
+
+
+def make_igv_report(
+    output_prefix,
+    ctat_genome_lib,
+    introns_output_file,
+    cancer_introns_file,
+    bam_file,
+    vis_sample_name,
+    pipeliner,
+):
+
+    # generate the intron/junctions bed needed by igv
+    igv_introns_bed_file = introns_output_file + ".for_IGV.bed"
+
+    pipeliner.add_commands(
+        [
+            PyCommand(
+                make_igv_splice_bed,
+                [introns_output_file, cancer_introns_file, ctat_genome_lib, igv_introns_bed_file],
+                "intron_igv_bed.ok",
+                inputs=[
+                    introns_output_file,
+                    cancer_introns_file,
+                    os.path.join(ctat_genome_lib, "ref_annot.gtf.gene_spans"),
+                ],
+                outputs=[igv_introns_bed_file],
+            )
+        ]
+    )
+    pipeliner.run()
+
+    (igv_tracks_config_file, igv_track_files) = write_igv_config(
+        output_prefix,
+        ctat_genome_lib,
+        igv_introns_bed_file,
+        bam_file,
+        os.path.join(utildir, "misc/igv.tracks.json"),
+        pipeliner,
+    )
+
+    # Create the IGV Reports
+    ref_genome_fa = os.path.join(ctat_genome_lib, "ref_genome.fa")
+    igv_html_file = "{}.ctat-splicing.igv.html".format(output_prefix)
+
+    cmd = str(
+        "create_report {} ".format(igv_introns_bed_file)
+        + " {} ".format(ref_genome_fa)
+        + " --type junction "
+        + " --output {} ".format(igv_html_file)
+        + " --track-config {} ".format(igv_tracks_config_file)
+        + " --info-columns gene variant_name uniquely_mapped multi_mapped TCGA GTEx "
+        + " --title 'CTAT_Splicing: {}' ".format(vis_sample_name)
+    )
+
+    # the report embeds the bed, genome and track files, so it's rebuilt whenever any of them change.
+    pipeliner.add_commands(
+        [
+            Command(
+                cmd,
+                "igv_create_html.ok",
+                inputs=[igv_introns_bed_file, ref_genome_fa, igv_tracks_config_file]
+                + igv_track_files,
+                outputs=[igv_html_file],
+            )
+        ]
+    )
+    pipeliner.run()
+
+    return
 
 
 def write_igv_config(
@@ -308,10 +551,25 @@ def write_igv_config(
 
     igv_track_config_file = os.path.join(output_prefix + ".igv.tracks")
 
-    with open(igv_track_config_file, "wt") as ofh:
-        ofh.write(json_template_text)
+    # only rewritten when changed, since the report step is fingerprinted on it.
+    prev_json_text = None
+    if os.path.exists(igv_track_config_file):
+        with open(igv_track_config_file, "rt") as fh:
+            prev_json_text = fh.read()
+
+    if prev_json_text != json_template_text:
+        with open(igv_track_config_file, "wt") as ofh:
+            ofh.write(json_template_text)
+
+    igv_track_files = [
+        ref_annotations_file,
+        gene_reads_bam_file,
+        gene_reads_bam_file + ".bai",
+        cancer_intron_reads_bam_file,
+        cancer_intron_reads_bam_file + ".bai",
+    ]
 
-    return igv_track_config_file
+    return (igv_track_config_file, igv_track_files)
 
 
 def get_gene_and_cancer_intron_reads_bam_files(
@@ -327,30 +585,24 @@ def get_gene_and_cancer_intron_reads_bam_files(
         + " --output_prefix {} ".format(output_prefix)
     )
 
-    pipeliner.add_commands([Command(cmd, "reads_alignments_extracted.ok")])
-
-    gene_reads_tmp_bam = output_prefix + ".gene_reads.bam"
-    cancer_intron_reads_tmp_bam = output_prefix + ".cancer_intron_reads.bam"
-
-    cancer_intron_reads_bam = output_prefix + ".cancer_intron_reads.sorted.bam"
-
-    pipeliner.add_commands(
-        [
-            Command(
-                "samtools sort -o {} {}".format(
-                    cancer_intron_reads_bam, cancer_intron_reads_tmp_bam
-                ),
-                "sort_cancer_intron_reads.ok",
-            )
-        ]
-    )
+    # the extractor writes both bams coordinate-sorted and indexed, so the cancer intron reads
+    # need no further steps. The remaining --vis steps (sift, sort, index the gene reads, then the
+    # report) each consume the previous step's output, so they're run serially.
+    gene_reads_bam = output_prefix + ".gene_reads.bam"
+    cancer_intron_reads_bam = output_prefix + ".cancer_intron_reads.bam"
 
-    gene_reads_bam = output_prefix + ".gene_reads.sorted.bam"
     pipeliner.add_commands(
         [
             Command(
-                "samtools sort -o {} {}".format(gene_reads_bam, gene_reads_tmp_bam),
-                "sort_gene_reads.ok",
+                cmd,
+                "reads_alignments_extracted.ok",
+                inputs=[igv_introns_bed_file, bam_file],
+                outputs=[
+                    gene_reads_bam,
+                    gene_reads_bam + ".bai",
+                    cancer_intron_reads_bam,
+                    cancer_intron_reads_bam + ".bai",
+                ],
             )
         ]
     )
@@ -359,9 +611,8 @@ def get_gene_and_cancer_intron_reads_bam_files(
     max_coverage = 50
     gene_reads_bam_sifted = sift_bam(gene_reads_bam, max_coverage, pipeliner)
 
-    ## index final bams
+    ## index final bam
     index_bam(gene_reads_bam_sifted, pipeliner)
-    index_bam(cancer_intron_reads_bam, pipeliner)
 
     return (gene_reads_bam_sifted, cancer_intron_reads_bam)
 
@@ -383,7 +634,14 @@ def sift_bam(bam_file, max_coverage, pipeliner):
     )
 
     pipeliner.add_commands(
-        [Command(cmd, os.path.basename(sifted_bam_tmp_file) + ".ok")]
+        [
+            Command(
+                cmd,
+                os.path.basename(sifted_bam_tmp_file) + ".ok",
+                inputs=[bam_file],
+                outputs=[sifted_bam_tmp_file],
+            )
+        ]
     )
 
     sifted_bam_file, count = re.subn(".bam$", ".sifted.bam", bam_file)
@@ -395,6 +653,8 @@ def sift_bam(bam_file, max_coverage, pipeliner):
             Command(
                 "samtools sort -o {} {}".format(sifted_bam_file, sifted_bam_tmp_file),
                 os.path.basename(sifted_bam_tmp_file) + "sorted.ok",
+                inputs=[sifted_bam_tmp_file],
+                outputs=[sifted_bam_file],
             )
         ]
     )
@@ -409,6 +669,8 @@ def index_bam(bam_file, pipeliner):
             Command(
                 "samtools index {} ".format(bam_file),
                 os.path.basename(bam_file) + ".indexed.ok",
+                inputs=[bam_file],
+                outputs=[bam_file + ".bai"],
             )
         ]
     )
@@ -13,6 +13,11 @@ logging.basicConfig(stream=sys.stderr, format=FORMAT, level=logging.INFO)
 
 UTILDIR = os.path.join(os.path.dirname(__file__), "util")
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../util"))
+from splice_site_index import load_splice_site_index
+from cancer_intron_store import compile_cancer_intron_store
+from gene_spans_index import load_gene_spans_index
+
 
 
 def main():
@@ -34,6 +39,12 @@ def main():
 
     index_cancer_db(cancer_introns_tsv_file, genome_lib_dir)
 
+    build_cancer_intron_store(genome_lib_dir)
+
+    build_splice_site_index(genome_lib_dir)
+
+    build_gene_spans_index(genome_lib_dir)
+
     logger.info("done")
 
     sys.exit(0)
@@ -55,6 +66,40 @@ def index_cancer_db(cancer_introns_tsv_file, genome_lib_dir):
 
 
 
+def build_cancer_intron_store(genome_lib_dir):
+
+    logger.info("compiling memory-mapped cancer intron annotation store")
+
+    # written alongside cancer_splicing.idx; runs only use it while it's current with the index
+    compile_cancer_intron_store(genome_lib_dir)
+
+    return
+
+
+
+
+def build_splice_site_index(genome_lib_dir):
+
+    logger.info("compiling splice site index")
+
+    # written alongside the targets list, so it's available to runs against a read-only genome lib
+    targets_list_file = os.path.join(genome_lib_dir, "ref_annot.gtf.mini.sortu")
+    load_splice_site_index(targets_list_file)
+
+    return
+
+
+
+def build_gene_spans_index(genome_lib_dir):
+
+    logger.info("compiling gene spans index")
+
+    load_gene_spans_index(os.path.join(genome_lib_dir, "ref_annot.gtf.gene_spans"))
+
+    return
+
+
+
 def ensure_sorted_gene_bed(genome_lib_dir):
 
 
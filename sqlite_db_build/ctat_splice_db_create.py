@@ -24,6 +24,9 @@ def main():
 
     parser.add_argument("--index", dest='index', type=str, required=False, nargs='+', help="tables to index")
 
+    parser.add_argument("--schema_version", dest='schema_version', type=int, required=False, default=1, choices=[1, 2],
+                        help="database schema version for --create: 1 = text-keyed tables, 2 = integer-keyed tables with views under the version 1 table names")
+
     args = parser.parse_args()
 
     sqlite3_dbname = args.sqlite3_db
@@ -40,124 +43,413 @@ def main():
 
 
     conn = sqlite3.connect(sqlite3_dbname)
-    c = conn.cursor()
 
 
     if args.create:
 
         logger.info("-creating database: {}".format(sqlite3_dbname))
-                
-        c.execute("CREATE TABLE samples " +
-                  " (sample_name TEXT, " +
-                  "  db_class TEXT, " +
-                  "  sample_type TEXT, " +
-                  "  total_uniq_count INT, " +
-                  "  total_multi_count INT, " +
-                  "  total_count INT, " +
-                  "  TN char)")
+        create_tables(conn, args.schema_version)
 
-        
-        c.execute("CREATE TABLE intron_feature " +
-                  " (intron TEXT, " +
-                  "  chromosome TEXT, " +
-                  "  start INT, " +
-                  "  end INT, " +
-                  "  strand INT, " +
-                  "  intron_motif INT, " +
-                  "  annot_status INT, " +
-                  "  genes TEXT)")
-        
-        c.execute("CREATE TABLE intron_occurrence " +
-                  " (intron TEXT, " +
-                  "  sample TEXT, " +
-                  "  unique_mappings INT, " +
-                  "  multi_mappings INT, " +
-                  "  all_mappings INT, " +
-                  "  max_spliced_align_overhang INT)")
-
-        c.execute("CREATE TABLE intron_sample_type_counts " +
-                  " (intron TEXT, " +
-                  "  db_class TEXT, " +
-                  "  sample_type TEXT, " +
-                  "  uniq_map_sample_count INT, " +
-                  "  uniq_map_sample_pct REAL, " +
-                  "  all_map_sample_count INT, " +
-                  "  all_map_sample_pct REAL)")
+
+    ## table indexing
+    if args.index:
+
+        for tablename in args.index:
+            index_table(conn, tablename)
+
+
+    logger.info("-done")
+    
+    sys.exit(0)
+
+
+
+def get_schema_version(conn : sqlite3.Connection) -> int:
+    """ schema version of the database (version 1 databases predate the user_version setting) """
+
+    schema_version = conn.execute("PRAGMA user_version").fetchone()[0]
+
+    return schema_version if schema_version else 1
+
+
+
+def create_tables(conn : sqlite3.Connection, schema_version : int = 1) -> None:
+
+    if schema_version == 2:
+        create_tables_v2(conn)
+        return
+    
+    c = conn.cursor()
+    
+    c.execute("CREATE TABLE samples " +
+              " (sample_name TEXT, " +
+              "  db_class TEXT, " +
+              "  sample_type TEXT, " +
+              "  total_uniq_count INT, " +
+              "  total_multi_count INT, " +
+              "  total_count INT, " +
+              "  TN char)")
+
+
+    c.execute("CREATE TABLE intron_feature " +
+              " (intron TEXT, " +
+              "  chromosome TEXT, " +
+              "  start INT, " +
+              "  end INT, " +
+              "  strand INT, " +
+              "  intron_motif INT, " +
+              "  annot_status INT, " +
+              "  genes TEXT)")
+
+    c.execute("CREATE TABLE intron_occurrence " +
+              " (intron TEXT, " +
+              "  sample TEXT, " +
+              "  unique_mappings INT, " +
+              "  multi_mappings INT, " +
+              "  all_mappings INT, " +
+              "  max_spliced_align_overhang INT)")
+
+    c.execute("CREATE TABLE intron_sample_type_counts " +
+              " (intron TEXT, " +
+              "  db_class TEXT, " +
+              "  sample_type TEXT, " +
+              "  uniq_map_sample_count INT, " +
+              "  uniq_map_sample_pct REAL, " +
+              "  all_map_sample_count INT, " +
+              "  all_map_sample_pct REAL)")
+
+
+    c.execute("CREATE TABLE tumor_vs_normal " +
+              " (intron TEXT, " +
+              "  tumor_sample_type TEXT, " +
+              "  normal_sample_type TEXT, " +
+              "  tumor_yes INT, " +
+              "  tumor_no INT, " +
+              "  normal_yes INT, " +
+              "  normal_no INT, "
+              "  enrichment REAL, " +
+              "  odds_ratio REAL, " +
+              "  pvalue REAL)")
+
+
+    conn.commit()
+
+    return
+
+
+
+def index_table(conn : sqlite3.Connection, tablename : str) -> None:
+
+    if get_schema_version(conn) == 2:
+        index_table_v2(conn, tablename)
+        return
     
+    c = conn.cursor()
 
-        c.execute("CREATE TABLE tumor_vs_normal " +
-                  " (intron TEXT, " +
-                  "  tumor_sample_type TEXT, " +
-                  "  normal_sample_type TEXT, " +
-                  "  tumor_yes INT, " +
-                  "  tumor_no INT, " +
-                  "  normal_yes INT, " +
-                  "  normal_no INT, "
-                  "  enrichment REAL, " +
-                  "  odds_ratio REAL, " +
-                  "  pvalue REAL)")
+    if tablename == 'samples':
 
+        logger.info("-indexing table: samples")
 
+        c.execute("CREATE UNIQUE INDEX samples_table_idx_sample_name ON samples(sample_name)")
         conn.commit()
 
-        ## done database creation
+    if tablename == 'intron_feature':
 
+        logger.info("-indexing table: intron_feature")
 
-    ## table indexing
-    if args.index:
+        c.execute("CREATE UNIQUE INDEX intron_feature_idx_intron ON intron_feature (intron)")
+        conn.commit()
 
-        for tablename in args.index:
+    if tablename == 'intron_occurrence':
+
+        logger.info("-indexing table: intron_occurrence")
 
-            if tablename == 'samples':
+        c.execute("CREATE UNIQUE INDEX intron_occurrence_idx_intron_sample ON intron_occurrence(intron, sample)")
 
-                logger.info("-indexing table: samples")
-                
-                c.execute("CREATE UNIQUE INDEX samples_table_idx_sample_name ON samples(sample_name)")
-                conn.commit()
+        c.execute("CREATE INDEX intron_occurrence_idx_intron ON intron_occurrence(intron)")
+        conn.commit()
 
-            if tablename == 'intron_feature':
+    if tablename == 'intron_sample_type_counts':
 
-                logger.info("-indexing table: intron_feature")
+        logger.info("-indexing table: intron_sample_type_counts")
 
-                c.execute("CREATE UNIQUE INDEX intron_feature_idx_intron ON intron_feature (intron)")
-                conn.commit()
+        c.execute("CREATE UNIQUE INDEX intron_sample_type_counts_idx_key ON intron_sample_type_counts(intron, db_class, sample_type)")
 
-            if tablename == 'intron_occurrence':
+        c.execute("CREATE INDEX intron_sample_type_counts_idx_db_class_sample_type ON intron_sample_type_counts(db_class, sample_type)")
 
-                logger.info("-indexing table: intron_occurrence")
+        c.execute("CREATE INDEX intron_sample_type_counts_idx_intron ON intron_sample_type_counts(intron)")
 
-                c.execute("CREATE UNIQUE INDEX intron_occurrence_idx_intron_sample ON intron_occurrence(intron, sample)")
+        conn.commit()
 
-                c.execute("CREATE INDEX intron_occurrence_idx_intron ON intron_occurrence(intron)")
 
+    if tablename == "tumor_vs_normal":
 
-            if tablename == 'intron_sample_type_counts':
+        logger.info("-indexing table: tumor_vs_normal")
 
-                logger.info("-indexing table: intron_sample_type_counts")
+        c.execute("CREATE UNIQUE INDEX tumor_vs_normal_idx_intron_tumor_normal ON tumor_vs_normal (intron, tumor_sample_type, normal_sample_type)")
 
-                c.execute("CREATE UNIQUE INDEX intron_sample_type_counts_idx_key ON intron_sample_type_counts(intron, db_class, sample_type)")
-                
-                c.execute("CREATE INDEX intron_sample_type_counts_idx_db_class_sample_type ON intron_sample_type_counts(db_class, sample_type)")
-                
-                c.execute("CREATE INDEX intron_sample_type_counts_idx_intron ON intron_sample_type_counts(intron)")
-                    
-                conn.commit()
+        c.execute("CREATE INDEX tumor_vs_normal_idx_intron ON tumor_vs_normal(intron)")
 
-            
-            if tablename == "tumor_vs_normal":
+        conn.commit()
 
-                logger.info("-indexing table: tumor_vs_normal")
-                
-                c.execute("CREATE UNIQUE INDEX tumor_vs_normal_idx_intron_tumor_normal ON tumor_vs_normal (intron, tumor_sample_type, normal_sample_type)")
-                
-                c.execute("CREATE INDEX tumor_vs_normal_idx_intron ON tumor_vs_normal(intron)")
+    return
 
-                conn.commit()
 
 
-    logger.info("-done")
+def create_tables_v2(conn : sqlite3.Connection) -> None:
+    """
+    Schema version 2: introns, samples and sample types are stored once and referenced by
+    integer id, with the occurrence and count tables keyed on those ids (WITHOUT ROWID).
+    Views named as the version 1 tables present the same columns, and their INSTEAD OF
+    INSERT triggers resolve (or add) the ids, so existing queries and loaders (sqlite3 .import)
+    work unchanged. The triggers run per row: bulk loads should write the ids to the _v2
+    tables directly instead, as intron_sqlite3_bulk_loader.py does.
+    """
+
+    c = conn.cursor()
+
+    ## ------
+    ## tables
     
-    sys.exit(0)
+    c.execute("CREATE TABLE sample_types " +
+              " (sample_type_id INTEGER PRIMARY KEY, " +
+              "  db_class TEXT, " +
+              "  sample_type TEXT, " +
+              "  UNIQUE (db_class, sample_type))")
+    
+    c.execute("CREATE TABLE samples_v2 " +
+              " (sample_id INTEGER PRIMARY KEY, " +
+              "  sample_name TEXT UNIQUE, " +
+              "  sample_type_id INT, " +
+              "  total_uniq_count INT, " +
+              "  total_multi_count INT, " +
+              "  total_count INT, " +
+              "  TN char)")
+    
+    c.execute("CREATE TABLE intron_feature_v2 " +
+              " (intron_id INTEGER PRIMARY KEY, " +
+              "  intron TEXT UNIQUE, " +
+              "  chromosome TEXT, " +
+              "  start INT, " +
+              "  end INT, " +
+              "  strand INT, " +
+              "  intron_motif INT, " +
+              "  annot_status INT, " +
+              "  genes TEXT)")
+
+    c.execute("CREATE TABLE intron_occurrence_v2 " +
+              " (intron_id INT, " +
+              "  sample_id INT, " +
+              "  unique_mappings INT, " +
+              "  multi_mappings INT, " +
+              "  all_mappings INT, " +
+              "  max_spliced_align_overhang INT, " +
+              "  PRIMARY KEY (intron_id, sample_id)) WITHOUT ROWID")
+
+    c.execute("CREATE TABLE intron_sample_type_counts_v2 " +
+              " (intron_id INT, " +
+              "  sample_type_id INT, " +
+              "  uniq_map_sample_count INT, " +
+              "  uniq_map_sample_pct REAL, " +
+              "  all_map_sample_count INT, " +
+              "  all_map_sample_pct REAL, " +
+              "  PRIMARY KEY (intron_id, sample_type_id)) WITHOUT ROWID")
+
+    # tumor sample types are TCGA sample types and normal ones GTEx sample types ('total' and 'NONE' included)
+    c.execute("CREATE TABLE tumor_vs_normal_v2 " +
+              " (intron_id INT, " +
+              "  tumor_sample_type_id INT, " +
+              "  normal_sample_type_id INT, " +
+              "  tumor_yes INT, " +
+              "  tumor_no INT, " +
+              "  normal_yes INT, " +
+              "  normal_no INT, "
+              "  enrichment REAL, " +
+              "  odds_ratio REAL, " +
+              "  pvalue REAL)")
+
+    ## ----------------------------------
+    ## views under the version 1 names
+
+    c.execute("CREATE VIEW samples AS " +
+              " SELECT s.sample_name AS sample_name, st.db_class AS db_class, st.sample_type AS sample_type, " +
+              "        s.total_uniq_count AS total_uniq_count, s.total_multi_count AS total_multi_count, s.total_count AS total_count, s.TN AS TN " +
+              " FROM samples_v2 AS s, sample_types AS st " +
+              " WHERE s.sample_type_id = st.sample_type_id")
+
+    c.execute("CREATE VIEW intron_feature AS " +
+              " SELECT intron, chromosome, start, end, strand, intron_motif, annot_status, genes " +
+              " FROM intron_feature_v2")
+
+    c.execute("CREATE VIEW intron_occurrence AS " +
+              " SELECT f.intron AS intron, s.sample_name AS sample, " +
+              "        io.unique_mappings AS unique_mappings, io.multi_mappings AS multi_mappings, io.all_mappings AS all_mappings, " +
+              "        io.max_spliced_align_overhang AS max_spliced_align_overhang " +
+              " FROM intron_occurrence_v2 AS io, intron_feature_v2 AS f, samples_v2 AS s " +
+              " WHERE io.intron_id = f.intron_id AND io.sample_id = s.sample_id")
+
+    c.execute("CREATE VIEW intron_sample_type_counts AS " +
+              " SELECT f.intron AS intron, st.db_class AS db_class, st.sample_type AS sample_type, " +
+              "        istc.uniq_map_sample_count AS uniq_map_sample_count, istc.uniq_map_sample_pct AS uniq_map_sample_pct, " +
+              "        istc.all_map_sample_count AS all_map_sample_count, istc.all_map_sample_pct AS all_map_sample_pct " +
+              " FROM intron_sample_type_counts_v2 AS istc, intron_feature_v2 AS f, sample_types AS st " +
+              " WHERE istc.intron_id = f.intron_id AND istc.sample_type_id = st.sample_type_id")
+
+    c.execute("CREATE VIEW tumor_vs_normal AS " +
+              " SELECT f.intron AS intron, tst.sample_type AS tumor_sample_type, nst.sample_type AS normal_sample_type, " +
+              "        tvn.tumor_yes AS tumor_yes, tvn.tumor_no AS tumor_no, tvn.normal_yes AS normal_yes, tvn.normal_no AS normal_no, " +
+              "        tvn.enrichment AS enrichment, tvn.odds_ratio AS odds_ratio, tvn.pvalue AS pvalue " +
+              " FROM tumor_vs_normal_v2 AS tvn, intron_feature_v2 AS f, sample_types AS tst, sample_types AS nst " +
+              " WHERE tvn.intron_id = f.intron_id " +
+              "   AND tvn.tumor_sample_type_id = tst.sample_type_id AND tvn.normal_sample_type_id = nst.sample_type_id")
+
+    ## ---------------------------------------------------------
+    ## inserts via the views (ie. sqlite3 .import, the loaders)
+
+    c.execute("CREATE TRIGGER samples_insert INSTEAD OF INSERT ON samples BEGIN " +
+              " INSERT OR IGNORE INTO sample_types (db_class, sample_type) VALUES (NEW.db_class, NEW.sample_type); " +
+              " INSERT INTO samples_v2 (sample_name, sample_type_id, total_uniq_count, total_multi_count, total_count, TN) " +
+              "   VALUES (NEW.sample_name, " +
+              "           (SELECT sample_type_id FROM sample_types WHERE db_class = NEW.db_class AND sample_type = NEW.sample_type), " +
+              "           NEW.total_uniq_count, NEW.total_multi_count, NEW.total_count, NEW.TN) " +
+              "   ON CONFLICT (sample_name) DO UPDATE SET sample_type_id = excluded.sample_type_id, " +
+              "     total_uniq_count = excluded.total_uniq_count, total_multi_count = excluded.total_multi_count, " +
+              "     total_count = excluded.total_count, TN = excluded.TN; " +
+              "END")
+
+    c.execute("CREATE TRIGGER intron_feature_insert INSTEAD OF INSERT ON intron_feature BEGIN " +
+              " INSERT INTO intron_feature_v2 (intron, chromosome, start, end, strand, intron_motif, annot_status, genes) " +
+              "   VALUES (NEW.intron, NEW.chromosome, NEW.start, NEW.end, NEW.strand, NEW.intron_motif, NEW.annot_status, NEW.genes) " +
+              "   ON CONFLICT (intron) DO UPDATE SET chromosome = excluded.chromosome, start = excluded.start, end = excluded.end, " +
+              "     strand = excluded.strand, intron_motif = excluded.intron_motif, annot_status = excluded.annot_status, genes = excluded.genes; " +
+              "END")
+
+    # ids for samples or introns not yet loaded are reserved here, and filled in when they are.
+    c.execute("CREATE TRIGGER intron_occurrence_insert INSTEAD OF INSERT ON intron_occurrence BEGIN " +
+              " INSERT OR IGNORE INTO intron_feature_v2 (intron) VALUES (NEW.intron); " +
+              " INSERT OR IGNORE INTO samples_v2 (sample_name) VALUES (NEW.sample); " +
+              " INSERT INTO intron_occurrence_v2 VALUES ( " +
+              "   (SELECT intron_id FROM intron_feature_v2 WHERE intron = NEW.intron), " +
+              "   (SELECT sample_id FROM samples_v2 WHERE sample_name = NEW.sample), " +
+              "   NEW.unique_mappings, NEW.multi_mappings, NEW.all_mappings, NEW.max_spliced_align_overhang); " +
+              "END")
+
+    c.execute("CREATE TRIGGER intron_sample_type_counts_insert INSTEAD OF INSERT ON intron_sample_type_counts BEGIN " +
+              " INSERT OR IGNORE INTO intron_feature_v2 (intron) VALUES (NEW.intron); " +
+              " INSERT OR IGNORE INTO sample_types (db_class, sample_type) VALUES (NEW.db_class, NEW.sample_type); " +
+              " INSERT INTO intron_sample_type_counts_v2 VALUES ( " +
+              "   (SELECT intron_id FROM intron_feature_v2 WHERE intron = NEW.intron), " +
+              "   (SELECT sample_type_id FROM sample_types WHERE db_class = NEW.db_class AND sample_type = NEW.sample_type), " +
+              "   NEW.uniq_map_sample_count, NEW.uniq_map_sample_pct, NEW.all_map_sample_count, NEW.all_map_sample_pct); " +
+              "END")
+
+    c.execute("CREATE TRIGGER tumor_vs_normal_insert INSTEAD OF INSERT ON tumor_vs_normal BEGIN " +
+              " INSERT OR IGNORE INTO intron_feature_v2 (intron) VALUES (NEW.intron); " +
+              " INSERT OR IGNORE INTO sample_types (db_class, sample_type) VALUES ('TCGA', NEW.tumor_sample_type); " +
+              " INSERT OR IGNORE INTO sample_types (db_class, sample_type) VALUES ('GTEx', NEW.normal_sample_type); " +
+              " INSERT INTO tumor_vs_normal_v2 VALUES ( " +
+              "   (SELECT intron_id FROM intron_feature_v2 WHERE intron = NEW.intron), " +
+              "   (SELECT sample_type_id FROM sample_types WHERE db_class = 'TCGA' AND sample_type = NEW.tumor_sample_type), " +
+              "   (SELECT sample_type_id FROM sample_types WHERE db_class = 'GTEx' AND sample_type = NEW.normal_sample_type), " +
+              "   NEW.tumor_yes, NEW.tumor_no, NEW.normal_yes, NEW.normal_no, " +
+              "   NEW.enrichment, NEW.odds_ratio, NEW.pvalue); " +
+              "END")
+
+    c.execute("PRAGMA user_version = 2")
+
+    conn.commit()
+
+    return
+
+
+
+def index_table_v2(conn : sqlite3.Connection, tablename : str) -> None:
+
+    # lookups by intron and by (intron, sample) are served by the integer keys of the version 2 tables,
+    # so only the secondary indexes remain.
+
+    c = conn.cursor()
+
+    if tablename in ('samples', 'intron_feature', 'intron_occurrence'):
+
+        logger.info("-table {} is indexed by its keys in schema version 2".format(tablename))
+
+    if tablename == 'intron_sample_type_counts':
+
+        logger.info("-indexing table: intron_sample_type_counts_v2")
+
+        c.execute("CREATE INDEX intron_sample_type_counts_v2_idx_sample_type ON intron_sample_type_counts_v2(sample_type_id)")
+        conn.commit()
+
+    if tablename == "tumor_vs_normal":
+
+        logger.info("-indexing table: tumor_vs_normal_v2")
+        
+        c.execute("CREATE UNIQUE INDEX tumor_vs_normal_v2_idx_intron_tumor_normal ON tumor_vs_normal_v2 (intron_id, tumor_sample_type_id, normal_sample_type_id)")
+        conn.commit()
+
+    return
+
+
+
+def get_table_row_inserter(conn : sqlite3.Connection, tablename : str) -> tuple:
+    """
+    For bulk loading rows having the (version 1) columns of intron_sample_type_counts or tumor_vs_normal,
+    returns (insert_query, to_table_row).  On a schema version 2 database, to_table_row resolves the intron
+    and sample type ids (adding any new ones, as the view's trigger would) so the rows are inserted into the
+    _v2 table directly, rather than each through the trigger.  On version 1, rows are inserted as they are.
+    """
+
+    num_columns = len(conn.execute("SELECT * FROM {} LIMIT 0".format(tablename)).description)
+
+    if get_schema_version(conn) != 2:
+        return ("INSERT INTO {} VALUES ({})".format(tablename, ", ".join(["?"] * num_columns)), tuple)
+
+    if tablename == 'intron_sample_type_counts':
+        # (intron, db_class, sample_type, ...) -> (intron_id, sample_type_id, ...)
+        get_sample_type_keys = lambda row: [ (row[1], row[2]) ]
+        num_key_columns = 3
+    elif tablename == 'tumor_vs_normal':
+        # (intron, tumor_sample_type, normal_sample_type, ...) -> (intron_id, tumor_sample_type_id, normal_sample_type_id, ...)
+        get_sample_type_keys = lambda row: [ ('TCGA', row[1]), ('GTEx', row[2]) ]
+        num_key_columns = 3
+    else:
+        raise RuntimeError("Error, no bulk insert into table {} of a schema version 2 database".format(tablename))
+
+    c = conn.cursor()
+
+    sample_type_to_id = { (db_class, sample_type) : sample_type_id
+                          for (sample_type_id, db_class, sample_type) in c.execute("SELECT sample_type_id, db_class, sample_type FROM sample_types") }
+
+    def get_sample_type_id(sample_type_key):
+        sample_type_id = sample_type_to_id.get(sample_type_key)
+        if sample_type_id is None:
+            c.execute("INSERT INTO sample_types (db_class, sample_type) VALUES (?, ?)", sample_type_key)
+            sample_type_id = sample_type_to_id[sample_type_key] = c.lastrowid
+        return sample_type_id
+
+    # rows come grouped by intron, so its id is looked up once per intron rather than held for all introns.
+    last_intron = [None, None]
+
+    def get_intron_id(intron):
+        if intron != last_intron[0]:
+            row = c.execute("SELECT intron_id FROM intron_feature_v2 WHERE intron = ?", (intron,)).fetchone()
+            if row is None:
+                c.execute("INSERT INTO intron_feature_v2 (intron) VALUES (?)", (intron,))
+                intron_id = c.lastrowid
+            else:
+                intron_id = row[0]
+            last_intron[:] = [intron, intron_id]
+        return last_intron[1]
+
+    def to_table_row(row):
+        return tuple([ get_intron_id(row[0]) ]
+                     + [ get_sample_type_id(sample_type_key) for sample_type_key in get_sample_type_keys(row) ]
+                     + list(row[num_key_columns:]))
+
+    num_columns = len(c.execute("SELECT * FROM {}_v2 LIMIT 0".format(tablename)).description)
+
+    return ("INSERT INTO {}_v2 VALUES ({})".format(tablename, ", ".join(["?"] * num_columns)), to_table_row)
 
 
 
@@ -10,6 +10,7 @@ import argparse
 import time
 import scipy.stats as stats
 import statistics
+import numpy as np
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -23,6 +24,8 @@ def main():
     parser.add_argument("--intron_features_file", dest="intron_features_file", type=str, required=True, help="file containing list of intron features")
     parser.add_argument("--output_file", dest="output_file", type=str, required=True, help="output filename")
     parser.add_argument("--pseudocount", dest="pseudocount", type=float, required=False, default=0.1, help="pseudocount used in ratio computations: (A + pseudo)/(B + pseudo)") 
+    parser.add_argument("--bulk", dest="bulk", action='store_true', default=False, help="evaluate the intron features in chunks, one query and vectorized tests per chunk, instead of one query per intron")
+    parser.add_argument("--chunk_size", dest="chunk_size", type=int, required=False, default=100000, help="number of intron features per chunk in --bulk mode")
     
     args = parser.parse_args()
     sqlite3_dbname = args.sqlite3_db
@@ -34,6 +37,44 @@ def main():
     c = conn.cursor()
 
 
+    (sample_type_counts, mean_tcga_count, mean_gtex_count) = get_sample_type_counts(c)
+
+    ofh = open(output_filename, 'wt')
+
+    if args.bulk:
+        with open(intron_features_file) as fh:
+            intron_features = list()
+            for intron_feature in fh:
+                intron_features.append(intron_feature.rstrip())
+                if len(intron_features) >= args.chunk_size:
+                    examine_intron_features_for_enrichment_bulk(intron_features, c, sample_type_counts, ofh, pseudocount, mean_tcga_count, mean_gtex_count)
+                    intron_features = list()
+            if intron_features:
+                examine_intron_features_for_enrichment_bulk(intron_features, c, sample_type_counts, ofh, pseudocount, mean_tcga_count, mean_gtex_count)
+
+        ofh.close()
+        sys.exit(0)
+
+    with open(intron_features_file) as fh:
+        for intron_feature in fh:
+            intron_feature = intron_feature.rstrip()
+            logger.info(intron_feature)
+            start_time = time.time()
+            examine_intron_feature_for_enrichment(intron_feature, c, sample_type_counts, ofh, pseudocount, mean_tcga_count, mean_gtex_count)
+            end_time = time.time()
+            seconds = int(end_time - start_time)
+            logger.info("-took {} seconds".format(seconds))
+
+    
+    ofh.close()
+
+    sys.exit(0)
+
+
+
+def get_sample_type_counts(c : sqlite3.Cursor) -> tuple:
+    """ returns (sample_type_counts, mean_tcga_count, mean_gtex_count) for the tumor and GTEx samples """
+
     ## get counts of samples according to tissue type
     query = "select db_class, sample_type, count(*) from samples where db_class = 'GTEx' or (db_class = 'TCGA' and TN = 'T') group by db_class, sample_type"
     c.execute(query)
@@ -56,24 +97,8 @@ def main():
 
     mean_tcga_count = round(statistics.mean(tcga_counts))
     mean_gtex_count = round(statistics.mean(gtex_counts))
-    
 
-    ofh = open(output_filename, 'wt')
-
-    with open(intron_features_file) as fh:
-        for intron_feature in fh:
-            intron_feature = intron_feature.rstrip()
-            logger.info(intron_feature)
-            start_time = time.time()
-            examine_intron_feature_for_enrichment(intron_feature, c, sample_type_counts, ofh, pseudocount, mean_tcga_count, mean_gtex_count)
-            end_time = time.time()
-            seconds = int(end_time - start_time)
-            logger.info("-took {} seconds".format(seconds))
-
-    
-    ofh.close()
-
-    sys.exit(0)
+    return (sample_type_counts, mean_tcga_count, mean_gtex_count)
 
 
 
@@ -207,6 +232,162 @@ def examine_intron_feature_for_enrichment(intron_feature : str,
     
     return
     
+def examine_intron_features_for_enrichment_bulk(intron_features : list,
+                                               c : sqlite3.Cursor,
+                                               sample_type_counts : collections.defaultdict,
+                                               ofh : typing.TextIO,
+                                               pseudocount : float,
+                                               mean_tcga_count : int,
+                                               mean_gtex_count : int) -> None:
+    """
+    Same as examine_intron_feature_for_enrichment(), but for a chunk of intron features at once:
+    all their intron_sample_type_counts rows are pulled in a single query, and the top sample
+    type selection, enrichment ratios and Fisher tests are computed over arrays.
+    """
+
+    logger.info("-examining {} intron features".format(len(intron_features)))
+    start_time = time.time()
+    
+    num_features = len(intron_features)
+
+    c.execute("CREATE TEMP TABLE IF NOT EXISTS chunk_intron_features (feature_idx INTEGER PRIMARY KEY, intron TEXT)")
+    c.execute("DELETE FROM chunk_intron_features")
+    c.executemany("INSERT INTO chunk_intron_features (feature_idx, intron) VALUES (?, ?)", enumerate(intron_features))
+
+    # rows ordered as the per-intron query returns them, so ties in the top sample type resolve the same way.
+    if c.execute("PRAGMA user_version").fetchone()[0] == 2:
+        # integer-keyed schema: intron_sample_type_counts is a view, read the keyed table directly.
+        query = str("select f.feature_idx, st.db_class, st.sample_type, istc.all_map_sample_count, istc.all_map_sample_pct " +
+                    " from chunk_intron_features as f, intron_feature_v2 as ifv, intron_sample_type_counts_v2 as istc, sample_types as st " +
+                    " where f.intron = ifv.intron and ifv.intron_id = istc.intron_id and istc.sample_type_id = st.sample_type_id " +
+                    " order by f.feature_idx, istc.sample_type_id ")
+    else:
+        query = str("select f.feature_idx, istc.db_class, istc.sample_type, istc.all_map_sample_count, istc.all_map_sample_pct " +
+                    " from chunk_intron_features as f, intron_sample_type_counts as istc " +
+                    " where f.intron = istc.intron " +
+                    " order by f.feature_idx, istc.rowid ")
+
+    c.execute(query)
+    rows = c.fetchall()
+
+    if rows:
+        (feature_idx, db_class, sample_type, all_count, all_pct) = [np.array(x) for x in zip(*rows)]
+        feature_idx = feature_idx.astype(np.int64)
+        all_count = all_count.astype(np.int64)
+        all_pct = all_pct.astype(float)
+    else:
+        (feature_idx, db_class, sample_type, all_count, all_pct) = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=str), np.zeros(0, dtype=str),
+                                                                   np.zeros(0, dtype=np.int64), np.zeros(0, dtype=float))
+
+    assert(np.isin(db_class, ("TCGA", "GTEx", "NONE")).all())
+
+    is_total = (sample_type == "total")
+
+    def get_total_counts(db_class_name):
+        counts = np.zeros(num_features, dtype=np.int64)
+        mask = is_total & (db_class == db_class_name)
+        counts[feature_idx[mask]] = all_count[mask]
+        return counts
+
+    def get_top_sample_types(db_class_name):
+        # first row having the max pct for each intron feature
+        top_sample_types = np.full(num_features, "NONE", dtype=object)
+        top_counts = np.zeros(num_features, dtype=np.int64)
+        row_idx = np.flatnonzero(~is_total & (db_class == db_class_name))
+        if len(row_idx):
+            row_idx = row_idx[np.lexsort((row_idx, -all_pct[row_idx], feature_idx[row_idx]))]
+            (top_features, first) = np.unique(feature_idx[row_idx], return_index=True)
+            top_rows = row_idx[first]
+            top_sample_types[top_features] = sample_type[top_rows]
+            top_counts[top_features] = all_count[top_rows]
+        return (top_sample_types, top_counts)
+    
+
+    ## examine tumor enrichment stats
+
+    count_tcga_all = sample_type_counts["TCGA^total"]
+    count_gtex_all = sample_type_counts["GTEx^total"]
+
+    tcga_all_counts = get_total_counts("TCGA")
+    gtex_all_counts = get_total_counts("GTEx")
+
+    (tcga_top_sample_types, tcga_top_counts) = get_top_sample_types("TCGA")
+    (gtex_top_sample_types, gtex_top_counts) = get_top_sample_types("GTEx")
+
+    count_tcga_top = np.array([ sample_type_counts.get("TCGA^{}".format(x), 0) or mean_tcga_count for x in tcga_top_sample_types ], dtype=np.int64)
+    count_gtex_top = np.array([ sample_type_counts.get("GTEx^{}".format(x), 0) or mean_gtex_count for x in gtex_top_sample_types ], dtype=np.int64)
+
+    #################
+    ## All comparison
+
+    tcga_all_enrichment = ( (tcga_all_counts + pseudocount) / (count_tcga_all + pseudocount) ) / ( (gtex_all_counts + pseudocount) / (count_gtex_all + pseudocount) )
+
+    (all_oddsratios, all_pvalues) = fisher_exact_greater(tcga_all_counts, count_tcga_all - tcga_all_counts,
+                                                         gtex_all_counts, count_gtex_all - gtex_all_counts)
+    
+    #################
+    ## top comparison
+
+    tcga_top_enrichment = ( (tcga_top_counts + pseudocount) / (count_tcga_top + pseudocount) ) / ( (gtex_top_counts + pseudocount) / (count_gtex_top + pseudocount) )
+
+    (top_oddsratios, top_pvalues) = fisher_exact_greater(tcga_top_counts, count_tcga_top - tcga_top_counts,
+                                                         gtex_top_counts, count_gtex_top - gtex_top_counts)
+
+
+    for i, intron_feature in enumerate(intron_features):
+
+        print("\t".join([intron_feature, "total", "total",
+                         str(tcga_all_counts[i]), str(count_tcga_all - tcga_all_counts[i]),
+                         str(gtex_all_counts[i]), str(count_gtex_all - gtex_all_counts[i]),
+                         "{:.4}".format(tcga_all_enrichment[i]),
+                         "{:.4}".format(all_oddsratios[i]),
+                         "{:.4}".format(all_pvalues[i])]),
+              file=ofh)
+
+        print("\t".join([intron_feature, tcga_top_sample_types[i], gtex_top_sample_types[i],
+                         str(tcga_top_counts[i]), str(count_tcga_top[i] - tcga_top_counts[i]),
+                         str(gtex_top_counts[i]), str(count_gtex_top[i] - gtex_top_counts[i]),
+                         "{:.4}".format(tcga_top_enrichment[i]),
+                         "{:.4}".format(top_oddsratios[i]),
+                         "{:.4}".format(top_pvalues[i])]),
+              file=ofh)
+
+    end_time = time.time()
+    seconds = int(end_time - start_time)
+    logger.info("-took {} seconds".format(seconds))
+
+    return
+
+
+
+def fisher_exact_greater(a, b, c, d) -> tuple:
+    """
+    Vectorized scipy.stats.fisher_exact([[a, b], [c, d]], alternative='greater') over arrays of
+    2x2 tables, returning (odds_ratios, pvalues).
+    """
+
+    (a, b, c, d) = [np.asarray(x, dtype=np.int64) for x in (a, b, c, d)]
+
+    if (a < 0).any() or (b < 0).any() or (c < 0).any() or (d < 0).any():
+        raise ValueError("All values in `table` must be nonnegative.")
+
+    n1 = a + b
+    n2 = c + d
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        oddsratios = np.where((c > 0) & (b > 0), (a * d) / (c * b), np.inf)
+
+    pvalues = np.minimum(stats.hypergeom.cdf(b, n1 + n2, n1, b + d), 1.0)
+
+    # if both values in a row or column are zero, the p-value is 1 and the odds ratio is NaN
+    empty_margin = (n1 == 0) | (n2 == 0) | (a + c == 0) | (b + d == 0)
+    oddsratios[empty_margin] = np.nan
+    pvalues[empty_margin] = 1.0
+    
+    return (oddsratios, pvalues)
+
+
+
 if __name__ == '__main__':
     main()
 
@@ -9,6 +9,9 @@ from collections import defaultdict
 import argparse
 import time
 
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from ctat_splice_db_create import get_table_row_inserter
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -18,31 +21,33 @@ def main():
     parser = argparse.ArgumentParser(description="examines intron feature usage stats and computes the normalized abundance", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
     parser.add_argument("--sqlite3_db", dest="sqlite3_db", type=str, required=True, help="sqlite3_db name")
-    parser.add_argument("--intron_features_file", dest="intron_features_file", type=str, required=True, help="file containing list of intron features")
-    parser.add_argument("--output_file", dest="output_file", type=str, required=True, help="output filename")
+    parser.add_argument("--intron_features_file", dest="intron_features_file", type=str, required=False, default=None, help="file containing list of intron features")
+    parser.add_argument("--output_file", dest="output_file", type=str, required=False, default=None, help="output filename")
+    parser.add_argument("--all_introns", dest="all_introns", action='store_true', default=False, help="compute the stats for all introns in a single pass over intron_occurrence, instead of per intron feature")
+    parser.add_argument("--load_table", dest="load_table", action='store_true', default=False, help="with --all_introns, insert the stats directly into the intron_sample_type_counts table")
     
     args = parser.parse_args()
     sqlite3_dbname = args.sqlite3_db
     intron_features_file = args.intron_features_file
     output_filename = args.output_file
 
+    if args.all_introns:
+        if not (output_filename or args.load_table):
+            parser.error("--all_introns requires --output_file and/or --load_table")
+    elif not (intron_features_file and output_filename):
+        parser.error("--intron_features_file and --output_file are required unless running with --all_introns")
+
     conn = sqlite3.connect(sqlite3_dbname)
     c = conn.cursor()
 
-    ## get counts of samples according to tissue type
-    query = "select db_class, sample_type, count(*) from samples group by db_class, sample_type"
-    #logger.info(query)
-    c.execute(query)
-    rows = c.fetchall()
-    sample_type_counts = defaultdict(int)
-    for row in rows:
-        (db_class, sample_type, count) = row
-        sample_type = "^".join([db_class, sample_type])
-        sample_type_counts[sample_type] += count
-        base_sample_type = "^".join([db_class, "total"])
-        sample_type_counts[base_sample_type] += count
+    sample_type_counts = get_sample_type_counts(c)
 
 
+    if args.all_introns:
+        evaluate_all_intron_usage_stats(conn, sample_type_counts, output_filename, args.load_table)
+        sys.exit(0)
+    
+
     ofh = open(output_filename, 'wt')
 
     with open(intron_features_file) as fh:
@@ -64,13 +69,33 @@ def main():
 
 
 
+MIN_TOTAL_READ_MAPPINGS = 5 # based on a handful of known cancer introns.
+
+
+def get_sample_type_counts(c : sqlite3.Cursor) -> collections.defaultdict:
+
+    ## get counts of samples according to tissue type
+    query = "select db_class, sample_type, count(*) from samples group by db_class, sample_type"
+    #logger.info(query)
+    c.execute(query)
+    rows = c.fetchall()
+    sample_type_counts = defaultdict(int)
+    for row in rows:
+        (db_class, sample_type, count) = row
+        sample_type = "^".join([db_class, sample_type])
+        sample_type_counts[sample_type] += count
+        base_sample_type = "^".join([db_class, "total"])
+        sample_type_counts[base_sample_type] += count
+
+    return sample_type_counts
+
+
+
 def examine_intron_feature_usage_stats(intron_feature : str,
                                        c : sqlite3.Cursor,
                                        sample_type_counts : collections.defaultdict,
                                        ofh : typing.TextIO):
 
-
-    MIN_TOTAL_READ_MAPPINGS = 5 # based on a handful of known cancer introns.
     
     query = str("select s.sample_name, s.db_class, s.sample_type, s.total_uniq_count, s.total_count, "
                 + " io.intron, io.unique_mappings, io.all_mappings "
@@ -136,6 +161,166 @@ def examine_intron_feature_usage_stats(intron_feature : str,
     ofh.flush()
     
 
+def evaluate_all_intron_usage_stats(conn : sqlite3.Connection,
+                                    sample_type_counts : collections.defaultdict,
+                                    output_filename : str,
+                                    load_table : bool) -> None:
+
+    ofh = open(output_filename, 'wt') if output_filename else None
+
+    insert_cursor = conn.cursor()
+    # (on a schema version 2 database, straight into intron_sample_type_counts_v2 by id, bypassing the view's trigger)
+    (insert_query, to_table_row) = get_table_row_inserter(conn, 'intron_sample_type_counts')
+    
+    INSERT_BATCH_SIZE = 100000
+    batch = list()
+
+    num_introns = 0
+    start_time = time.time()
+    
+    for (intron, intron_stats) in stream_intron_usage_stats(conn.cursor(), sample_type_counts):
+
+        num_introns += 1
+        
+        if ofh:
+            write_intron_usage_stats(ofh, intron, intron_stats)
+
+        if load_table:
+            for (db_class, sample_type, uniq_count, uniq_frac, all_count, all_frac) in intron_stats:
+                # values as a tab-delimited .import of the output file would store them
+                batch.append( to_table_row( (intron, db_class, sample_type,
+                                             uniq_count, float("{:.4f}".format(uniq_frac)),
+                                             all_count, float("{:.4f}".format(all_frac))) ) )
+
+        if len(batch) >= INSERT_BATCH_SIZE:
+            insert_cursor.executemany(insert_query, batch)
+            batch = list()
+
+        if num_introns % 100000 == 0:
+            logger.info("-processed {} introns, {} seconds".format(num_introns, int(time.time() - start_time)))
+
+    if batch:
+        insert_cursor.executemany(insert_query, batch)
+
+    if load_table:
+        conn.commit()
+
+    if ofh:
+        ofh.close()
+
+    logger.info("-done. {} introns in {} seconds".format(num_introns, int(time.time() - start_time)))
+
+    return
+
+
+
+def write_intron_usage_stats(ofh : typing.TextIO, intron : str, intron_stats : list) -> None:
+
+    for (db_class, sample_type, uniq_count, uniq_frac, all_count, all_frac) in intron_stats:
+        print("\t".join([intron, db_class, sample_type,
+                         str(uniq_count), "{:.4f}".format(uniq_frac),
+                         str(all_count), "{:.4f}".format(all_frac)]), file=ofh)
+
+    return
+
+
+
+def stream_intron_usage_stats(c : sqlite3.Cursor,
+                              sample_type_counts : collections.defaultdict,
+                              intron_range : tuple = None):
+    """
+    Yields (intron, [ (db_class, sample_type, uniq_count, uniq_frac, all_count, all_frac), ... ]) for
+    every intron in intron_occurrence, same as examine_intron_feature_usage_stats() reports per intron,
+    from a single pass over intron_occurrence in intron order.  Sample metadata is held in memory,
+    with each sample reduced to the integer ids of its specific and total sample groups.
+
+    intron_range, as (first intron, last intron), restricts the pass to that (inclusive) range of introns.
+    """
+
+    group_names = list()
+    group_to_id = dict()
+    def get_group_id(db_class : str, sample_type : str) -> int:
+        group = (db_class, sample_type)
+        if group not in group_to_id:
+            group_to_id[group] = len(group_names)
+            group_names.append(group)
+        return group_to_id[group]
+
+    sample_to_group_ids = dict()
+    
+    c.execute("select sample_name, db_class, sample_type, TN from samples")
+    for (sample_name, db_class, sample_type, TN) in c.fetchall():
+        # skip the tumor normals for now... analyze separately.
+        # (a null TN excludes TCGA samples too, as in the per-intron query)
+        if db_class == "TCGA" and (TN == "N" or TN is None):
+            continue
+        sample_to_group_ids[sample_name] = (get_group_id(db_class, sample_type), get_group_id(db_class, "total"))
+
+    group_sample_counts = [ sample_type_counts["^".join(group)] for group in group_names ]
+    
+    
+    def get_intron_stats(group_counter : dict) -> list:
+        intron_stats = list()
+        for group_id, (num_uniq, num_all) in group_counter.items():
+            (db_class, sample_type) = group_names[group_id]
+            num_sample_counts = group_sample_counts[group_id]
+            intron_stats.append( (db_class, sample_type,
+                                  num_uniq, num_uniq / num_sample_counts,
+                                  num_all, num_all / num_sample_counts) )
+        return intron_stats
+    
+    
+    query_params = [MIN_TOTAL_READ_MAPPINGS]
+    
+    if c.execute("PRAGMA user_version").fetchone()[0] == 2:
+        # integer-keyed schema: intron_occurrence is a view, read the keyed table directly.
+        query = str("select f.intron, s.sample_name, io.unique_mappings, io.all_mappings "
+                    + " from intron_occurrence_v2 as io, intron_feature_v2 as f, samples_v2 as s "
+                    + " where io.intron_id = f.intron_id and io.sample_id = s.sample_id "
+                    + "       and io.all_mappings >= ? ")
+        if intron_range is not None:
+            query += " and f.intron between ? and ? "
+            query_params += list(intron_range)
+        query += " order by f.intron, io.sample_id "
+    else:
+        query = str("select intron, sample, unique_mappings, all_mappings "
+                    + " from intron_occurrence "
+                    + " where all_mappings >= ? ")
+        if intron_range is not None:
+            query += " and intron between ? and ? "
+            query_params += list(intron_range)
+        query += " order by intron, rowid "
+
+    c.execute(query, query_params)
+
+    prev_intron = None
+    group_counter = dict() # group_id -> [ num uniq, num all ], in order of first occurrence
+    
+    for (intron, sample, intron_unique_mappings, intron_all_mappings) in c:
+
+        if intron != prev_intron:
+            if group_counter:
+                yield (prev_intron, get_intron_stats(group_counter))
+            prev_intron = intron
+            group_counter = dict()
+
+        group_ids = sample_to_group_ids.get(sample, None)
+        if group_ids is None:
+            continue
+
+        for group_id in group_ids:
+            if group_id not in group_counter:
+                group_counter[group_id] = [0, 0]
+            if intron_unique_mappings != 0:
+                group_counter[group_id][0] += 1
+            if intron_all_mappings != 0:
+                group_counter[group_id][1] += 1
+
+    if group_counter:
+        yield (prev_intron, get_intron_stats(group_counter))
+
+
+
 if __name__ == '__main__':
     main()
 
@@ -21,7 +21,8 @@ def main():
     parser = argparse.ArgumentParser(description="loads introns into intron sqlite3 db", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
     parser.add_argument("--sqlite3_db", dest="sqlite3_db", type=str, required=True, help="sqlite3_db name")
-    parser.add_argument("--input", dest="input", type=str, required=True, help="input data table", nargs='+')
+    parser.add_argument("--input", dest="input", type=str, required=True, help="input data table (intron occurrence tsv file or parquet dataset dir)", nargs='+')
+    parser.add_argument("--chromosomes", dest="chromosomes", type=str, required=False, default=None, nargs='+', help="restrict to introns on these chromosomes")
 
     args = parser.parse_args()
 
@@ -52,94 +53,63 @@ def main():
     ## populate data
     for input_file in input_files:
         logger.info("-processing file: " + input_file)
-        with open(input_file, 'rt') as fh:
-            header = next(fh)
-            counter = 0
-            for line in fh:
-
-                counter += 1
-                if counter % 1000 == 0:
-                    sys.stderr.write("\r[{}]  ".format(counter))
+        counter = 0
+        for (classname, sample, genes,
+             Chromosome, Start, End, strandval,
+             intron_motif, annot_status,
+             unique_mappings, multi_mappings, max_spliced_align_overhang) in get_intron_occurrence_records(input_file, args.chromosomes):
+
+            counter += 1
+            if counter % 1000 == 0:
+                sys.stderr.write("\r[{}]  ".format(counter))
+            
+            unique_mappings = int(unique_mappings)
+            multi_mappings = int(multi_mappings)
+
+
+            ## sample:     # fields: sample_name, db_class, sample_type, total_uniq_count, total_multi_count, total_count
+            if sample not in samples:
+                sample_struct = samples[sample] = get_sample_struct(classname, sample, GTEx_sample_to_tissue_type)
+            else:
+                sample_struct = samples[sample]
+
+            sample_struct['total_uniq_count'] += unique_mappings
+            sample_struct['total_multi_count'] += multi_mappings
+            sample_struct['total_count'] += unique_mappings + multi_mappings
+
+
+            ## intron feature: fields: intron, chromosome, start, end, strand, intron_motif, annot_status, genes
+            intron_feature_key = "{}:{}-{}".format(Chromosome, Start, End)
+            if intron_feature_key not in intron_features:
+
+                bulk_intron_feature_ofh.write("\t".join([intron_feature_key,
+                                                         Chromosome,
+                                                         str(Start),
+                                                         str(End),
+                                                         strandval,
+                                                         str(intron_motif),
+                                                         str(annot_status),
+                                                         genes ]) + "\n")
+                intron_features.add(intron_feature_key)
                 
-                line = line.rstrip()
-                (classname, sample, genes,
-                 Chromosome, Start, End, strandval,
-                 intron_motif, annot_status,
-                 unique_mappings, multi_mappings, max_spliced_align_overhang) = line.split("\t")
-                
-                unique_mappings = int(unique_mappings)
-                multi_mappings = int(multi_mappings)
-
-
-                ## sample:     # fields: sample_name, db_class, sample_type, total_uniq_count, total_multi_count, total_count
-                if sample not in samples:
-
-                    ## determine if tumor or normal
-                    TN = 'N'
-
-                    if classname == "TCGA":
-                        TN = 'T'
-                        
-                        if sample[-3:] == "-NT":
-                            TN = 'N'
-                        
-                        sample_type = sample.split("-")[0]
-
-                    elif classname == "GTEx":
-
-                        assert(sample in GTEx_sample_to_tissue_type)
-                        sample_type = GTEx_sample_to_tissue_type[sample]
-
-                    else:
-                        raise RuntimeError("Error, not recognizing class type: {}".format(classname))
-                                           
-                                        
-                    sample_struct = samples[sample] = { 'db_class' : classname,
-                                                        'sample_type' : sample_type,
-                                                        'total_uniq_count' : 0,
-                                                        'total_multi_count' : 0,
-                                                        'total_count' : 0,
-                                                        'TN' : TN}
-                else:
-                    sample_struct = samples[sample]
-
-                sample_struct['total_uniq_count'] += unique_mappings
-                sample_struct['total_multi_count'] += multi_mappings
-                sample_struct['total_count'] += unique_mappings + multi_mappings
-
-
-                ## intron feature: fields: intron, chromosome, start, end, strand, intron_motif, annot_status, genes
-                intron_feature_key = "{}:{}-{}".format(Chromosome, Start, End)
-                if intron_feature_key not in intron_features:
-
-                    bulk_intron_feature_ofh.write("\t".join([intron_feature_key,
-                                                             Chromosome,
-                                                             Start,
-                                                             End,
-                                                             strandval,
-                                                             intron_motif,
-                                                             annot_status,
-                                                             genes ]) + "\n")
-                    intron_features.add(intron_feature_key)
-                    
-
-                ## intron occurrence: fields: intron, sample, unique_mappings, multi_mappings, all_mappings,
-                ##                    max_spliced_align_overhang, norm_unique_mappings, norm_multi_mappings, norm_all_mappings 
-
-                intron_occurrence = { 'intron' : intron_feature_key,
-                                      'sample' : sample,
-                                      'unique_mappings' : unique_mappings,
-                                      'multi_mappings' : multi_mappings,
-                                      'all_mappings' : unique_mappings + multi_mappings,
-                                      'max_spliced_align_overhang' : max_spliced_align_overhang }
-
-                bulk_intron_occurrence_ofh.write("\t".join([intron_feature_key,
-                                                            sample,
-                                                            str(unique_mappings),
-                                                            str(multi_mappings),
-                                                            str(unique_mappings + multi_mappings),
-                                                            max_spliced_align_overhang
-                                                            ]) + "\n")
+
+            ## intron occurrence: fields: intron, sample, unique_mappings, multi_mappings, all_mappings,
+            ##                    max_spliced_align_overhang, norm_unique_mappings, norm_multi_mappings, norm_all_mappings 
+
+            intron_occurrence = { 'intron' : intron_feature_key,
+                                  'sample' : sample,
+                                  'unique_mappings' : unique_mappings,
+                                  'multi_mappings' : multi_mappings,
+                                  'all_mappings' : unique_mappings + multi_mappings,
+                                  'max_spliced_align_overhang' : max_spliced_align_overhang }
+
+            bulk_intron_occurrence_ofh.write("\t".join([intron_feature_key,
+                                                        sample,
+                                                        str(unique_mappings),
+                                                        str(multi_mappings),
+                                                        str(unique_mappings + multi_mappings),
+                                                        str(max_spliced_align_overhang)
+                                                        ]) + "\n")
         
         sys.stderr.write("  ok\n")
 
@@ -162,6 +132,83 @@ def main():
 
 
 
+def get_sample_struct(classname : str, sample : str, GTEx_sample_to_tissue_type : dict) -> dict:
+    """ new samples table entry (with zeroed mapping totals) for the sample """
+    
+    ## determine if tumor or normal
+    TN = 'N'
+
+    if classname == "TCGA":
+        TN = 'T'
+
+        if sample[-3:] == "-NT":
+            TN = 'N'
+
+        sample_type = sample.split("-")[0]
+
+    elif classname == "GTEx":
+
+        assert(sample in GTEx_sample_to_tissue_type)
+        sample_type = GTEx_sample_to_tissue_type[sample]
+
+    else:
+        raise RuntimeError("Error, not recognizing class type: {}".format(classname))
+
+    return { 'db_class' : classname,
+             'sample_type' : sample_type,
+             'total_uniq_count' : 0,
+             'total_multi_count' : 0,
+             'total_count' : 0,
+             'TN' : TN}
+
+
+
+def get_intron_occurrence_records(input_file : str, chromosomes : list = None):
+    """
+    Yields the intron occurrence fields for each record of the input, which is either
+    the tsv written by intron_occurrence_capture.py (fields as text) or its parquet
+    dataset (--output_format parquet; coordinates and counts as ints, as stored).
+    Parquet partitions not among the chromosomes are skipped.
+    """
+
+    if os.path.isdir(input_file) or input_file.endswith(".parquet"):
+        yield from get_intron_occurrence_records_from_parquet(input_file, chromosomes)
+        return
+
+    with open(input_file, 'rt') as fh:
+        header = next(fh)
+        for line in fh:
+            line = line.rstrip()
+            vals = line.split("\t")
+            if chromosomes is not None and vals[3] not in chromosomes:
+                continue
+            yield vals
+
+
+def get_intron_occurrence_records_from_parquet(input_dir : str, chromosomes : list = None):
+
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    column_names = [ "class", "sample", "genes",
+                     "Chromosome", "Start", "End",
+                     "strandval", "intron_motif", "annot_status",
+                     "unique_mappings", "multi_mappings", "max_spliced_align_overhang" ]
+
+    dataset = ds.dataset(input_dir, format="parquet",
+                         partitioning=ds.partitioning(pa.schema([("Chromosome", pa.string())]), flavor="hive"))
+
+    row_filter = None
+    if chromosomes is not None:
+        row_filter = ds.field("Chromosome").isin(chromosomes)
+
+    for batch in dataset.to_batches(columns=column_names, filter=row_filter):
+        # typed columns are kept as is, and only formatted where written as text
+        columns = [ batch.column(column_name).to_pylist() for column_name in column_names ]
+        yield from zip(*columns)
+
+
+
 def parse_GTEx_sample_types():
 
     gtex_sample_to_tissue = dict()
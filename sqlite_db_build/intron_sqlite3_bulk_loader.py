@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+
+import os, re, sys
+import sqlite3
+import logging
+import argparse
+import time
+
+if sys.version_info[0] != 3:
+    print("This script requires Python 3")
+    exit(1)
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from ctat_splice_db_create import create_tables, index_table, get_schema_version
+from intron_sqlite3_bulk_load_prepper import get_intron_occurrence_records, get_sample_struct, parse_GTEx_sample_types
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+INSERT_BATCH_SIZE = 100000
+COMMIT_EVERY = 5000000
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="creates the intron sqlite3 db and loads the intron occurrence data directly (no bulk tsv files or sqlite3 .import)", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("--sqlite3_db", dest="sqlite3_db", type=str, required=True, help="sqlite3_db name")
+    parser.add_argument("--input", dest="input", type=str, required=True, help="input data table (intron occurrence tsv file or parquet dataset dir)", nargs='+')
+    parser.add_argument("--chromosomes", dest="chromosomes", type=str, required=False, default=None, nargs='+', help="restrict to introns on these chromosomes")
+    parser.add_argument("--index", dest="index", type=str, required=False, default=["samples", "intron_feature", "intron_occurrence"], nargs='*', help="tables to index once loaded")
+    parser.add_argument("--schema_version", dest="schema_version", type=int, required=False, default=1, choices=[1, 2], help="database schema version (see ctat_splice_db_create.py)")
+    parser.add_argument("--cache_size_mb", dest="cache_size_mb", type=int, required=False, default=4000, help="sqlite page cache size (MB) used during the load")
+
+    args = parser.parse_args()
+
+    sqlite3_dbname = args.sqlite3_db
+
+    if os.path.exists(sqlite3_dbname):
+        sys.stderr.write("\n\n\tDatabase file {} already exists. Please rename it or provide a different database name via --sqlite3_db\n\n".format(sqlite3_dbname))
+        sys.exit(1)
+
+    conn = sqlite3.connect(sqlite3_dbname)
+
+    # the database is built from scratch, so a failed load is just rerun: no journal needed.
+    # (schema version 2 stages all the intron occurrences in a temp table: keep that on disk)
+    for pragma in ("journal_mode=OFF",
+                   "synchronous=OFF",
+                   "locking_mode=EXCLUSIVE",
+                   "temp_store={}".format("FILE" if args.schema_version == 2 else "MEMORY"),
+                   "cache_size=-{}".format(args.cache_size_mb * 1024)):
+        conn.execute("PRAGMA {}".format(pragma))
+
+    logger.info("-creating database: {}".format(sqlite3_dbname))
+    create_tables(conn, args.schema_version)
+
+    if get_schema_version(conn) == 2:
+        load_intron_occurrences_v2(conn, args.input, args.chromosomes)
+    else:
+        load_intron_occurrences(conn, args.input, args.chromosomes)
+
+    ## indexes are built after the load, rather than maintained row by row during it.
+    for tablename in args.index:
+        index_table(conn, tablename)
+
+    logger.info("-analyzing database")
+    conn.execute("ANALYZE")
+    conn.commit()
+    conn.close()
+
+    logger.info("-done")
+
+    sys.exit(0)
+
+
+
+def load_intron_occurrences(conn : sqlite3.Connection, input_files : list, chromosomes : list = None) -> None:
+    """
+    Streams the intron occurrence records into the samples, intron_feature and intron_occurrence
+    tables, storing the same rows as the bulk load prepper tsv files imported via sqlite3 .import
+    """
+
+    GTEx_sample_to_tissue_type = parse_GTEx_sample_types()
+
+    c = conn.cursor()
+
+    samples = dict()
+    intron_features = set()
+
+    intron_feature_rows = list()
+    intron_occurrence_rows = list()
+
+    def flush_rows():
+        c.executemany("INSERT INTO intron_feature VALUES (?, ?, ?, ?, ?, ?, ?, ?)", intron_feature_rows)
+        c.executemany("INSERT INTO intron_occurrence VALUES (?, ?, ?, ?, ?, ?)", intron_occurrence_rows)
+        intron_feature_rows.clear()
+        intron_occurrence_rows.clear()
+
+    start_time = time.time()
+    num_records = 0
+
+    for input_file in input_files:
+        logger.info("-loading file: " + input_file)
+
+        for (classname, sample, genes,
+             Chromosome, Start, End, strandval,
+             intron_motif, annot_status,
+             unique_mappings, multi_mappings, max_spliced_align_overhang) in get_intron_occurrence_records(input_file, chromosomes):
+
+            unique_mappings = int(unique_mappings)
+            multi_mappings = int(multi_mappings)
+
+            if sample not in samples:
+                sample_struct = samples[sample] = get_sample_struct(classname, sample, GTEx_sample_to_tissue_type)
+            else:
+                sample_struct = samples[sample]
+
+            sample_struct['total_uniq_count'] += unique_mappings
+            sample_struct['total_multi_count'] += multi_mappings
+            sample_struct['total_count'] += unique_mappings + multi_mappings
+
+            intron_feature_key = "{}:{}-{}".format(Chromosome, Start, End)
+            if intron_feature_key not in intron_features:
+                intron_feature_rows.append( (intron_feature_key, Chromosome, Start, End, strandval, intron_motif, annot_status, genes) )
+                intron_features.add(intron_feature_key)
+
+            intron_occurrence_rows.append( (intron_feature_key, sample,
+                                            unique_mappings, multi_mappings, unique_mappings + multi_mappings,
+                                            max_spliced_align_overhang) )
+
+            num_records += 1
+            if num_records % INSERT_BATCH_SIZE == 0:
+                flush_rows()
+                sys.stderr.write("\r[{}]  ".format(num_records))
+
+            if num_records % COMMIT_EVERY == 0:
+                conn.commit()
+
+        flush_rows()
+        conn.commit()
+        sys.stderr.write("  ok\n")
+
+    c.executemany("INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?, ?)",
+                  [ (sample,
+                     sample_struct['db_class'],
+                     sample_struct['sample_type'],
+                     sample_struct['total_uniq_count'],
+                     sample_struct['total_multi_count'],
+                     sample_struct['total_count'],
+                     sample_struct['TN']) for (sample, sample_struct) in samples.items() ])
+    conn.commit()
+
+    logger.info("-loaded {} intron occurrences, {} intron features, {} samples in {} seconds".format(
+        num_records, len(intron_features), len(samples), int(time.time() - start_time)))
+
+    return
+
+
+
+def load_intron_occurrences_v2(conn : sqlite3.Connection, input_files : list, chromosomes : list = None) -> None:
+    """
+    Schema version 2: as load_intron_occurrences, but assigns the intron, sample and sample type ids
+    here and writes them straight into the _v2 tables, rather than through the views' per-row triggers.
+    The intron occurrences are staged unindexed and then inserted in (intron_id, sample_id) order,
+    so the WITHOUT ROWID table is built by appending instead of random b-tree inserts.
+    """
+
+    GTEx_sample_to_tissue_type = parse_GTEx_sample_types()
+
+    c = conn.cursor()
+
+    c.execute("CREATE TEMP TABLE intron_occurrence_staging " +
+              " (intron_id INT, sample_id INT, unique_mappings INT, multi_mappings INT, all_mappings INT, max_spliced_align_overhang INT)")
+
+    samples = dict()
+    sample_to_id = dict()
+    intron_to_id = dict()
+
+    intron_feature_rows = list()
+    intron_occurrence_rows = list()
+
+    def flush_rows():
+        c.executemany("INSERT INTO intron_feature_v2 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", intron_feature_rows)
+        c.executemany("INSERT INTO intron_occurrence_staging VALUES (?, ?, ?, ?, ?, ?)", intron_occurrence_rows)
+        intron_feature_rows.clear()
+        intron_occurrence_rows.clear()
+
+    start_time = time.time()
+    num_records = 0
+
+    for input_file in input_files:
+        logger.info("-loading file: " + input_file)
+
+        for (classname, sample, genes,
+             Chromosome, Start, End, strandval,
+             intron_motif, annot_status,
+             unique_mappings, multi_mappings, max_spliced_align_overhang) in get_intron_occurrence_records(input_file, chromosomes):
+
+            unique_mappings = int(unique_mappings)
+            multi_mappings = int(multi_mappings)
+
+            if sample not in samples:
+                sample_struct = samples[sample] = get_sample_struct(classname, sample, GTEx_sample_to_tissue_type)
+                sample_to_id[sample] = len(sample_to_id) + 1
+            else:
+                sample_struct = samples[sample]
+
+            sample_struct['total_uniq_count'] += unique_mappings
+            sample_struct['total_multi_count'] += multi_mappings
+            sample_struct['total_count'] += unique_mappings + multi_mappings
+
+            intron_feature_key = "{}:{}-{}".format(Chromosome, Start, End)
+            intron_id = intron_to_id.get(intron_feature_key)
+            if intron_id is None:
+                intron_id = intron_to_id[intron_feature_key] = len(intron_to_id) + 1
+                intron_feature_rows.append( (intron_id, intron_feature_key, Chromosome, Start, End, strandval, intron_motif, annot_status, genes) )
+
+            intron_occurrence_rows.append( (intron_id, sample_to_id[sample],
+                                            unique_mappings, multi_mappings, unique_mappings + multi_mappings,
+                                            max_spliced_align_overhang) )
+
+            num_records += 1
+            if num_records % INSERT_BATCH_SIZE == 0:
+                flush_rows()
+                sys.stderr.write("\r[{}]  ".format(num_records))
+
+            if num_records % COMMIT_EVERY == 0:
+                conn.commit()
+
+        flush_rows()
+        conn.commit()
+        sys.stderr.write("  ok\n")
+
+    logger.info("-building table: intron_occurrence_v2")
+    c.execute("INSERT INTO intron_occurrence_v2 " +
+              " SELECT intron_id, sample_id, unique_mappings, multi_mappings, all_mappings, max_spliced_align_overhang " +
+              " FROM intron_occurrence_staging ORDER BY intron_id, sample_id")
+    c.execute("DROP TABLE intron_occurrence_staging")
+
+    sample_type_to_id = dict()
+    for sample_struct in samples.values():
+        sample_type_key = (sample_struct['db_class'], sample_struct['sample_type'])
+        if sample_type_key not in sample_type_to_id:
+            sample_type_to_id[sample_type_key] = len(sample_type_to_id) + 1
+
+    c.executemany("INSERT INTO sample_types VALUES (?, ?, ?)",
+                  [ (sample_type_id, db_class, sample_type) for ((db_class, sample_type), sample_type_id) in sample_type_to_id.items() ])
+
+    c.executemany("INSERT INTO samples_v2 VALUES (?, ?, ?, ?, ?, ?, ?)",
+                  [ (sample_to_id[sample],
+                     sample,
+                     sample_type_to_id[ (sample_struct['db_class'], sample_struct['sample_type']) ],
+                     sample_struct['total_uniq_count'],
+                     sample_struct['total_multi_count'],
+                     sample_struct['total_count'],
+                     sample_struct['TN']) for (sample, sample_struct) in samples.items() ])
+    conn.commit()
+
+    logger.info("-loaded {} intron occurrences, {} intron features, {} samples in {} seconds".format(
+        num_records, len(intron_to_id), len(samples), int(time.time() - start_time)))
+
+    return
+
+
+
+if __name__ == '__main__':
+    main()
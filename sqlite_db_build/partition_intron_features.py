@@ -19,9 +19,6 @@ def main():
     if not os.path.exists(output_directory):
         os.makedirs(output_directory)
 
-
-    files_per_bin = 100
-
     feature_counter = 0
     file_counter = 0
     
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+import sys, os, re
+import sqlite3
+import logging
+import argparse
+import shutil
+import multiprocessing
+import time
+from urllib.request import pathname2url
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import evaluate_intron_usage_stats
+import evaluate_intron_tumor_enrichment
+from ctat_splice_db_create import index_table, get_table_row_inserter
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+## evaluation -> table its output is loaded into
+EVALUATION_TABLES = { 'usage_stats' : 'intron_sample_type_counts',
+                      'tumor_enrichment' : 'tumor_vs_normal' }
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="runs the intron usage stats or tumor enrichment evaluation locally across a process pool, in place of partition_intron_features.py and a grid", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("--sqlite3_db", dest="sqlite3_db", type=str, required=True, help="sqlite3_db name")
+    parser.add_argument("--intron_features_file", dest="intron_features_file", type=str, required=True, help="file containing list of intron features")
+    parser.add_argument("--evaluation", dest="evaluation", type=str, required=True, choices=sorted(EVALUATION_TABLES.keys()), help="evaluation to run")
+    parser.add_argument("--output_file", dest="output_file", type=str, required=True, help="output filename")
+    parser.add_argument("--CPU", dest="CPU", type=int, required=False, default=4, help="number of worker processes")
+    parser.add_argument("--num_shards", dest="num_shards", type=int, required=False, default=None, help="number of intron ranges to partition the features into (default: 10 x --CPU)")
+    parser.add_argument("--pseudocount", dest="pseudocount", type=float, required=False, default=0.1, help="tumor_enrichment pseudocount used in ratio computations: (A + pseudo)/(B + pseudo)")
+    parser.add_argument("--load_table", dest="load_table", action='store_true', default=False, help="load the merged output into its table (intron_sample_type_counts or tumor_vs_normal) and index it")
+
+    args = parser.parse_args()
+
+    num_shards = args.num_shards if args.num_shards else 10 * args.CPU
+
+    shards = partition_intron_features(args.intron_features_file, num_shards)
+
+    shard_dir = args.output_file + ".shards"
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+
+    tasks = [ (args.evaluation, shard_num, intron_features, shard_dir) for (shard_num, intron_features) in enumerate(shards) ]
+
+    start_time = time.time()
+
+    # shards come back in intron range order, so the merged output is the same regardless of --CPU
+    tmp_output_file = args.output_file + ".tmp"
+    with open(tmp_output_file, 'wt') as ofh:
+        with multiprocessing.Pool(args.CPU, initializer=_init_evaluation_worker, initargs=(args.sqlite3_db, args.pseudocount)) as pool:
+            for (shard_num, shard_filename) in enumerate(pool.imap(_evaluate_shard_worker, tasks)):
+                with open(shard_filename, 'rt') as fh:
+                    shutil.copyfileobj(fh, ofh)
+                os.remove(shard_filename)
+                logger.info("-merged shard {} of {}, {} seconds".format(shard_num + 1, len(tasks), int(time.time() - start_time)))
+
+    os.replace(tmp_output_file, args.output_file)
+    os.rmdir(shard_dir)
+
+    if args.load_table:
+        load_evaluation_table(args.sqlite3_db, EVALUATION_TABLES[args.evaluation], args.output_file)
+
+    logger.info("-done")
+
+    sys.exit(0)
+
+
+
+def partition_intron_features(intron_features_file : str, num_shards : int) -> list:
+    """ sorts the (distinct) intron features and splits them into up to num_shards contiguous intron ranges """
+
+    intron_features = set()
+    with open(intron_features_file) as fh:
+        for intron_feature in fh:
+            intron_feature = intron_feature.rstrip()
+            if intron_feature:
+                intron_features.add(intron_feature)
+
+    intron_features = sorted(intron_features)
+
+    num_shards = max(1, min(num_shards, len(intron_features)))
+
+    shards = list()
+    for shard_num in range(num_shards):
+        shard = intron_features[ (shard_num * len(intron_features)) // num_shards : ((shard_num + 1) * len(intron_features)) // num_shards ]
+        if shard:
+            shards.append(shard)
+
+    logger.info("-partitioned {} intron features into {} intron ranges".format(len(intron_features), len(shards)))
+
+    return shards
+
+
+
+def connect_read_only(sqlite3_dbname : str) -> sqlite3.Connection:
+    # immutable: no locking or change detection, as the database isn't written while the evaluations run.
+    return sqlite3.connect("file:{}?mode=ro&immutable=1".format(pathname2url(os.path.abspath(sqlite3_dbname))), uri=True)
+
+
+
+_worker_conn = None
+_worker_pseudocount = None
+_worker_sample_type_counts = dict()
+
+
+def _init_evaluation_worker(sqlite3_dbname : str, pseudocount : float) -> None:
+    global _worker_conn, _worker_pseudocount
+    _worker_conn = connect_read_only(sqlite3_dbname)
+    _worker_pseudocount = pseudocount
+
+
+def _evaluate_shard_worker(task : tuple) -> str:
+    (evaluation, shard_num, intron_features, shard_dir) = task
+
+    c = _worker_conn.cursor()
+
+    shard_filename = os.path.join(shard_dir, "shard_{:06d}.tsv".format(shard_num))
+    tmp_shard_filename = shard_filename + ".tmp"
+
+    with open(tmp_shard_filename, 'wt') as ofh:
+
+        if evaluation == 'usage_stats':
+            if evaluation not in _worker_sample_type_counts:
+                _worker_sample_type_counts[evaluation] = evaluate_intron_usage_stats.get_sample_type_counts(c)
+            sample_type_counts = _worker_sample_type_counts[evaluation]
+
+            shard_intron_features = set(intron_features)
+            for (intron, intron_stats) in evaluate_intron_usage_stats.stream_intron_usage_stats(c, sample_type_counts, (intron_features[0], intron_features[-1])):
+                if intron in shard_intron_features:
+                    evaluate_intron_usage_stats.write_intron_usage_stats(ofh, intron, intron_stats)
+
+        elif evaluation == 'tumor_enrichment':
+            if evaluation not in _worker_sample_type_counts:
+                _worker_sample_type_counts[evaluation] = evaluate_intron_tumor_enrichment.get_sample_type_counts(c)
+            (sample_type_counts, mean_tcga_count, mean_gtex_count) = _worker_sample_type_counts[evaluation]
+
+            evaluate_intron_tumor_enrichment.examine_intron_features_for_enrichment_bulk(intron_features, c, sample_type_counts, ofh,
+                                                                                       _worker_pseudocount, mean_tcga_count, mean_gtex_count)
+
+        else:
+            raise RuntimeError("Error, not recognizing evaluation type: {}".format(evaluation))
+
+    os.rename(tmp_shard_filename, shard_filename)
+
+    return shard_filename
+
+
+
+def load_evaluation_table(sqlite3_dbname : str, tablename : str, evaluation_output_file : str) -> None:
+    """ loads the evaluation output into the table, as a tab-delimited sqlite3 .import would, then indexes it """
+
+    logger.info("-loading {} into table {}".format(evaluation_output_file, tablename))
+
+    conn = sqlite3.connect(sqlite3_dbname)
+    c = conn.cursor()
+
+    # (on a schema version 2 database, straight into the _v2 table by id, bypassing the view's trigger)
+    (insert_query, to_table_row) = get_table_row_inserter(conn, tablename)
+
+    with open(evaluation_output_file, 'rt') as fh:
+        c.executemany(insert_query, (to_table_row(line.rstrip("\n").split("\t")) for line in fh))
+
+    conn.commit()
+
+    index_table(conn, tablename)
+
+    conn.close()
+
+    return
+
+
+
+if __name__ == '__main__':
+    main()
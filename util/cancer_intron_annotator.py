@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+import sys, os, re
+import argparse
+import logging
+from cancer_intron_store import open_cancer_intron_store, read_cancer_introns_idx
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s : %(levelname)s : %(message)s',
+                    datefmt='%H:%M:%S')
+logger = logging.getLogger(__name__)
+
+def main():
+
+    parser = argparse.ArgumentParser(description="annotate introns according to the ctat cancer introns database", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("--introns_file", type=str, required=True, help="introns tsv file (requires a columns header line)")
+    parser.add_argument("--ctat_genome_lib", type=str, required=False, default=os.environ.get("CTAT_GENOME_LIB", None), help="ctat genome lib build dir")
+    parser.add_argument("--intron_col", type=int, required=False, default=0, help="tab-delim column index for intron")
+
+    args = parser.parse_args()
+
+    if not args.ctat_genome_lib:
+        raise RuntimeError("Error, must set --ctat_genome_lib ")
+
+    annotator = CancerIntronAnnotator(args.ctat_genome_lib)
+    annotator.annotate_introns_file(args.introns_file, sys.stdout, args.intron_col)
+
+    sys.exit(0)
+
+
+
+class CancerIntronAnnotator:
+    """
+    In-process equivalent of annotate_cancer_introns.pl
+
+    Lookups go to the memory-mapped cancer intron store (see cancer_intron_store.py) when
+    the genome lib has a current one, and otherwise to the cancer introns index read into
+    memory. Either is opened a single time, so the same annotator can be applied to any
+    number of samples.
+    """
+
+    def __init__(self, ctat_genome_lib : str):
+
+        store = open_cancer_intron_store(ctat_genome_lib)
+
+        if store is not None:
+            self._column_headers = store.get_column_headers()
+            self._get_annotation = store.get_annotation
+            num_annotations = len(store)
+        else:
+            (self._column_headers, intron_to_annot) = read_cancer_introns_idx(ctat_genome_lib)
+            self._get_annotation = intron_to_annot.get
+            num_annotations = len(intron_to_annot)
+
+        logger.info("-{} cancer intron annotations available".format(num_annotations))
+
+
+    def get_annotation(self, intron : str) -> str:
+        return self._get_annotation(intron)
+
+
+    def annotate_introns_file(self, introns_file : str, ofh, intron_col : int = 0) -> int:
+        """
+        Writes the header and each input row having a cancer intron annotation,
+        with the annotation columns appended.  Returns the number of rows written.
+        """
+
+        found = 0
+
+        get_annotation = self._get_annotation
+
+        with open(introns_file) as fh:
+
+            header = next(fh).rstrip("\n")
+
+            header_add = re.sub("^intron\t", "", self._column_headers)
+
+            already_got_genes_flag = False
+            if re.search("\\bgenes\t", header):
+                already_got_genes_flag = True
+                header_add = header_add.replace("genes\t", "", 1)
+
+            ofh.write("\t".join([header, header_add]) + "\n")
+
+            for line in fh:
+                input_line = line.rstrip("\n")
+                vals = input_line.split("\t")
+                intron = vals[intron_col]
+
+                intron_annot = get_annotation(intron)
+                if intron_annot is not None:
+
+                    if already_got_genes_flag:
+                        annot_vals = intron_annot.split("\t")[1:] # remove genes
+                        while annot_vals and annot_vals[-1] == "":
+                            annot_vals.pop()
+                        intron_annot = "\t".join(annot_vals)
+
+                    ofh.write("\t".join([input_line, intron_annot]) + "\n")
+                    found += 1
+
+        if found:
+            logger.info("-{}: identified {} cancer introns".format(introns_file, found))
+        else:
+            logger.info("-{}: no cancer introns identified.".format(introns_file))
+
+        return found
+
+
+
+def annotate_cancer_introns(ctat_genome_lib : str, introns_file : str, output_file : str, intron_col : int = 0) -> int:
+    """ in-process equivalent of: annotate_cancer_introns.pl ... > output_file """
+
+    annotator = CancerIntronAnnotator(ctat_genome_lib)
+
+    with open(output_file, "wt") as ofh:
+        return annotator.annotate_introns_file(introns_file, ofh, intron_col)
+
+
+
+if __name__ == "__main__":
+    main()
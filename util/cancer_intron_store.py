@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+
+import sys, os, re
+import json
+import mmap
+import zlib
+import struct
+import argparse
+import subprocess
+import logging
+from array import array
+from splice_site_index import get_source_info, index_is_current, refresh_index_source_mtime
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+utildir = os.path.dirname(os.path.realpath(__file__))
+
+
+STORE_MAGIC = b"CTATCIS1"
+STORE_FILE_SUFFIX = ".mmap"
+
+
+"""
+Read-only cancer intron -> annotation store, compiled from the TiedHash
+cancer_splicing.idx so it can be memory-mapped directly rather than loaded.
+
+Records (intron key, annotation text) are kept in key order as two utf-8
+blobs with offset arrays, and looked up through an open-addressing hash
+table of record numbers (crc32 of the key, linear probing).
+
+On-disk layout:
+
+    magic (8 bytes) | header length (uint64, little endian) | json header |
+    zero padding to 8-byte boundary |
+    hash slots (uint32 x num_slots, record number + 1, or 0 if empty) |
+    zero padding to 8-byte boundary |
+    key offsets (uint64 x N+1) | annotation offsets (uint64 x N+1) |
+    keys blob | annotations blob
+
+"""
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="build the memory-mapped cancer intron annotation store for a ctat genome lib", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("--ctat_genome_lib", dest="ctat_genome_lib", type=str, required=True, help="ctat genome lib build dir")
+
+    args = parser.parse_args()
+
+    compile_cancer_intron_store(args.ctat_genome_lib)
+
+    sys.exit(0)
+
+
+
+class CancerIntronStore:
+
+    def __init__(self, column_headers : str, num_records : int, slots, key_offsets, annot_offsets, keys_blob, annots_blob):
+
+        self._column_headers = column_headers
+        self._num_records = num_records
+        self._slots = slots
+        self._slot_mask = len(slots) - 1
+        self._key_offsets = key_offsets
+        self._annot_offsets = annot_offsets
+        self._keys_blob = keys_blob
+        self._annots_blob = annots_blob
+
+
+    def __len__(self):
+        return self._num_records
+
+
+    def get_column_headers(self) -> str:
+        return self._column_headers
+
+
+    def get_annotation(self, intron : str) -> str:
+        """ annotation text for the intron, or None if it's not a cancer intron """
+
+        key = intron.encode()
+        slot = zlib.crc32(key) & self._slot_mask
+
+        while True:
+            record_num = self._slots[slot]
+            if record_num == 0:
+                return None
+
+            record_num -= 1
+            if self._keys_blob[self._key_offsets[record_num]:self._key_offsets[record_num+1]] == key:
+                return bytes(self._annots_blob[self._annot_offsets[record_num]:self._annot_offsets[record_num+1]]).decode()
+
+            slot = (slot + 1) & self._slot_mask
+
+
+    @classmethod
+    def build(cls, column_headers : str, intron_to_annot : dict):
+
+        num_records = len(intron_to_annot)
+
+        num_slots = 1
+        while num_slots < 2 * num_records:
+            num_slots *= 2
+
+        slots = array('I', bytes(4 * num_slots))
+        key_offsets = array('Q', [0])
+        annot_offsets = array('Q', [0])
+        keys_blob = bytearray()
+        annots_blob = bytearray()
+
+        for (record_num, intron) in enumerate(sorted(intron_to_annot)):
+            key = intron.encode()
+
+            keys_blob += key
+            annots_blob += intron_to_annot[intron].encode()
+            key_offsets.append(len(keys_blob))
+            annot_offsets.append(len(annots_blob))
+
+            slot = zlib.crc32(key) & (num_slots - 1)
+            while slots[slot] != 0:
+                slot = (slot + 1) & (num_slots - 1)
+            slots[slot] = record_num + 1
+
+        return cls(column_headers, num_records, slots, key_offsets, annot_offsets, bytes(keys_blob), bytes(annots_blob))
+
+
+    def write(self, store_file : str, source_info : dict) -> None:
+
+        header = { 'byteorder' : sys.byteorder,
+                   'num_records' : self._num_records,
+                   'num_slots' : len(self._slots),
+                   'keys_blob_len' : len(self._keys_blob),
+                   'annots_blob_len' : len(self._annots_blob),
+                   'column_headers' : self._column_headers,
+                   'source' : source_info }
+
+        header_bytes = json.dumps(header).encode()
+        header_end = len(STORE_MAGIC) + 8 + len(header_bytes)
+
+        slots_bytes = array('I', self._slots).tobytes()
+
+        # write to a temp file and rename into place, so concurrent readers never see a partial store
+        tmp_store_file = "{}.tmp.{}".format(store_file, os.getpid())
+        with open(tmp_store_file, 'wb') as ofh:
+            ofh.write(STORE_MAGIC)
+            ofh.write(struct.pack("<Q", len(header_bytes)))
+            ofh.write(header_bytes)
+            ofh.write(b"\0" * (-header_end % 8))
+            ofh.write(slots_bytes)
+            ofh.write(b"\0" * (-len(slots_bytes) % 8))
+            ofh.write(array('Q', self._key_offsets).tobytes())
+            ofh.write(array('Q', self._annot_offsets).tobytes())
+            ofh.write(self._keys_blob)
+            ofh.write(self._annots_blob)
+
+        os.replace(tmp_store_file, store_file)
+
+
+    @classmethod
+    def read_header(cls, store_file : str) -> dict:
+
+        with open(store_file, 'rb') as fh:
+            if fh.read(len(STORE_MAGIC)) != STORE_MAGIC:
+                return None
+            (header_len,) = struct.unpack("<Q", fh.read(8))
+            header = json.loads(fh.read(header_len).decode())
+
+        header_end = len(STORE_MAGIC) + 8 + header_len
+        header['data_offset'] = header_end + (-header_end % 8)
+
+        return header
+
+
+    @classmethod
+    def load(cls, store_file : str, header : dict = None):
+
+        if header is None:
+            header = cls.read_header(store_file)
+
+        num_records = header['num_records']
+        num_slots = header['num_slots']
+
+        slots_offset = header['data_offset']
+        key_offsets_offset = slots_offset + 4 * num_slots + (-(4 * num_slots) % 8)
+        annot_offsets_offset = key_offsets_offset + 8 * (num_records + 1)
+        keys_blob_offset = annot_offsets_offset + 8 * (num_records + 1)
+        annots_blob_offset = keys_blob_offset + header['keys_blob_len']
+
+        with open(store_file, 'rb') as fh:
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        mv = memoryview(mm)
+
+        return cls(header['column_headers'], num_records,
+                   mv[slots_offset:slots_offset + 4 * num_slots].cast('I'),
+                   mv[key_offsets_offset:annot_offsets_offset].cast('Q'),
+                   mv[annot_offsets_offset:keys_blob_offset].cast('Q'),
+                   mv[keys_blob_offset:annots_blob_offset],
+                   mv[annots_blob_offset:annots_blob_offset + header['annots_blob_len']])
+
+
+
+def read_cancer_introns_idx(ctat_genome_lib : str) -> tuple:
+    """
+    Reads the TiedHash cancer introns index via dump_cancer_introns_idx.pl,
+    returning (column_headers, { intron : annotation }).
+    """
+
+    cmd = [os.path.join(utildir, "dump_cancer_introns_idx.pl"), "--ctat_genome_lib", ctat_genome_lib]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+
+    column_headers = proc.stdout.readline().rstrip("\n")
+    intron_to_annot = dict()
+
+    for line in proc.stdout:
+        intron, intron_annot = line.rstrip("\n").split("\t", 1)
+        # keep the perl truthiness test applied on lookup
+        if intron_annot not in ("", "0"):
+            intron_to_annot[intron] = intron_annot
+
+    if proc.wait() != 0:
+        raise RuntimeError("Error, command failed: {}".format(" ".join(cmd)))
+
+    return (column_headers, intron_to_annot)
+
+
+
+def get_cancer_intron_store_file(ctat_genome_lib : str) -> tuple:
+    """ returns (cancer_splicing.idx, its compiled store file) """
+
+    db_idx_file = os.path.join(ctat_genome_lib, "cancer_splicing_lib/cancer_splicing.idx")
+    if not os.path.exists(db_idx_file):
+        raise RuntimeError("Error, cannot locate resource file: {}".format(db_idx_file))
+
+    return (db_idx_file, db_idx_file + STORE_FILE_SUFFIX)
+
+
+
+def compile_cancer_intron_store(ctat_genome_lib : str) -> None:
+    """
+    Genome lib prep: writes the compiled store alongside cancer_splicing.idx, unless
+    the one there is already current with the index.
+    """
+
+    (db_idx_file, store_file) = get_cancer_intron_store_file(ctat_genome_lib)
+
+    if os.path.exists(store_file) and index_is_current(CancerIntronStore.read_header(store_file), db_idx_file):
+        refresh_index_source_mtime(store_file, db_idx_file, data_alignment=8)
+        logger.info("-compiled cancer intron store {} is current".format(store_file))
+        return
+
+    logger.info("-reading cancer introns index: {}".format(db_idx_file))
+    (column_headers, intron_to_annot) = read_cancer_introns_idx(ctat_genome_lib)
+    store = CancerIntronStore.build(column_headers, intron_to_annot)
+
+    store.write(store_file, get_source_info(db_idx_file))
+    logger.info("-wrote compiled cancer intron store: {}".format(store_file))
+
+    return
+
+
+
+def open_cancer_intron_store(ctat_genome_lib : str) -> CancerIntronStore:
+    """
+    Returns the memory-mapped compiled store if it's current with cancer_splicing.idx, otherwise None.
+    Nothing is compiled or written here: the store is built by the genome lib prep (compile_cancer_intron_store).
+    """
+
+    (db_idx_file, store_file) = get_cancer_intron_store_file(ctat_genome_lib)
+
+    if not os.path.exists(store_file):
+        logger.info("-no compiled cancer intron store: {}".format(store_file))
+        return None
+
+    header = CancerIntronStore.read_header(store_file)
+    if not index_is_current(header, db_idx_file):
+        logger.info("-compiled cancer intron store {} is out of date with {}".format(store_file, db_idx_file))
+        return None
+
+    logger.info("-using compiled cancer intron store: {}".format(store_file))
+
+    return CancerIntronStore.load(store_file, header)
+
+
+
+if __name__ == '__main__':
+    main()
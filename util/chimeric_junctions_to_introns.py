@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+import sys, os, re
+import gzip as gz
+import argparse
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+MIN_INTRON_LEN = 20
+
+cigar_regex = re.compile("(\\d+)([A-Zp])")
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="extract introns and their read support from a STAR Chimeric.out.junction file (python port of STAR_chimeric_junctions_to_introns.pl)",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("--chimeric_junction", "-J", dest="chimeric_junction", type=str, required=True, help="Chimeric.out.junction file (can be gzipped)")
+
+    args = parser.parse_args()
+
+    print("\t".join(["#intron_candidate", "uniqmap", "multimap"]))
+
+    for ((chr, lend, rend), uniq_count, multi_count) in map_chimeric_reads_to_introns(args.chimeric_junction):
+        print("{}:{}-{}\t{}\t{}".format(chr, lend, rend, uniq_count, multi_count))
+
+    sys.exit(0)
+
+
+
+def map_chimeric_reads_to_introns(chimeric_junction_file : str):
+    """
+    Yields ((chromosome, intron_lend, intron_rend), uniq_count, multi_count) for each intron
+    implied by the chimeric alignments, same as STAR_chimeric_junctions_to_introns.pl.
+
+    STAR writes all chimeric alignments of a read on consecutive lines, so each read's
+    alignment count is known once its block of lines ends and read names never need
+    to be retained.  (Input not grouped by read name, ie. re-sorted, would have a read's
+    split blocks counted as separate reads.)  Duplicate alignments are dropped across the
+    whole file, as in the perl script, whose counts this matches: identical alignments of
+    different reads (ie. PCR duplicates) are counted once.  So memory use is not bounded:
+    it grows with the number of distinct same-chromosome alignments, each held as a single
+    string key.
+
+    from the STAR manual, the first 14 columns are:
+    column 1: chromosome of the donor
+    column 2: first base of the intron of the donor (1-based)
+    column 3: strand of the donor
+    column 4: chromosome of the acceptor
+    column 5: first base of the intron of the acceptor (1-based)
+    column 6: strand of the acceptor
+    column 7: junction type: -1=encompassing junction (between the mates), 1=GT/AG, 2=CT/AC
+    column 8: repeat length to the left of the junction
+    column 9: repeat length to the right of the junction
+    column 10: read name
+    column 11: first base of the first segment (on the + strand)
+    column 12: CIGAR of the first segment
+    column 13: first base of the second segment
+    column 14: CIGAR of the second segment
+    """
+
+    intron_counter = dict()  # (chr, lend, rend) -> [uniq_count, multi_count]
+
+    seen = set()  # avoid duplicates
+
+    read_name = None
+    read_alignment_count = 0
+    read_introns = set()
+
+    def count_read_introns():
+        idx = 0 if read_alignment_count == 1 else 1
+        for intron in read_introns:
+            if intron not in intron_counter:
+                intron_counter[intron] = [0, 0]
+            intron_counter[intron][idx] += 1
+
+    if chimeric_junction_file[-3:] == ".gz":
+        fh = gz.open(chimeric_junction_file, 'rt')
+    else:
+        fh = open(chimeric_junction_file, 'rt')
+
+    for line in fh:
+        if line[0] == "#" or line.startswith("chr_donorA\tbrkpt"):
+            continue
+
+        line = line.rstrip("\n")
+        if line == "":
+            continue
+
+        x = line.split("\t")
+
+        if x[9] != read_name:
+            # done with the previous read
+            count_read_introns()
+            read_name = x[9]
+            read_alignment_count = 0
+            read_introns = set()
+
+        read_alignment_count += 1
+
+        (chrA, orientA) = (x[0], x[2])
+        (chrB, orientB) = (x[3], x[5])
+
+        if chrA != chrB:
+            # want introns for long introns and readthru splices only.
+            continue
+
+        if orientA != orientB:
+            # want consistent orientations.
+            continue
+
+        (rst_A, cigar_A) = (x[10], x[11])
+        (rst_B, cigar_B) = (x[12], x[13])
+
+        uniq_aln_token = "\t".join([chrA, rst_A, cigar_A, rst_B, cigar_B])
+        if uniq_aln_token in seen:
+            # duplicate
+            continue
+        seen.add(uniq_aln_token)
+
+        genome_coords_A = get_genome_coords_via_cigar(int(rst_A), cigar_A)
+        genome_coords_B = get_genome_coords_via_cigar(int(rst_B), cigar_B)
+
+        if orientA == '+':
+            genomic_coords = genome_coords_A + genome_coords_B
+        else:
+            genomic_coords = genome_coords_B + genome_coords_A
+
+        for i in range(len(genomic_coords) - 1):
+            intron_lend = genomic_coords[i][1] + 1
+            intron_rend = genomic_coords[i+1][0] - 1
+
+            if intron_rend - intron_lend > MIN_INTRON_LEN:
+                read_introns.add((chrA, intron_lend, intron_rend))
+
+    count_read_introns()
+
+    fh.close()
+
+    for (intron, (uniq_count, multi_count)) in intron_counter.items():
+        yield (intron, uniq_count, multi_count)
+
+
+
+def get_genome_coords_via_cigar(rst : int, cigar : str) -> list:
+    """ returns the [lend, rend] genome coordinates of the aligned segments """
+
+    genome_coords = list()
+
+    genome_lend = rst - 1 # move pointer just before first position.
+
+    for (length, code) in cigar_regex.findall(cigar):
+        length = int(length)
+
+        if code == 'M':
+            # aligned bases match or mismatch
+            genome_rend = genome_lend + length
+            genome_coords.append([genome_lend + 1, genome_rend])
+            genome_lend = genome_rend
+
+        elif code in ('D', 'N', 'p'):
+            # insertion in the genome or gap in query (intron, perhaps)
+            genome_lend += length
+
+        elif code not in ('I', 'S', 'H'):
+            raise RuntimeError("Error, cannot parse cigar code [{}] ".format(code))
+
+    return genome_coords
+
+
+
+if __name__ == '__main__':
+    main()
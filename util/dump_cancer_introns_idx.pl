@@ -0,0 +1,71 @@
+#!/usr/bin/env perl
+
+use strict;
+use warnings;
+use Carp;
+use FindBin;
+use lib ("$FindBin::Bin/PerlLib");
+use Getopt::Long qw(:config posix_default no_ignore_case bundling pass_through);
+use TiedHash;
+
+
+my $ctat_genome_lib = $ENV{CTAT_GENOME_LIB};
+
+
+my $usage = <<__EOUSAGE__;
+
+#####################################################################
+#
+# Writes the cancer introns index as tab-delimited intron/annotation
+# records so it can be loaded once and reused across many samples.
+#
+# --ctat_genome_lib <string>      /path/to/ctat_genome_lib_build_dir (default: $ctat_genome_lib)
+#
+#####################################################################
+
+__EOUSAGE__
+
+    ;
+
+
+my $help_flag;
+
+
+&GetOptions ( 'h' => \$help_flag,
+              'ctat_genome_lib=s' => \$ctat_genome_lib,
+    );
+
+
+if ($help_flag) { die $usage; }
+
+
+unless ($ctat_genome_lib) {
+    die $usage;
+}
+
+
+main: {
+
+    my $db_idx_file = "$ctat_genome_lib/cancer_splicing_lib/cancer_splicing.idx";
+
+    unless (-s $db_idx_file) {
+        die "Error, cannot locate resource file: $db_idx_file";
+    }
+
+    my $idx = new TiedHash( { 'use' => $db_idx_file } );
+
+    unless($idx->get_value("chr:ABC-DEF") eq "__placeholder_testval__") {
+        die "Error, $db_idx_file doesn't appear useable and must be rebuilt";
+    }
+
+    ## column headers first, then one intron record per line.
+    print $idx->get_value("column_headers") . "\n";
+
+    foreach my $key ($idx->get_keys()) {
+        if ($key eq "chr:ABC-DEF" || $key eq "column_headers") { next; }
+
+        print join("\t", $key, $idx->get_value($key)) . "\n";
+    }
+
+    exit(0);
+}
@@ -1,10 +1,18 @@
 #!/usr/bin/env python3
 
 import sys, os, re
-import pandas as pd
+import heapq
+import tempfile
 import argparse
 
 
+# max passing records held in memory while sorting; beyond this, sorted runs are spilled to temp files
+MAX_RECORDS_IN_MEMORY = 1000000
+
+NUMBER_RE = re.compile(r"^[+-]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][+-]?[0-9]+)?$")
+
+
+
 def main():
 
     args_parser = argparse.ArgumentParser(
@@ -24,22 +32,120 @@ def main():
     cancer_introns_file = args.cancer_intron_candidates
     min_total_reads = args.min_total_reads
 
+    filter_cancer_introns(cancer_introns_file, min_total_reads, sys.stdout)
 
+    sys.exit(0)
 
-    data = pd.read_table(cancer_introns_file)
-    data['total_reads'] = data['uniq_mapped'] + data['multi_mapped'] 
 
-    filtered_data = data[ data['total_reads'] >= min_total_reads ]
 
-    filtered_data = filtered_data.sort_values('total_reads', ascending=False)
+def filter_cancer_introns(cancer_introns_file, min_total_reads, ofh, max_records_in_memory=MAX_RECORDS_IN_MEMORY):
+    """
+    Writes the header and the records having uniq_mapped + multi_mapped >= min_total_reads,
+    sorted by decreasing total reads (ties kept in input order).  Records missing either count
+    don't pass.  Returns the number of records written.
 
-    filtered_data = filtered_data.drop('total_reads', axis=1)
+    Field text is written as read, with empty (or absent trailing) fields written as NA.  Unlike
+    the former pandas implementation, values aren't retyped: eg. a count column having missing
+    values keeps 7 rather than becoming 7.0, and NA-like text (nan, NULL, ...) isn't rewritten as NA.
 
-    sys.stdout.write(filtered_data.to_csv(sep="\t", index=False, na_rep="NA"))
-    
-    
+    Records are filtered as they're read, and the sort is an external merge sort,
+    so memory use is bounded regardless of the size of the candidates file.
+    """
 
-    sys.exit(0)
+    sorted_runs = list()
+    records = list()
+    num_records = 0
+
+    with open(cancer_introns_file, "rt") as fh:
+
+        header = next(fh).rstrip("\n")
+        column_names = header.split("\t")
+        num_columns = len(column_names)
+        uniq_mapped_idx = column_names.index("uniq_mapped")
+        multi_mapped_idx = column_names.index("multi_mapped")
+
+        ofh.write(header + "\n")
+
+        for (record_num, line) in enumerate(fh):
+            vals = line.rstrip("\n").split("\t")
+
+            if len(vals) < num_columns:
+                vals += [""] * (num_columns - len(vals))
+
+            uniq_mapped = parse_number(vals[uniq_mapped_idx])
+            multi_mapped = parse_number(vals[multi_mapped_idx])
+            if uniq_mapped is None or multi_mapped is None:
+                continue
+
+            total_reads = uniq_mapped + multi_mapped
+            if total_reads < min_total_reads:
+                continue
+
+            record = "\t".join([val if val != "" else "NA" for val in vals])
+
+            records.append((-total_reads, record_num, record))
+
+            if len(records) >= max_records_in_memory:
+                sorted_runs.append(write_sorted_run(records))
+                records = list()
+
+    records.sort()
+
+    if sorted_runs:
+        sorted_runs.append(write_sorted_run(records))
+        records = heapq.merge(*[read_sorted_run(run_fh) for run_fh in sorted_runs])
+
+    for (neg_total_reads, record_num, record) in records:
+        ofh.write(record + "\n")
+        num_records += 1
+
+    for run_fh in sorted_runs:
+        run_fh.close()
+
+    return num_records
+
+
+
+def parse_number(val):
+    """ returns the count as an int, or a float if it isn't integral text, or None if it's missing or not a number """
+
+    if not NUMBER_RE.match(val):
+        return None
+
+    try:
+        return int(val)
+    except ValueError:
+        return float(val)
+
+
+
+def filter_cancer_introns_file(cancer_introns_file, min_total_reads, output_file):
+
+    with open(output_file, "wt") as ofh:
+        return filter_cancer_introns(cancer_introns_file, min_total_reads, ofh)
+
+
+
+def write_sorted_run(records):
+
+    records.sort()
+
+    run_fh = tempfile.TemporaryFile(mode="w+t")
+    for (neg_total_reads, record_num, record) in records:
+        # repr round-trips the total, int or float
+        run_fh.write("{!r}\t{}\t{}\n".format(neg_total_reads, record_num, record))
+
+    run_fh.seek(0)
+
+    return run_fh
+
+
+
+def read_sorted_run(run_fh):
+
+    for line in run_fh:
+        (neg_total_reads, record_num, record) = line.rstrip("\n").split("\t", 2)
+        yield (parse_number(neg_total_reads), int(record_num), record)
 
 
 
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+import sys, os, re
+import json
+import mmap
+import struct
+import argparse
+import logging
+from array import array
+from splice_site_index import get_source_info, index_is_current, refresh_index_source_mtime
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+INDEX_MAGIC = b"CTATGSI2"
+INDEX_FILE_SUFFIX = ".idx"
+
+
+"""
+Gene id -> (chromosome, lend, rend) lookup for the ctat genome lib
+ref_annot.gtf.gene_spans, cached in a binary file alongside it that's
+memory-mapped as-is.  Gene ids are kept sorted (utf-8 byte order) in a
+blob with an offsets array, so a lookup is a binary search and nothing
+is decoded up front.
+
+On-disk layout:
+
+    magic (8 bytes) | header length (uint64, little endian) | json header |
+    zero padding to 8-byte boundary | gene id offsets (uint64 x N+1) |
+    lends (uint32 x N) | rends (uint32 x N) | chromosome ids (uint16 x N) |
+    gene ids blob
+
+"""
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="build the compiled gene spans index for a ctat genome lib", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("--ctat_genome_lib", dest="ctat_genome_lib", type=str, required=True, help="ctat genome lib build dir")
+
+    args = parser.parse_args()
+
+    load_gene_spans_index(os.path.join(args.ctat_genome_lib, "ref_annot.gtf.gene_spans"))
+
+    sys.exit(0)
+
+
+
+class GeneSpansIndex:
+
+    def __init__(self, chromosomes : list, gene_id_offsets, gene_ids_blob, chrom_ids, lends, rends):
+
+        self._chromosomes = chromosomes
+        self._gene_id_offsets = gene_id_offsets
+        self._gene_ids_blob = gene_ids_blob
+        self._chrom_ids = chrom_ids
+        self._lends = lends
+        self._rends = rends
+        self._num_genes = len(lends)
+
+
+    def __len__(self):
+        return self._num_genes
+
+
+    def _get_gene_id_bytes(self, i : int) -> bytes:
+        return bytes(self._gene_ids_blob[self._gene_id_offsets[i]:self._gene_id_offsets[i + 1]])
+
+
+    def get_gene_span(self, gene_id : str) -> tuple:
+        """ returns (chromosome, lend, rend) for the gene id, or None """
+
+        key = gene_id.encode()
+
+        # binary search of the sorted gene ids
+        (lo, hi) = (0, self._num_genes)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._get_gene_id_bytes(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo == self._num_genes or self._get_gene_id_bytes(lo) != key:
+            return None
+
+        return (self._chromosomes[self._chrom_ids[lo]], self._lends[lo], self._rends[lo])
+
+
+    @classmethod
+    def build_from_gene_spans(cls, gene_spans_file : str):
+
+        logger.info("-reading gene spans: {}".format(gene_spans_file))
+
+        chrom_to_id = dict()
+        gene_to_span = dict()
+
+        with open(gene_spans_file) as fh:
+            for line in fh:
+                vals = line.rstrip("\n").split("\t")
+                (gene_id, chrom, lend, rend) = vals[0:4]
+
+                if chrom not in chrom_to_id:
+                    chrom_to_id[chrom] = len(chrom_to_id)
+
+                # first entry wins, as with the gene spans table lookup
+                if gene_id not in gene_to_span:
+                    gene_to_span[gene_id] = (chrom_to_id[chrom], int(lend), int(rend))
+
+        chromosomes = sorted(chrom_to_id, key=lambda x: chrom_to_id[x])
+
+        gene_id_offsets = array('Q', [0])
+        gene_ids_blob = bytearray()
+        chrom_ids = array('H')
+        lends = array('I')
+        rends = array('I')
+
+        for (gene_id_bytes, gene_id) in sorted((gene_id.encode(), gene_id) for gene_id in gene_to_span):
+            (chrom_id, lend, rend) = gene_to_span[gene_id]
+            gene_ids_blob += gene_id_bytes
+            gene_id_offsets.append(len(gene_ids_blob))
+            chrom_ids.append(chrom_id)
+            lends.append(lend)
+            rends.append(rend)
+
+        return cls(chromosomes, gene_id_offsets, bytes(gene_ids_blob), chrom_ids, lends, rends)
+
+
+    def write(self, index_file : str, source_info : dict) -> None:
+
+        header = { 'byteorder' : sys.byteorder,
+                   'num_genes' : self._num_genes,
+                   'chromosomes' : self._chromosomes,
+                   'source' : source_info }
+
+        header_bytes = json.dumps(header).encode()
+        header_end = len(INDEX_MAGIC) + 8 + len(header_bytes)
+
+        # write to a temp file and rename into place, so concurrent readers never see a partial index
+        tmp_index_file = "{}.tmp.{}".format(index_file, os.getpid())
+        with open(tmp_index_file, 'wb') as ofh:
+            ofh.write(INDEX_MAGIC)
+            ofh.write(struct.pack("<Q", len(header_bytes)))
+            ofh.write(header_bytes)
+            ofh.write(b"\0" * (-header_end % 8))
+            ofh.write(array('Q', self._gene_id_offsets).tobytes())
+            ofh.write(array('I', self._lends).tobytes())
+            ofh.write(array('I', self._rends).tobytes())
+            ofh.write(array('H', self._chrom_ids).tobytes())
+            ofh.write(self._gene_ids_blob)
+
+        os.replace(tmp_index_file, index_file)
+
+
+    @classmethod
+    def read_header(cls, index_file : str) -> dict:
+
+        with open(index_file, 'rb') as fh:
+            if fh.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                return None
+            (header_len,) = struct.unpack("<Q", fh.read(8))
+            header = json.loads(fh.read(header_len).decode())
+
+        header_end = len(INDEX_MAGIC) + 8 + header_len
+        header['data_offset'] = header_end + (-header_end % 8)
+
+        return header
+
+
+    @classmethod
+    def load(cls, index_file : str, header : dict = None):
+
+        if header is None:
+            header = cls.read_header(index_file)
+
+        num_genes = header['num_genes']
+
+        gene_id_offsets_offset = header['data_offset']
+        lends_offset = gene_id_offsets_offset + 8 * (num_genes + 1)
+        rends_offset = lends_offset + 4 * num_genes
+        chrom_ids_offset = rends_offset + 4 * num_genes
+        gene_ids_blob_offset = chrom_ids_offset + 2 * num_genes
+
+        with open(index_file, 'rb') as fh:
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        mv = memoryview(mm)
+
+        return cls(header['chromosomes'],
+                   mv[gene_id_offsets_offset:lends_offset].cast('Q'),
+                   mv[gene_ids_blob_offset:],
+                   mv[chrom_ids_offset:gene_ids_blob_offset].cast('H'),
+                   mv[lends_offset:rends_offset].cast('I'),
+                   mv[rends_offset:chrom_ids_offset].cast('I'))
+
+
+
+def load_gene_spans_index(gene_spans_file : str, use_cache : bool = True) -> GeneSpansIndex:
+    """
+    Returns the gene spans index, memory-mapping the compiled index stored alongside the
+    gene spans file when it's current, and otherwise building it (and writing the
+    compiled index for subsequent use).
+    """
+
+    index_file = gene_spans_file + INDEX_FILE_SUFFIX
+
+    if use_cache and os.path.exists(index_file):
+        header = GeneSpansIndex.read_header(index_file)
+        if index_is_current(header, gene_spans_file):
+            if refresh_index_source_mtime(index_file, gene_spans_file, data_alignment=8):
+                header = GeneSpansIndex.read_header(index_file)
+            return GeneSpansIndex.load(index_file, header)
+        else:
+            logger.info("-compiled gene spans index {} is out of date with {}".format(index_file, gene_spans_file))
+
+    gene_spans_index = GeneSpansIndex.build_from_gene_spans(gene_spans_file)
+
+    if use_cache:
+        try:
+            gene_spans_index.write(index_file, get_source_info(gene_spans_file))
+            logger.info("-wrote compiled gene spans index: {}".format(index_file))
+        except OSError as e:
+            # ie. a read-only genome lib; just use the in-memory index.
+            logger.warning("-could not write compiled gene spans index {}: {}".format(index_file, str(e)))
+
+    return gene_spans_index
+
+
+
+if __name__ == '__main__':
+    main()
@@ -50,31 +50,55 @@ def main():
             logger.info("{} now registers as coordinate sorted".format(bam_file))
     
     
+    # regions are visited in coordinate order, so the outputs are written already sorted.
+    header = samfile.header.to_dict()
+    header.setdefault('HD', {'VN': '1.6'})['SO'] = 'coordinate'
+    
     introns_only_samfile_name = output_prefix + ".cancer_intron_reads.bam"
-    introns_only_samfile_obj = pysam.AlignmentFile(introns_only_samfile_name, 'wb', template=samfile)
+    introns_only_samfile_obj = pysam.AlignmentFile(introns_only_samfile_name, 'wb', header=header)
     gene_reads_samfile_name = output_prefix + ".gene_reads.bam"
-    gene_reads_samfile_obj = pysam.AlignmentFile(gene_reads_samfile_name, 'wb', template=samfile)
+    gene_reads_samfile_obj = pysam.AlignmentFile(gene_reads_samfile_name, 'wb', header=header)
 
 
 
-    for region, cancer_introns in regions_to_cancer_introns.items():
+    # overlapping viewports are merged so each read is decoded and written once.
+    merged_regions = merge_regions(regions_to_cancer_introns)
 
-        #print(region)
-        #print("\t" + str(cancer_introns))
+    for region_chr in sorted(merged_regions, key=lambda x: samfile.get_tid(x)):
 
-        # get the region reads
-        region_chr, region_coords = region.split(":")
-        region_lend, region_rend = region_coords.split("-")
+        chr_regions = merged_regions[region_chr]
+
+        # reads spanning two merged regions were already written from the earlier one.
+        prev_region_rend = None
         
-        gene_reads = samfile.fetch(region_chr, int(float(region_lend)), int(float(region_rend)))
-        for read in gene_reads:
-            gene_reads_samfile_obj.write(read)
+        for (region_idx, (region_lend, region_rend, cancer_introns)) in enumerate(chr_regions):
 
-            if read_has_cancer_intron(read, region_chr, cancer_introns):
-                #read.query_name = read.query_name + "-CI"
-                introns_only_samfile_obj.write(read)
+            gene_reads = samfile.fetch(region_chr, region_lend, region_rend)
+            for read in gene_reads:
+                if prev_region_rend is not None and read.reference_start < prev_region_rend:
+                    continue
+                
+                gene_reads_samfile_obj.write(read)
 
+                # the read is only visited here, so check it against the cancer introns
+                # of any following regions it extends into as well.
+                read_cancer_introns = cancer_introns
+                next_region_idx = region_idx + 1
+                while next_region_idx < len(chr_regions) and read.reference_end > chr_regions[next_region_idx][0]:
+                    read_cancer_introns = read_cancer_introns | chr_regions[next_region_idx][2]
+                    next_region_idx += 1
 
+                if read_has_cancer_intron(read, region_chr, read_cancer_introns):
+                    #read.query_name = read.query_name + "-CI"
+                    introns_only_samfile_obj.write(read)
+
+            prev_region_rend = region_rend
+
+    gene_reads_samfile_obj.close()
+    introns_only_samfile_obj.close()
+
+    pysam.index(gene_reads_samfile_name)
+    pysam.index(introns_only_samfile_name)
 
     sys.exit(0)
 
@@ -120,6 +144,39 @@ def parse_cancer_intron_regions(igv_introns_bed_filename):
     return regions_to_cancer_introns
 
 
+def merge_regions(regions_to_cancer_introns):
+    """
+    Merges overlapping or adjacent viewport regions, returning
+    { chr : [ (lend, rend, cancer_introns), ... ] } with each chromosome's
+    regions sorted by position and carrying the union of their cancer introns.
+    """
+
+    chr_to_regions = defaultdict(list)
+
+    for region, cancer_introns in regions_to_cancer_introns.items():
+        region_chr, region_coords = region.split(":")
+        region_lend, region_rend = region_coords.split("-")
+        chr_to_regions[region_chr].append( (int(float(region_lend)), int(float(region_rend)), cancer_introns) )
+
+    merged_regions = dict()
+
+    for region_chr, regions in chr_to_regions.items():
+        regions.sort(key=lambda x: (x[0], x[1]))
+
+        merged = list()
+        for (region_lend, region_rend, cancer_introns) in regions:
+            # closed intervals: abutting regions (lend == prev rend + 1) merge as well
+            if merged and region_lend <= merged[-1][1] + 1:
+                (prev_lend, prev_rend, prev_cancer_introns) = merged[-1]
+                merged[-1] = (prev_lend, max(prev_rend, region_rend), prev_cancer_introns | cancer_introns)
+            else:
+                merged.append( (region_lend, region_rend, set(cancer_introns)) )
+
+        merged_regions[region_chr] = merged
+
+    return merged_regions
+
+
 def is_coordinate_sorted_bam(samfile):
 
     # as per: https://www.programcreek.com/python/example/90607/pysam.sort
@@ -6,6 +6,10 @@ import logging
 import argparse
 from collections import defaultdict
 import subprocess
+import multiprocessing
+import hashlib
+import shutil
+from splice_site_index import SpliceSiteIndex, load_splice_site_index, pack_splice_site_key
 
 if sys.version_info[0] != 3:
     print("This script requires Python 3")
@@ -17,6 +21,13 @@ logger = logging.getLogger(__name__)
 
 utildir=os.path.dirname(os.path.realpath(__file__))
 
+INTRON_OCCURRENCE_COLUMNS = [
+    "class", "sample", "genes",
+    "Chromosome", "Start", "End",
+    "strandval", "intron_motif", "annot_status",
+    "unique_mappings", "multi_mappings", "max_spliced_align_overhang" ]
+
+
 
 def main():
 
@@ -26,6 +37,12 @@ def main():
     parser.add_argument("--tab_gz_files_list_file", dest="tab_gz_files_list_file", type=str, required=True, help="file containing lists of SJ.tab.gz files")
     parser.add_argument("--output_file_name", dest="output_file_name", type=str, required=True, help="name of output file")
     parser.add_argument("--db_class", dest="db_class", type=str, required=True, help="database class: ie. GTEx or TCGA")
+    parser.add_argument("--vectorized", dest="vectorized", action='store_true', default=False, help="bulk-load each SJ.out.tab with numpy/pandas instead of parsing it line by line")
+    parser.add_argument("--output_format", dest="output_format", type=str, required=False, default="tsv", choices=["tsv", "parquet"],
+                        help="tsv file, or parquet dataset directory partitioned by chromosome")
+    parser.add_argument("--workers", dest="workers", type=int, required=False, default=1, help="number of samples to process concurrently")
+    parser.add_argument("--shard_dir", dest="shard_dir", type=str, required=False, default=None,
+                        help="write each sample's records to a shard in this dir and merge them at the end; a rerun skips samples already completed")
     parser.add_argument("--debug", "-d", dest="DEBUG", action='store_true', default=False)
         
     args = parser.parse_args()
@@ -43,42 +60,44 @@ def main():
     targets_list_file = os.path.join(ctat_genome_lib, "ref_annot.gtf.mini.sortu")
     chr_intron_bounds = populate_intron_bounds(targets_list_file)
 
-    ofh = open(output_file_name, 'wt')
-    
-    column_header = [
-        "class", "sample", "genes",
-        "Chromosome", "Start", "End",
-        "strandval", "intron_motif", "annot_status",
-        "unique_mappings", "multi_mappings", "max_spliced_align_overhang" ]
-    
-    ofh.write("\t".join(column_header) + "\n")
-    
+    tasks = list()
     with open(tab_gz_files_list_file) as fh:
-        counter = 0
         for filename_pair in fh:
             filename_pair = filename_pair.rstrip()
+            if filename_pair == "":
+                continue
             splice_tab_gz_file, chimeric_out_introns_file = filename_pair.split("\t")
-            
-            counter += 1
-            logger.info("-[{}] processing {}".format(counter, splice_tab_gz_file))
-            
-            introns_dict = map_introns_from_splice_tab(splice_tab_gz_file, chr_intron_bounds)
+            tasks.append( (len(tasks) + 1, splice_tab_gz_file, chimeric_out_introns_file, db_class, args.vectorized, args.output_format) )
 
-            logger.info("-[{}] processing {}".format(counter, chimeric_out_introns_file))
-            introns_dict = supplement_introns_from_chimeric_junctions_file(chimeric_out_introns_file, introns_dict, chr_intron_bounds)
-            
-            ## output record:
-            sample_name = os.path.basename(splice_tab_gz_file).replace(".SJ.out.tab.gz", "")
-            for intron in introns_dict.values():
-                ofh.write("\t".join([db_class, sample_name, intron.genes,
-                                     intron.chromosome, intron.lend, intron.rend,
-                                     intron.strand,
-                                     intron.intron_motif, intron.annotated_flag,
-                                     str(intron.uniq_mapped), str(intron.multi_mapped),
-                                     intron.max_splice_overhang]) + "\n")
-                
-            
+    if args.shard_dir:
+        if args.output_format == "parquet" and os.path.exists(output_file_name):
+            # check before capturing rather than failing at the merge
+            raise RuntimeError("Error, parquet output directory {} already exists".format(output_file_name))
+
+        capture_sample_shards(tasks, args.shard_dir, chr_intron_bounds, targets_list_file, args.workers)
+        merge_sample_shards(tasks, args.shard_dir, output_file_name, args.output_format)
+
+        logger.info("Done.")
+        sys.exit(0)
+
+    ofh = open_intron_occurrence_output(output_file_name, args.output_format)
+
+    if args.workers > 1:
+        # samples are processed concurrently, but records are written in the list file order.
+        global _worker_chr_intron_bounds
+        _worker_chr_intron_bounds = chr_intron_bounds  # shared by forked workers
 
+        with multiprocessing.Pool(args.workers, initializer=_init_capture_worker, initargs=(targets_list_file,)) as pool:
+            for sample_records in pool.imap(_capture_sample_records_worker, tasks):
+                ofh.write(sample_records)
+
+    else:
+        for (counter, splice_tab_gz_file, chimeric_out_introns_file, db_class, vectorized, output_format) in tasks:
+            sample_records = capture_sample_records(counter, splice_tab_gz_file, chimeric_out_introns_file,
+                                                    chr_intron_bounds, db_class, vectorized, output_format)
+            ofh.write(sample_records)
+
+    ofh.close()
 
     logger.info("Done.")
     
@@ -86,7 +105,369 @@ def main():
     
 
 
+def open_intron_occurrence_output(output_file_name : str, output_format : str):
+
+    if output_format == "parquet":
+        ofh = IntronOccurrenceParquetWriter(output_file_name)
+    else:
+        ofh = open(output_file_name, 'wt')
+        ofh.write("\t".join(INTRON_OCCURRENCE_COLUMNS) + "\n")
+
+    return ofh
+
+
+
+def capture_sample_records(counter : int,
+                           splice_tab_gz_file : str,
+                           chimeric_out_introns_file : str,
+                           chr_intron_bounds : SpliceSiteIndex,
+                           db_class : str,
+                           vectorized : bool = False,
+                           output_format : str = "tsv"):
+    """
+    returns the intron occurrence table rows for the sample, as tsv text
+    or as per-chromosome columns for the parquet writer
+    """
+
+    logger.info("-[{}] processing {}".format(counter, splice_tab_gz_file))
+
+    if vectorized:
+        introns_dict = map_introns_from_splice_tab_vectorized(splice_tab_gz_file, chr_intron_bounds)
+    else:
+        introns_dict = map_introns_from_splice_tab(splice_tab_gz_file, chr_intron_bounds)
+
+    logger.info("-[{}] processing {}".format(counter, chimeric_out_introns_file))
+    introns_dict = supplement_introns_from_chimeric_junctions_file(chimeric_out_introns_file, introns_dict, chr_intron_bounds)
+
+    ## output record:
+    sample_name = os.path.basename(splice_tab_gz_file).replace(".SJ.out.tab.gz", "")
+
+    if output_format == "parquet":
+        return IntronOccurrenceParquetWriter.encode_sample_records(db_class, sample_name, introns_dict.values())
+
+    sample_records = list()
+    for intron in introns_dict.values():
+        sample_records.append("\t".join([db_class, sample_name, intron.genes,
+                                         intron.chromosome, str(intron.lend), str(intron.rend),
+                                         intron.strand,
+                                         str(intron.intron_motif), str(intron.annotated_flag),
+                                         str(intron.uniq_mapped), str(intron.multi_mapped),
+                                         str(intron.max_splice_overhang)]) + "\n")
+
+    return "".join(sample_records)
+
+
+
+## --workers process pool
+
+_worker_chr_intron_bounds = None
+
+
+def _init_capture_worker(targets_list_file : str) -> None:
+    global _worker_chr_intron_bounds
+    if _worker_chr_intron_bounds is None:
+        # not inherited from the parent (ie. spawn start method), so map the compiled index.
+        _worker_chr_intron_bounds = populate_intron_bounds(targets_list_file)
+
+
+def _capture_sample_records_worker(task : tuple):
+    (counter, splice_tab_gz_file, chimeric_out_introns_file, db_class, vectorized, output_format) = task
+    return capture_sample_records(counter, splice_tab_gz_file, chimeric_out_introns_file,
+                                  _worker_chr_intron_bounds, db_class, vectorized, output_format)
+
+
+
+## --shard_dir resumable capture
+
+SHARD_MANIFEST = "completed_shards.manifest"
+
+
+def get_shard_filename(task : tuple) -> str:
+    """ shard filename for the sample, unique to its input files and db class """
+
+    (counter, splice_tab_gz_file, chimeric_out_introns_file, db_class, vectorized, output_format) = task
+
+    sample_name = os.path.basename(splice_tab_gz_file).replace(".SJ.out.tab.gz", "")
+    checksum = hashlib.sha1("\t".join([splice_tab_gz_file, chimeric_out_introns_file, db_class]).encode()).hexdigest()
+
+    return "{}.{}.introns.tsv".format(sample_name, checksum[:12])
+
+
+def read_shard_manifest(shard_dir : str) -> set:
+    """ returns the shard filenames recorded as completed """
+
+    completed_shards = set()
+
+    manifest_file = os.path.join(shard_dir, SHARD_MANIFEST)
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as fh:
+            for line in fh:
+                if not line.endswith("\n"):
+                    # partial record from an interrupted run
+                    continue
+                shard_filename = line.rstrip("\n")
+                if os.path.exists(os.path.join(shard_dir, shard_filename)):
+                    completed_shards.add(shard_filename)
+
+    return completed_shards
+
+
+def capture_sample_shard(task : tuple, shard_dir : str, chr_intron_bounds : SpliceSiteIndex) -> str:
+    """ writes the sample's tsv records to its shard file, returning the shard filename """
+
+    (counter, splice_tab_gz_file, chimeric_out_introns_file, db_class, vectorized, output_format) = task
+
+    sample_records = capture_sample_records(counter, splice_tab_gz_file, chimeric_out_introns_file,
+                                            chr_intron_bounds, db_class, vectorized, "tsv")
+
+    shard_filename = get_shard_filename(task)
+    shard_file = os.path.join(shard_dir, shard_filename)
+
+    # write to a temp file and rename into place, so a shard is either complete or absent
+    tmp_shard_file = "{}.tmp.{}".format(shard_file, os.getpid())
+    with open(tmp_shard_file, 'wt') as ofh:
+        ofh.write(sample_records)
+        ofh.flush()
+        os.fsync(ofh.fileno())
+
+    os.replace(tmp_shard_file, shard_file)
+
+    return shard_filename
+
+
+def _capture_sample_shard_worker(task_info : tuple) -> str:
+    (task, shard_dir) = task_info
+    return capture_sample_shard(task, shard_dir, _worker_chr_intron_bounds)
+
+
+def capture_sample_shards(tasks : list,
+                          shard_dir : str,
+                          chr_intron_bounds : SpliceSiteIndex,
+                          targets_list_file : str,
+                          workers : int = 1) -> None:
+    """
+    Captures each sample not already recorded in the shard dir's manifest, appending
+    each to the manifest as soon as its shard is in place.
+    """
+
+    os.makedirs(shard_dir, exist_ok=True)
+
+    completed_shards = read_shard_manifest(shard_dir)
+
+    pending_tasks = [ task for task in tasks if get_shard_filename(task) not in completed_shards ]
+
+    logger.info("-{} of {} samples already captured in {}".format(len(tasks) - len(pending_tasks), len(tasks), shard_dir))
+
+    with open(os.path.join(shard_dir, SHARD_MANIFEST), 'at') as manifest_ofh:
+
+        def record_completed(shard_filename):
+            manifest_ofh.write(shard_filename + "\n")
+            manifest_ofh.flush()
+            os.fsync(manifest_ofh.fileno())
+
+        if workers > 1:
+            global _worker_chr_intron_bounds
+            _worker_chr_intron_bounds = chr_intron_bounds  # shared by forked workers
+
+            with multiprocessing.Pool(workers, initializer=_init_capture_worker, initargs=(targets_list_file,)) as pool:
+                # completion order, since the merge restores the list file order
+                for shard_filename in pool.imap_unordered(_capture_sample_shard_worker, [ (task, shard_dir) for task in pending_tasks ]):
+                    record_completed(shard_filename)
+
+        else:
+            for task in pending_tasks:
+                record_completed(capture_sample_shard(task, shard_dir, chr_intron_bounds))
+
+
+def merge_sample_shards(tasks : list, shard_dir : str, output_file_name : str, output_format : str) -> None:
+    """ merges the sample shards, in list file order, into the final output """
+
+    logger.info("-merging {} sample shards into {}".format(len(tasks), output_file_name))
+
+    tmp_output_file_name = "{}.tmp.{}".format(output_file_name, os.getpid())
+
+    ofh = open_intron_occurrence_output(tmp_output_file_name, output_format)
+
+    for task in tasks:
+        with open(os.path.join(shard_dir, get_shard_filename(task)), 'rt') as fh:
+            if output_format == "parquet":
+                ofh.write(IntronOccurrenceParquetWriter.encode_tsv_records(fh))
+            else:
+                shutil.copyfileobj(fh, ofh)
+
+    ofh.close()
+
+    os.replace(tmp_output_file_name, output_file_name)
+
+
+
+class IntronOccurrenceParquetWriter:
+    """
+    Writes the intron occurrence table as a parquet dataset partitioned by chromosome
+    (hive-style output_dir/Chromosome=<chr>/part-0.parquet), so readers can restrict
+    to chromosomes without scanning the others.
+
+    The class, sample, genes and strandval text columns are dictionary encoded, and
+    coordinates and counts are stored as integers.  Each write is converted to arrow
+    record batches right away, which are buffered per chromosome and written a row group
+    at a time.  Once more than max_buffered_rows are buffered across all chromosomes,
+    the largest chromosome buffers are written out early, so memory stays bounded
+    however many contigs are open.
+    """
+
+    def __init__(self, output_dir : str, row_group_size : int = 100000, max_buffered_rows : int = 1000000):
+
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._pa = pa
+        self._pq = pq
+
+        if os.path.exists(output_dir) and (not os.path.isdir(output_dir) or os.listdir(output_dir)):
+            raise RuntimeError("Error, parquet output directory {} already exists".format(output_dir))
+
+        os.makedirs(output_dir, exist_ok=True)
+
+        self._output_dir = output_dir
+        self._row_group_size = row_group_size
+        self._max_buffered_rows = max_buffered_rows
+
+        text_type = pa.dictionary(pa.int32(), pa.string())
+
+        # Chromosome is stored in the partition path
+        self._schema = pa.schema([ ("class", text_type),
+                                   ("sample", text_type),
+                                   ("genes", text_type),
+                                   ("Start", pa.int64()),
+                                   ("End", pa.int64()),
+                                   ("strandval", text_type),
+                                   ("intron_motif", pa.int8()),
+                                   ("annot_status", pa.int8()),
+                                   ("unique_mappings", pa.int32()),
+                                   ("multi_mappings", pa.int32()),
+                                   ("max_spliced_align_overhang", pa.int32()) ])
+
+        self._chrom_batches = dict()
+        self._chrom_num_rows = dict()
+        self._num_buffered_rows = 0
+        self._chrom_writers = dict()
+
+
+    @staticmethod
+    def encode_sample_records(db_class : str, sample_name : str, introns) -> dict:
+        """ returns chromosome -> list of column value lists (in schema order) for the sample's introns """
+
+        chrom_columns = dict()
+
+        for intron in introns:
+            columns = chrom_columns.get(intron.chromosome, None)
+            if columns is None:
+                columns = chrom_columns[intron.chromosome] = [ list() for i in range(11) ]
+
+            columns[2].append(intron.genes)
+            columns[3].append(intron.lend)
+            columns[4].append(intron.rend)
+            columns[5].append(intron.strand)
+            columns[6].append(intron.intron_motif)
+            columns[7].append(intron.annotated_flag)
+            columns[8].append(intron.uniq_mapped)
+            columns[9].append(intron.multi_mapped)
+            columns[10].append(intron.max_splice_overhang)
+
+        for columns in chrom_columns.values():
+            num_rows = len(columns[2])
+            columns[0] = [db_class] * num_rows
+            columns[1] = [sample_name] * num_rows
+
+        return chrom_columns
+
+
+    @staticmethod
+    def encode_tsv_records(lines) -> dict:
+        """ same as encode_sample_records(), but from intron occurrence tsv lines """
+
+        chrom_columns = dict()
+
+        for line in lines:
+            vals = line.rstrip("\n").split("\t")
+
+            columns = chrom_columns.get(vals[3], None)
+            if columns is None:
+                columns = chrom_columns[vals[3]] = [ list() for i in range(11) ]
+
+            columns[0].append(vals[0])
+            columns[1].append(vals[1])
+            columns[2].append(vals[2])
+            columns[3].append(int(vals[4]))
+            columns[4].append(int(vals[5]))
+            columns[5].append(vals[6])
+            for i in range(6, 11):
+                columns[i].append(int(vals[i+1]))
+
+        return chrom_columns
+
+
+    def write(self, chrom_columns : dict) -> None:
+
+        pa = self._pa
+
+        for (chrom, columns) in chrom_columns.items():
+            num_rows = len(columns[2])
+            if num_rows == 0:
+                continue
+
+            batch = pa.RecordBatch.from_arrays([ pa.array(column, type=field.type) for (column, field) in zip(columns, self._schema) ],
+                                               schema=self._schema)
+
+            self._chrom_batches.setdefault(chrom, list()).append(batch)
+            self._chrom_num_rows[chrom] = self._chrom_num_rows.get(chrom, 0) + num_rows
+            self._num_buffered_rows += num_rows
+
+            if self._chrom_num_rows[chrom] >= self._row_group_size:
+                self._flush(chrom)
+
+        while self._num_buffered_rows > self._max_buffered_rows:
+            self._flush(max(self._chrom_num_rows, key=self._chrom_num_rows.get))
+
+
+    def _flush(self, chrom : str) -> None:
+
+        batches = self._chrom_batches.pop(chrom, None)
+        if not batches:
+            return
+
+        self._num_buffered_rows -= self._chrom_num_rows.pop(chrom)
+
+        writer = self._chrom_writers.get(chrom, None)
+        if writer is None:
+            from urllib.parse import quote
+            partition_dir = os.path.join(self._output_dir, "Chromosome={}".format(quote(chrom, safe="")))
+            os.makedirs(partition_dir, exist_ok=True)
+            writer = self._chrom_writers[chrom] = self._pq.ParquetWriter(os.path.join(partition_dir, "part-0.parquet"), self._schema)
+
+        writer.write_table(self._pa.Table.from_batches(batches, schema=self._schema))
+
+
+    def close(self) -> None:
+
+        for chrom in list(self._chrom_batches):
+            self._flush(chrom)
+
+        for writer in self._chrom_writers.values():
+            writer.close()
+
+
+
 class Intron:
+    """
+    Intron feature and read support for a single sample.
+
+    Slotted with integer fields, since per-sample intron dicts hold hundreds of thousands of these.
+    (intron_motif, annotated_flag and max_splice_overhang are -1 when unknown, ie. from chimeric reads.)
+    """
+
+    __slots__ = ("chromosome", "lend", "rend", "strand", "intron_motif", "annotated_flag",
+                 "uniq_mapped", "multi_mapped", "max_splice_overhang", "genes")
 
     def __init__(self, chromosome, lend, rend, strand, intron_motif, annotated_flag,
                  uniq_mapped, multi_mapped, max_splice_overhang, genes):
@@ -103,12 +484,12 @@ class Intron:
         self.genes = genes
 
     def __repr__(self):
-        return("^".join([self.chromosome, self.lend, self.rend, str(self.uniq_mapped), str(self.multi_mapped)]))
+        return("^".join([self.chromosome, str(self.lend), str(self.rend), str(self.uniq_mapped), str(self.multi_mapped)]))
 
         
 
 def map_introns_from_splice_tab(tab_filename : str,
-                                chr_intron_bounds : dict) -> dict:
+                                chr_intron_bounds : SpliceSiteIndex) -> dict:
         
     
     """  from the STAR manual
@@ -145,6 +526,9 @@ def map_introns_from_splice_tab(tab_filename : str,
 
     introns_dict = dict()
 
+    get_chromosome_id = chr_intron_bounds.get_chromosome_id
+    get_genes_by_key = chr_intron_bounds.get_genes_by_key
+
     fh = None
     if tab_filename[-3:] == ".gz":
         fh = gz.open(tab_filename, 'rt')
@@ -156,56 +540,156 @@ def map_introns_from_splice_tab(tab_filename : str,
         line = line.rstrip()
         vals = line.split("\t")
         chr = vals[0]
-        intron_lend = vals[1]
-        intron_rend = vals[2]
 
-        strand = '+' if vals[3] == "1" else '-'
+        chrom_id = get_chromosome_id(chr)
+        if chrom_id is None:
+            # no annotated splice sites on this chromosome
+            continue
+
+        lend = int(vals[1])
+        rend = int(vals[2])
+
+        if vals[3] == "1":
+            strand = '+'
+            strand_bit = 0
+        else:
+            strand = '-'
+            strand_bit = 1
+
+        # packed splice site keys, as per splice_site_index.pack_splice_site_key()
+        site_key_base = (chrom_id << 33) | strand_bit
+
+        genesA = get_genes_by_key(site_key_base | (lend << 1))
+        if genesA is None:
+            continue
+
+        genesB = get_genes_by_key(site_key_base | (rend << 1))
+        if genesB is None:
+            continue
 
-        intron_motif = vals[4]
-        annotated_flag = vals[5]
-        uniq_mapped = vals[6]
-        multi_mapped = vals[7]
-        max_splice_overhang = vals[8]
+        intron_motif = int(vals[4])
+        annotated_flag = int(vals[5])
+        uniq_mapped = int(vals[6])
+        multi_mapped = int(vals[7])
+        max_splice_overhang = int(vals[8])
 
+        if genesA == genesB:
+            genes_entry = ",".join(genesA)
+        else:
+            genes_entry = ",".join(genesA) + "--" + ",".join(genesB)
+
+        intron_obj = Intron(chr, lend, rend, strand,
+                            intron_motif, annotated_flag, uniq_mapped,
+                            multi_mapped, max_splice_overhang, genes_entry)
+
+        introns_dict[(chr, lend, rend)] = intron_obj
+
+    fh.close()
+    
+    return introns_dict
 
-        intron_tok_A = "{}:{}:{}".format(chr, intron_lend, strand)
-        intron_tok_B = "{}:{}:{}".format(chr, intron_rend, strand)
 
-        genesA = None
-        genesB = None
 
-        if intron_tok_A in chr_intron_bounds:
-            genesA = chr_intron_bounds[intron_tok_A]
+def map_introns_from_splice_tab_vectorized(tab_filename : str,
+                                           chr_intron_bounds : SpliceSiteIndex) -> dict:
+    """
+    Same result as map_introns_from_splice_tab(), but the SJ.out.tab file is read in bulk
+    into typed columns and both intron ends are joined against the splice site index
+    with a vectorized binary search. Intron objects are only created for the rows
+    having annotated splice sites at both ends.
+    """
 
-        if intron_tok_B in chr_intron_bounds:
-            genesB = chr_intron_bounds[intron_tok_B]
+    import numpy as np
+    import pandas as pd
 
-        if genesA and genesB:
+    introns_dict = dict()
 
-            if genesA == genesB:
-                genes_entry = ",".join(list(genesA))
+    index_keys = np.frombuffer(chr_intron_bounds.get_keys(), dtype=np.uint64)
+    index_gene_set_ids = np.frombuffer(chr_intron_bounds.get_gene_set_ids(), dtype=np.uint32)
+    num_index_keys = len(index_keys)
+    if num_index_keys == 0:
+        return introns_dict
+
+    column_names = ["chr", "lend", "rend", "strand", "intron_motif", "annotated_flag",
+                    "uniq_mapped", "multi_mapped", "max_splice_overhang"]
+    column_types = { "chr" : str, "lend" : np.int64, "rend" : np.int64, "strand" : str, "intron_motif" : np.int64,
+                     "annotated_flag" : np.int64, "uniq_mapped" : np.int64, "multi_mapped" : np.int64,
+                     "max_splice_overhang" : np.int64 }
+
+    try:
+        sj = pd.read_csv(tab_filename, sep="\t", header=None, names=column_names, usecols=range(9),
+                         dtype=column_types, na_filter=False, compression='gzip' if tab_filename[-3:] == ".gz" else None)
+    except pd.errors.EmptyDataError:
+        return introns_dict
+
+    if len(sj) == 0:
+        return introns_dict
+
+    ## interned chromosome ids, -1 if no splice sites on that chromosome
+    chrom_codes, chroms = pd.factorize(sj["chr"])
+    chrom_code_to_id = np.full(len(chroms), -1, dtype=np.int64)
+    for (i, chrom) in enumerate(chroms):
+        chrom_id = chr_intron_bounds.get_chromosome_id(chrom)
+        if chrom_id is not None:
+            chrom_code_to_id[i] = chrom_id
+    chrom_ids = chrom_code_to_id[chrom_codes]
+
+    lend = sj["lend"].to_numpy()
+    rend = sj["rend"].to_numpy()
+    plus_strand = (sj["strand"] == "1").to_numpy()
+
+    # packed splice site keys, as per splice_site_index.pack_splice_site_key()
+    site_key_base = (np.maximum(chrom_ids, 0).astype(np.uint64) << np.uint64(33)) | (~plus_strand).astype(np.uint64)
+    keys_A = site_key_base | (lend.astype(np.uint64) << np.uint64(1))
+    keys_B = site_key_base | (rend.astype(np.uint64) << np.uint64(1))
+
+    idx_A = np.minimum(np.searchsorted(index_keys, keys_A), num_index_keys - 1)
+    idx_B = np.minimum(np.searchsorted(index_keys, keys_B), num_index_keys - 1)
+
+    keep = (chrom_ids >= 0) & (index_keys[idx_A] == keys_A) & (index_keys[idx_B] == keys_B)
+
+    rows = sj[keep]
+    gene_set_ids_A = index_gene_set_ids[idx_A[keep]].tolist()
+    gene_set_ids_B = index_gene_set_ids[idx_B[keep]].tolist()
+
+    ## only now materialize the gene text, once per distinct pair of splice site gene sets
+    genes_entries = dict()
+
+    for (chr, lend, rend, strandval, intron_motif, annotated_flag,
+         uniq_mapped, multi_mapped, max_splice_overhang,
+         gene_set_id_A, gene_set_id_B) in zip(rows["chr"].tolist(), rows["lend"].tolist(), rows["rend"].tolist(),
+                                              rows["strand"].tolist(), rows["intron_motif"].tolist(),
+                                              rows["annotated_flag"].tolist(), rows["uniq_mapped"].tolist(),
+                                              rows["multi_mapped"].tolist(), rows["max_splice_overhang"].tolist(),
+                                              gene_set_ids_A, gene_set_ids_B):
+
+        genes_entry = genes_entries.get((gene_set_id_A, gene_set_id_B), None)
+        if genes_entry is None:
+            if gene_set_id_A == gene_set_id_B:
+                genes_entry = ",".join(chr_intron_bounds.get_gene_set(gene_set_id_A))
             else:
-                genes_entry = ",".join(list(genesA)) + "--" + ",".join(list(genesB))
+                genes_entry = (",".join(chr_intron_bounds.get_gene_set(gene_set_id_A)) + "--" +
+                               ",".join(chr_intron_bounds.get_gene_set(gene_set_id_B)))
+            genes_entries[(gene_set_id_A, gene_set_id_B)] = genes_entry
 
+        strand = '+' if strandval == "1" else '-'
 
-            intron_tok = "{}:{}-{}".format(chr, intron_lend, intron_rend)
-            intron_obj = Intron(chr, intron_lend, intron_rend, strand,
-                                intron_motif, annotated_flag, int(uniq_mapped),
-                                int(multi_mapped), max_splice_overhang, genes_entry)
+        intron_obj = Intron(chr, lend, rend, strand,
+                            intron_motif, annotated_flag, uniq_mapped,
+                            multi_mapped, max_splice_overhang, genes_entry)
 
-            introns_dict[intron_tok] = intron_obj
+        introns_dict[(chr, lend, rend)] = intron_obj
 
-    fh.close()
-    
     return introns_dict
 
 
 
 def supplement_introns_from_chimeric_junctions_file(chimeric_out_introns_file : str,
                                                     introns_dict : dict,
-                                                    chr_intron_bounds : dict) -> dict:
+                                                    chr_intron_bounds : SpliceSiteIndex) -> dict:
+    """ adds read support from the introns file written by STAR_chimeric_junctions_to_introns.pl """
 
-    with open(chimeric_out_introns_file) as fh:
+    def parse_intron_counts(fh):
         for line in fh:
             if line[0] == "#":
                 continue
@@ -217,80 +701,82 @@ def supplement_introns_from_chimeric_junctions_file(chimeric_out_introns_file :
             if len(vals) != 3:
                 raise RuntimeError("Error, couldn't parse line in to three fields: {}".format(line))
             intron, uniq_map, multi_map = vals
-            uniq_map = int(uniq_map)
-            multi_map = int(multi_map)
-            if intron in introns_dict:
-                intron_obj = introns_dict[intron]
-                intron_obj.uniq_mapped += uniq_map
-                intron_obj.multi_mapped += multi_map
-                logger.debug("-supplementing existing intron: " + str(intron_obj) + " with uniq: {}, multi: {}".format(uniq_map, multi_map))
-            else:
-                # see if intron has known splice sites.
-                intron_obj = try_make_intron_obj(intron, chr_intron_bounds, uniq_map, multi_map)
-                if intron_obj is not None:
-                    introns_dict[intron] = intron_obj
-                    logger.debug("-supplementing NEW intron: " + str(intron_obj))
-            
+
+            chr, coords = intron.rsplit(':', 1)
+            lend, rend = coords.split('-')
+
+            yield ((chr, int(lend), int(rend)), int(uniq_map), int(multi_map))
+
+    with open(chimeric_out_introns_file) as fh:
+        introns_dict = supplement_introns_from_chimeric_junctions(parse_intron_counts(fh), introns_dict, chr_intron_bounds)
+
     return introns_dict
 
 
 
-def try_make_intron_obj(intron : str, chr_intron_bounds : dict, uniq_map : int, multi_map : int) -> Intron:
-    chr, coords = intron.split(':')
-    lend, rend = coords.split('-')
+def supplement_introns_from_chimeric_junctions(intron_counts,
+                                               introns_dict : dict,
+                                               chr_intron_bounds : SpliceSiteIndex) -> dict:
+    """
+    intron_counts is an iterable of ((chromosome, lend, rend), uniq_map, multi_map),
+    ie. as yielded by chimeric_junctions_to_introns.map_chimeric_reads_to_introns()
+    """
 
-    for orient in ('+', '-'):
-        left_splice_token = ":".join([chr, lend, orient])
-        right_splice_token = ":".join([chr, rend, orient])
+    for (intron_key, uniq_map, multi_map) in intron_counts:
 
-        if (left_splice_token in chr_intron_bounds and
-            right_splice_token in chr_intron_bounds):
+        if intron_key in introns_dict:
+            intron_obj = introns_dict[intron_key]
+            intron_obj.uniq_mapped += uniq_map
+            intron_obj.multi_mapped += multi_map
+            logger.debug("-supplementing existing intron: " + str(intron_obj) + " with uniq: {}, multi: {}".format(uniq_map, multi_map))
+        else:
+            # see if intron has known splice sites.
+            intron_obj = try_make_intron_obj(intron_key, chr_intron_bounds, uniq_map, multi_map)
+            if intron_obj is not None:
+                introns_dict[intron_key] = intron_obj
+                logger.debug("-supplementing NEW intron: " + str(intron_obj))
 
-            genes_left = chr_intron_bounds[left_splice_token]
-            genes_right = chr_intron_bounds[right_splice_token]
-            genes = genes_left.union(genes_right)
-            genes = ",".join(list(genes))
-            
-            intron_obj = Intron(chr, lend, rend, orient, "-1", "1", uniq_map, multi_map, "-1", genes)
+    return introns_dict
 
-            return intron_obj
 
-    # no intron could be created
-    return None
 
+def try_make_intron_obj(intron_key : tuple, chr_intron_bounds : SpliceSiteIndex, uniq_map : int, multi_map : int) -> Intron:
+    """ intron_key is the (chromosome, lend, rend) tuple used to key the introns dict """
 
+    chr, lend, rend = intron_key
 
-def populate_intron_bounds(targets_list_file : str) -> dict:
+    chrom_id = chr_intron_bounds.get_chromosome_id(chr)
+    if chrom_id is None:
+        return None
 
-    logger.info("-reading targets list: {}".format(targets_list_file))
-    
-    chr_intron_bounds = defaultdict(set)
+    for (orient, strand_bit) in (('+', 0), ('-', 1)):
 
-    with open(targets_list_file) as fh:
-        for line in fh:
-            line = line.rstrip()
-            vals = line.split("\t")
-            assert(len(vals) >= 9)
-            chr = vals[0]
-            lend = int(vals[3])
-            rend = int(vals[4])
-            orient = vals[6]
-            info = vals[8]
-
-            m = re.search("gene_id \"([^\"]+)\"", info)
-            if m:
-                gene_id = m.group(1)
-            else:
-                raise RuntimeError("Error, no gene id extracted from line: {}".format(line))
+        genes_left = chr_intron_bounds.get_genes_by_key(pack_splice_site_key(chrom_id, lend, strand_bit))
+        genes_right = chr_intron_bounds.get_genes_by_key(pack_splice_site_key(chrom_id, rend, strand_bit))
+
+        if genes_left and genes_right:
 
-            lend_token = ":".join([chr, str(lend-1), orient])
-            rend_token = ":".join([chr, str(rend+1), orient])
+            genes = sorted(set(genes_left).union(genes_right))
+            genes = ",".join(genes)
             
-            chr_intron_bounds[lend_token].add(gene_id)
-            chr_intron_bounds[rend_token].add(gene_id)
+            intron_obj = Intron(chr, lend, rend, orient, -1, 1, uniq_map, multi_map, -1, genes)
+
+            return intron_obj
+
+    # no intron could be created
+    return None
+
+
 
+def populate_intron_bounds(targets_list_file : str, use_index_cache : bool = True) -> SpliceSiteIndex:
+    """
+    Returns the splice site to genes index for the targets list file.
+
+    The index is compiled to targets_list_file + ".splice_sites.idx" on first use and
+    memory-mapped on subsequent runs, as long as it's current with the targets list.
+    """
 
-    return chr_intron_bounds
+    return load_splice_site_index(targets_list_file, use_cache=use_index_cache)
 
 
 
@@ -7,6 +7,7 @@ import math
 import argparse
 import pandas as pd
 import logging
+from gene_spans_index import load_gene_spans_index
 logging.basicConfig(level=logging.INFO, 
                     format='%(asctime)s : %(levelname)s : %(message)s',
                     datefmt='%H:%M:%S')
@@ -20,32 +21,25 @@ def split_intron(dt):
     split1["END"] = pd.to_numeric(split2[1])
     split1.drop(columns =[1], inplace = True) 
     split1.rename({0: 'CHR'}, axis=1, inplace=True)
-    split1["CHR"] = split1["CHR"].apply(str)
-    split1.set_index(['CHR', 'START', 'END'])
+    split1["CHR"] = split1["CHR"].astype(str)
 
     return(split1)
 
 
-def combineColumns(df, cols):
-    df = df[cols].apply(lambda row: ';'.join(row.values.astype(str)), axis=1)
-    return(df)
-
-
 
 class BEDfile:
 
-    def __init__(self, args):
+    def __init__(self, all_introns_file, cancer_introns_file, genome_lib_dir, output_bed):
 
         import warnings
-        self.args = args
 
         #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-        # Seperate Arguments and add to Object 
+        # Add Arguments to Object 
         #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-        self.all_introns_file = args.all_introns         ## example: ../testing/__expected_output/ctat.introns.b38
-        self.cancer_introns_file = args.cancer_introns   ## example:  ../testing/__expected_output/ctat.cancer.introns.b38
-        self.genome_lib_dir = args.genome_lib_dir        ## for b38, use: /seq/RNASEQ/__ctat_genome_lib_building/Apr2020/GRCh38_gencode_v22_CTAT_lib_Apr032020.plug-n-play/ctat_genome_lib_build_dir
-        self.output_bed = args.output_bed
+        self.all_introns_file = all_introns_file         ## example: ../testing/__expected_output/ctat.introns.b38
+        self.cancer_introns_file = cancer_introns_file   ## example:  ../testing/__expected_output/ctat.cancer.introns.b38
+        self.genome_lib_dir = genome_lib_dir             ## for b38, use: /seq/RNASEQ/__ctat_genome_lib_building/Apr2020/GRCh38_gencode_v22_CTAT_lib_Apr032020.plug-n-play/ctat_genome_lib_build_dir
+        self.output_bed = output_bed
 
     def createBedFile(self):
         logger.info(" Creating the BED File.")
@@ -60,86 +54,53 @@ class BEDfile:
         
         # set up the bed file 
         bed_file = split_intron(dt)
-        cancer_local = split_intron(cancer_dt)
         # uniquely_mapped=74;multi_mapped=0;gene=EGFR;viewport=chr7:55013358-55207969;TCGA=GBM:28:16.57,LGG:9:1.73,STAD:1:0.25,HNSC:1:0.18;GTEx=NA;variant_name=EGFRvIII;display_in_table=true     74      +
         
         #~~~~~~~~~~~~~~~~~~~~~
         # Create the viewport
         #~~~~~~~~~~~~~~~~~~~~~
         gene_spans = os.path.join(self.genome_lib_dir, "ref_annot.gtf.gene_spans")
-        gene_spans_df = pd.read_table(gene_spans, header = None)
+        gene_spans_index = load_gene_spans_index(gene_spans)
 
-        viewport = list()
-        gene_text = list()
-        get_viewport_ranges(dt, gene_spans_df, viewport, gene_text) 
+        (viewport, gene_text) = get_viewport_ranges(dt['genes'], gene_spans_index)
+        viewport = pd.Series(viewport, index=dt.index, dtype=object)
+        gene_text = pd.Series(gene_text, index=dt.index, dtype=object)
         
         #~~~~~~~~~~~~~~~~~~~~~
         # Make the name column for the bed file 
-        # Put the columns together
+        # (whole-column string concatenation)
         #~~~~~~~~~~~~~~~~~~~~~
-        dt['uniq_mapped_str']  = 'uniquely_mapped=' + dt['uniq_mapped'].astype(str)
-        dt['multi_mapped_str'] = 'multi_mapped=' + dt['multi_mapped'].astype(str)
-        dt['gene']             = ['gene=' + gene for gene in gene_text]
-        
-        
-        dt['viewport'] = viewport
-        
-        # concatenate to make name column
-        name = dt['uniq_mapped_str'] + ";" + dt['multi_mapped_str'] + ";" + dt['gene']
-        
-        # insert them into the bed file 
-        bed_file.insert(loc = 3, column = "NAME", value = name)
-        bed_file.insert(loc = 4, column = "total_mapped", value = dt['uniq_mapped'] + dt['multi_mapped'])
-        bed_file.insert(loc = 5, column = "strand", value = dt['strand'])
-        bed_file = bed_file.assign(viewport="viewport=" + dt['viewport']) 
+        name = ('uniquely_mapped=' + dt['uniq_mapped'].astype(str)
+                + ';multi_mapped=' + dt['multi_mapped'].astype(str)
+                + ';gene=' + gene_text)
         
         #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
         #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
         # Edit the Cancer introns 
         #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
         #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-        # covert the dataframe into a series 
-        ## The Keys to use, (column names)
-        keys = list(cancer_local.columns.values)
-        bed_file = bed_file.set_index(keys)
-        i1 = bed_file.index
-        cancer_local = cancer_local.set_index(keys)
-        i2 = cancer_local.index
-        
-        # ~ means not in
-        cancer_temp_df = bed_file.loc[i2] 
-        temp_df = pd.DataFrame()
-
         # convert NaN'ss into NA's
         cancer_dt = cancer_dt.fillna('NA')
-        # place commas after spaces for igv
-        cancer_dt['GTEx_sample_counts'] = cancer_dt['GTEx_sample_counts'].str.replace(",", ", ")
-        cancer_dt['TCGA_sample_counts'] = cancer_dt['TCGA_sample_counts'].str.replace(",", ", ")
 
+        # cancer intron annotation text, keyed by intron.
+        # (place commas after spaces for igv)
+        cancer_annot = (';TCGA=' + cancer_dt['TCGA_sample_counts'].str.replace(",", ", ").astype(str)
+                        + ';GTEx=' + cancer_dt['GTEx_sample_counts'].str.replace(",", ", ").astype(str)
+                        + ';variant_name=' + cancer_dt['variant_name'].astype(str))
+        cancer_annot.index = cancer_dt['intron']
+        cancer_annot = cancer_annot[ ~cancer_annot.index.duplicated() ]
 
-        # Add the new columns into the temp dataframe for updating  bed file.
-        temp_df['NAME'] = cancer_temp_df["NAME"]
-        temp_df['TCGA'] = list('TCGA=' + cancer_dt['TCGA_sample_counts'].astype(str))
-        temp_df['GTEx'] = list('GTEx=' + cancer_dt['GTEx_sample_counts'].astype(str))
-        temp_df['variant_name'] = list('variant_name=' + cancer_dt['variant_name'].astype(str))
-        
-        # combine the new columns into one, then replace NAME with the newly created column 
-        cols = ["NAME", "TCGA", "GTEx", "variant_name"]
-        replace_NAME = combineColumns(df = temp_df, cols = cols)
-        cancer_temp_df = cancer_temp_df.assign(NAME=replace_NAME)
-
-
-        # Now update the existing be file to include the new NAME changes for the cancer introns 
-        bed_file.update(cancer_temp_df)
-
-        # tack on viewport to just the cancer intron names:
-        cancer_temp_df = bed_file.loc[i1[i1.isin(i2)]]
-        cols = ["NAME", "viewport"]
-        replace_NAME = combineColumns(df = cancer_temp_df, cols = cols)
-        cancer_temp_df = cancer_temp_df.assign(NAME=replace_NAME) 
-        bed_file.update(cancer_temp_df)
-        bed_file = bed_file.drop('viewport', axis=1)
-        bed_file = bed_file.reset_index()
+        # tack the annotations, then the viewport, onto just the cancer intron names:
+        is_cancer_intron = dt['intron'].isin(cancer_annot.index)
+        name[is_cancer_intron] = (name[is_cancer_intron]
+                                  + dt.loc[is_cancer_intron, 'intron'].map(cancer_annot)
+                                  + ';viewport=' + viewport[is_cancer_intron])
+
+        # insert them into the bed file 
+        bed_file.insert(loc = 3, column = "NAME", value = name)
+        bed_file.insert(loc = 4, column = "total_mapped", value = dt['uniq_mapped'] + dt['multi_mapped'])
+        bed_file.insert(loc = 5, column = "strand", value = dt['strand'])
+        bed_file = bed_file.reset_index(drop=True)
         
         # Sort the BED File 
         #bed_file.sort_values(by=['START','END'], inplace=True, ascending=True)
@@ -161,68 +122,69 @@ class BEDfile:
         ofh.close()
                     
     
-def get_viewport_ranges(dt, gene_spans_df, viewport_list, gene_text_list):
+def get_viewport_ranges(dt_genes, gene_spans_index):
+    """
+    returns the (viewport, gene text) lists for the gene lists in dt_genes,
+    computed once per distinct gene list
+    """
 
-    dt_genes = dt['genes']
+    gene_list_to_viewport = { genes : construct_viewport(genes, gene_spans_index) for genes in dt_genes.unique() }
 
-    gene_list_to_viewport_memoize = dict()
+    viewport_list = [ gene_list_to_viewport[genes][0] for genes in dt_genes ]
+    gene_text_list = [ gene_list_to_viewport[genes][1] for genes in dt_genes ]
 
-    def construct_viewport(genes):
+    return (viewport_list, gene_text_list)
 
-        gene_syms = list()
 
-        if genes in gene_list_to_viewport_memoize:
-            ## shortcut in case weve already processed this gene list
+def construct_viewport(genes, gene_spans_index):
 
-            viewport, gene_text = gene_list_to_viewport_memoize[genes]
-            viewport_list.append(viewport)
-            gene_text_list.append(gene_text)
+    gene_syms = list()
 
-            return
-        
-        lend_range = list()
-        rend_range = list()
-        
-        chromosome = None
-        genelist = re.split("--|,", genes)
-        
-        for gene in genelist:
-            (sym, ensg) = gene.split("^")
+    lend_range = list()
+    rend_range = list()
 
-            if sym not in gene_syms:
-                gene_syms.append(sym)
-    
-            # look up coordinates based on ensg id
-            gene_coord_info = gene_spans_df[ gene_spans_df[0] == ensg ]
+    chromosome = None
+    genelist = re.split("--|,", genes)
 
-            chr = gene_coord_info.iloc[0,1]
-            lend = gene_coord_info.iloc[0,2]
-            rend = gene_coord_info.iloc[0,3]
+    for gene in genelist:
+        (sym, ensg) = gene.split("^")
 
-            if chromosome is not None:
-                assert(chr == chromosome)
+        if sym not in gene_syms:
+            gene_syms.append(sym)
 
-            chromosome = chr
-            lend_range.append(lend)
-            rend_range.append(rend)
+        # look up coordinates based on ensg id
+        gene_coord_info = gene_spans_index.get_gene_span(ensg)
+        if gene_coord_info is None:
+            raise RuntimeError("Error, no gene span found for gene: {}".format(ensg))
 
-        lend_range = sorted(lend_range)
-        rend_range = sorted(rend_range)
+        (chr, lend, rend) = gene_coord_info
 
-        min_lend = lend_range[0]
-        max_rend = rend_range[len(rend_range)-1]
+        if chromosome is not None:
+            assert(chr == chromosome)
 
-        viewport_str = "{}:{}-{}".format(chromosome, min_lend, max_rend)
-        gene_text = " ".join(gene_syms)
-    
-        gene_list_to_viewport_memoize[genes] = (viewport_str, gene_text)
-                
-        viewport_list.append(viewport_str)
-        gene_text_list.append(gene_text)
+        chromosome = chr
+        lend_range.append(lend)
+        rend_range.append(rend)
 
+    min_lend = min(lend_range)
+    max_rend = max(rend_range)
+
+    viewport_str = "{}:{}-{}".format(chromosome, min_lend, max_rend)
+    gene_text = " ".join(gene_syms)
+
+    return (viewport_str, gene_text)
+
+
+def make_igv_splice_bed(all_introns_file, cancer_introns_file, genome_lib_dir, output_bed):
+    """ writes the igv splice junctions bed for the introns, annotated with the cancer introns """
+
+    # Create the object
+    bed_file = BEDfile(all_introns_file, cancer_introns_file, genome_lib_dir, output_bed)
+    # Create the bed file 
+    bed_file = bed_file.createBedFile()
+    # Save the Bed file 
+    bed_file.saveBedFile()
 
-    dt_genes.apply(lambda x: construct_viewport(x))
-    
     return
 
                     
@@ -240,12 +202,7 @@ def main():
 
     args = args_parser.parse_args()
 
-    # Create teh object
-    bed_file = BEDfile(args)
-    # Create the bed file 
-    bed_file = bed_file.createBedFile()
-    # Save the Bed file 
-    bed_file.saveBedFile()
+    make_igv_splice_bed(args.all_introns, args.cancer_introns, args.genome_lib_dir, args.output_bed)
 
 
 if __name__=='__main__':
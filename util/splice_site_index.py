@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+
+import sys, os, re
+import json
+import mmap
+import struct
+import hashlib
+import shutil
+import argparse
+import logging
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+INDEX_MAGIC = b"CTATSSI1"
+INDEX_FILE_SUFFIX = ".splice_sites.idx"
+
+
+"""
+Splice sites are stored as packed 64-bit integer keys:
+
+    (chromosome_id << 33) | (position << 1) | strand_bit
+
+where strand_bit is 0 for '+' and 1 for '-'.  The keys are kept sorted in
+an array alongside a parallel array of gene-set ids, so a lookup is a
+binary search and the on-disk form can be memory-mapped as-is.
+
+On-disk layout:
+
+    magic (8 bytes) | header length (uint64, little endian) | json header |
+    zero padding to 8-byte boundary | keys (uint64 x N) | gene set ids (uint32 x N)
+
+"""
+
+
+def pack_splice_site_key(chrom_id : int, pos : int, strand_bit : int) -> int:
+    return (chrom_id << 33) | (pos << 1) | strand_bit
+
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="build the compiled splice site index for a ctat genome lib", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("--ctat_genome_lib", dest="ctat_genome_lib", type=str, required=True, help="ctat genome lib build dir")
+
+    args = parser.parse_args()
+
+    targets_list_file = os.path.join(args.ctat_genome_lib, "ref_annot.gtf.mini.sortu")
+    load_splice_site_index(targets_list_file)
+
+    sys.exit(0)
+
+
+
+class SpliceSiteIndex:
+
+    def __init__(self, chromosomes : list, gene_sets : list, keys, gene_set_ids):
+
+        self._chromosomes = chromosomes
+        self._chrom_to_id = { chrom : i for (i, chrom) in enumerate(chromosomes) }
+        self._gene_sets = gene_sets
+        self._keys = keys
+        self._gene_set_ids = gene_set_ids
+        self._num_keys = len(keys)
+
+
+    def __len__(self):
+        return self._num_keys
+
+
+    def get_chromosome_id(self, chrom : str) -> int:
+        """ interned chromosome id, or None if the chromosome has no splice sites """
+        return self._chrom_to_id.get(chrom, None)
+
+
+    def get_genes(self, chrom : str, pos : int, strand : str) -> tuple:
+        """ returns the sorted tuple of gene ids having a splice site at chrom:pos:strand, or None """
+
+        chrom_id = self._chrom_to_id.get(chrom, None)
+        if chrom_id is None:
+            return None
+
+        strand_bit = 1 if strand == '-' else 0
+
+        return self.get_genes_by_key(pack_splice_site_key(chrom_id, pos, strand_bit))
+
+
+    def get_keys(self):
+        """ sorted packed splice site keys (buffer of uint64) """
+        return self._keys
+
+
+    def get_gene_set_ids(self):
+        """ gene set id for each of the keys (buffer of uint32) """
+        return self._gene_set_ids
+
+
+    def get_gene_set(self, gene_set_id : int) -> tuple:
+        return self._gene_sets[gene_set_id]
+
+
+    def get_genes_by_key(self, key : int) -> tuple:
+
+        i = bisect_left(self._keys, key)
+        if i < self._num_keys and self._keys[i] == key:
+            return self._gene_sets[self._gene_set_ids[i]]
+
+        return None
+
+
+    @classmethod
+    def build_from_targets_list(cls, targets_list_file : str):
+
+        logger.info("-reading targets list: {}".format(targets_list_file))
+
+        chrom_to_id = dict()
+        splice_site_to_genes = defaultdict(set)
+
+        with open(targets_list_file) as fh:
+            for line in fh:
+                line = line.rstrip()
+                vals = line.split("\t")
+                assert(len(vals) >= 9)
+                chr = vals[0]
+                lend = int(vals[3])
+                rend = int(vals[4])
+                orient = vals[6]
+                info = vals[8]
+
+                m = re.search("gene_id \"([^\"]+)\"", info)
+                if m:
+                    gene_id = m.group(1)
+                else:
+                    raise RuntimeError("Error, no gene id extracted from line: {}".format(line))
+
+                if orient not in ('+', '-'):
+                    # never matched by an intron lookup
+                    continue
+
+                if chr not in chrom_to_id:
+                    chrom_to_id[chr] = len(chrom_to_id)
+
+                chrom_id = chrom_to_id[chr]
+                strand_bit = 1 if orient == '-' else 0
+
+                splice_site_to_genes[pack_splice_site_key(chrom_id, lend - 1, strand_bit)].add(gene_id)
+                splice_site_to_genes[pack_splice_site_key(chrom_id, rend + 1, strand_bit)].add(gene_id)
+
+        chromosomes = sorted(chrom_to_id, key=lambda x: chrom_to_id[x])
+
+        gene_set_to_id = dict()
+        keys = array('Q')
+        gene_set_ids = array('I')
+
+        for key in sorted(splice_site_to_genes):
+            gene_set = tuple(sorted(splice_site_to_genes[key]))
+            gene_set_id = gene_set_to_id.get(gene_set, None)
+            if gene_set_id is None:
+                gene_set_id = gene_set_to_id[gene_set] = len(gene_set_to_id)
+            keys.append(key)
+            gene_set_ids.append(gene_set_id)
+
+        gene_sets = sorted(gene_set_to_id, key=lambda x: gene_set_to_id[x])
+
+        return cls(chromosomes, gene_sets, keys, gene_set_ids)
+
+
+    def write(self, index_file : str, source_info : dict) -> None:
+
+        genes = sorted({ gene for gene_set in self._gene_sets for gene in gene_set })
+        gene_to_idx = { gene : i for (i, gene) in enumerate(genes) }
+
+        header = { 'byteorder' : sys.byteorder,
+                   'num_keys' : self._num_keys,
+                   'chromosomes' : self._chromosomes,
+                   'genes' : genes,
+                   'gene_sets' : [ [ gene_to_idx[gene] for gene in gene_set ] for gene_set in self._gene_sets ],
+                   'source' : source_info }
+
+        header_bytes = json.dumps(header).encode()
+        header_end = len(INDEX_MAGIC) + 8 + len(header_bytes)
+        padding = -header_end % 8
+
+        # write to a temp file and rename into place, so concurrent readers never see a partial index
+        tmp_index_file = "{}.tmp.{}".format(index_file, os.getpid())
+        with open(tmp_index_file, 'wb') as ofh:
+            ofh.write(INDEX_MAGIC)
+            ofh.write(struct.pack("<Q", len(header_bytes)))
+            ofh.write(header_bytes)
+            ofh.write(b"\0" * padding)
+            ofh.write(array('Q', self._keys).tobytes())
+            ofh.write(array('I', self._gene_set_ids).tobytes())
+
+        os.replace(tmp_index_file, index_file)
+
+
+    @classmethod
+    def read_header(cls, index_file : str) -> dict:
+
+        with open(index_file, 'rb') as fh:
+            if fh.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                return None
+            (header_len,) = struct.unpack("<Q", fh.read(8))
+            header = json.loads(fh.read(header_len).decode())
+
+        header['data_offset'] = len(INDEX_MAGIC) + 8 + header_len + (-(len(INDEX_MAGIC) + 8 + header_len) % 8)
+
+        return header
+
+
+    @classmethod
+    def load(cls, index_file : str, header : dict = None):
+
+        if header is None:
+            header = cls.read_header(index_file)
+
+        num_keys = header['num_keys']
+        keys_offset = header['data_offset']
+        gene_set_ids_offset = keys_offset + 8 * num_keys
+
+        with open(index_file, 'rb') as fh:
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        mv = memoryview(mm)
+        keys = mv[keys_offset:gene_set_ids_offset].cast('Q')
+        gene_set_ids = mv[gene_set_ids_offset:gene_set_ids_offset + 4 * num_keys].cast('I')
+
+        genes = header['genes']
+        gene_sets = [ tuple(genes[i] for i in gene_set) for gene_set in header['gene_sets'] ]
+
+        return cls(header['chromosomes'], gene_sets, keys, gene_set_ids)
+
+
+
+def get_source_info(targets_list_file : str, include_checksum : bool = True) -> dict:
+
+    st = os.stat(targets_list_file)
+
+    source_info = { 'size' : st.st_size,
+                    'mtime_ns' : st.st_mtime_ns }
+
+    if include_checksum:
+        source_info['sha1'] = sha1sum(targets_list_file)
+
+    return source_info
+
+
+def sha1sum(filename : str) -> str:
+
+    checksum = hashlib.sha1()
+    with open(filename, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b""):
+            checksum.update(chunk)
+
+    return checksum.hexdigest()
+
+
+def index_is_current(header : dict, targets_list_file : str) -> bool:
+
+    if header is None or header.get('byteorder') != sys.byteorder:
+        return False
+
+    index_source_info = header['source']
+    source_info = get_source_info(targets_list_file, include_checksum=False)
+
+    if index_source_info['size'] != source_info['size']:
+        return False
+
+    if index_source_info['mtime_ns'] == source_info['mtime_ns']:
+        return True
+
+    # same size but touched or copied: compare contents.
+    return index_source_info['sha1'] == sha1sum(targets_list_file)
+
+
+
+def refresh_index_source_mtime(index_file : str, source_file : str, data_alignment : int = 1) -> bool:
+    """
+    For an index found current by checksum (its source was touched or copied), rewrites
+    the index header with the source's current mtime, keeping the data as-is, so later
+    runs match on mtime instead of checksumming the source again.
+    The data section starts on a data_alignment byte boundary after the header.
+    Returns True if the index file was rewritten.
+    """
+
+    mtime_ns = os.stat(source_file).st_mtime_ns
+
+    try:
+        with open(index_file, 'rb') as fh:
+            magic = fh.read(8)  # the index formats all use 8-byte magics
+            (header_len,) = struct.unpack("<Q", fh.read(8))
+            header = json.loads(fh.read(header_len).decode())
+
+            if header['source']['mtime_ns'] == mtime_ns:
+                return False
+
+            header_end = len(magic) + 8 + header_len
+            fh.seek(header_end + (-header_end % data_alignment))
+
+            header['source']['mtime_ns'] = mtime_ns
+            header_bytes = json.dumps(header).encode()
+            header_end = len(magic) + 8 + len(header_bytes)
+
+            tmp_index_file = "{}.tmp.{}".format(index_file, os.getpid())
+            with open(tmp_index_file, 'wb') as ofh:
+                ofh.write(magic)
+                ofh.write(struct.pack("<Q", len(header_bytes)))
+                ofh.write(header_bytes)
+                ofh.write(b"\0" * (-header_end % data_alignment))
+                shutil.copyfileobj(fh, ofh)
+
+        os.replace(tmp_index_file, index_file)
+
+    except OSError as e:
+        # ie. a read-only genome lib; the index is still used, just checksummed again next time.
+        logger.warning("-could not update the source mtime of {}: {}".format(index_file, str(e)))
+        return False
+
+    return True
+
+
+
+def load_splice_site_index(targets_list_file : str, use_cache : bool = True) -> SpliceSiteIndex:
+    """
+    Returns the splice site index for the targets list file, opening the compiled
+    index stored alongside it when it's current with the targets list, and
+    otherwise building it (and writing the compiled index for subsequent use).
+    """
+
+    index_file = targets_list_file + INDEX_FILE_SUFFIX
+
+    if use_cache and os.path.exists(index_file):
+        header = SpliceSiteIndex.read_header(index_file)
+        if index_is_current(header, targets_list_file):
+            if refresh_index_source_mtime(index_file, targets_list_file, data_alignment=8):
+                header = SpliceSiteIndex.read_header(index_file)
+            logger.info("-using compiled splice site index: {}".format(index_file))
+            return SpliceSiteIndex.load(index_file, header)
+        else:
+            logger.info("-compiled splice site index {} is out of date with {}".format(index_file, targets_list_file))
+
+    splice_site_index = SpliceSiteIndex.build_from_targets_list(targets_list_file)
+
+    if use_cache:
+        try:
+            splice_site_index.write(index_file, get_source_info(targets_list_file))
+            logger.info("-wrote compiled splice site index: {}".format(index_file))
+        except OSError as e:
+            # ie. a read-only genome lib; just use the in-memory index.
+            logger.warning("-could not write compiled splice site index {}: {}".format(index_file, str(e)))
+
+    return splice_site_index
+
+
+
+if __name__ == '__main__':
+    main()